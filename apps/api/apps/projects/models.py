@@ -74,6 +74,10 @@ class App(models.Model):
         choices=Framework.choices,
         default=Framework.FASTAPI,
     )
+    # Route templates such as "/v1/orders/{order_id}/items". The ingest
+    # service rewrites matching request paths to them (before its built-in
+    # id/uuid/hex/ulid rules), so endpoints and analytics group by route.
+    path_templates = models.JSONField(default=list, blank=True)
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -23,6 +23,7 @@ from .models import Project, App, Endpoint, Environment, ProjectMember
 from .validators import (
     validate_project_slug,
     validate_app_slug,
+    validate_path_templates,
     RESERVED_PROJECT_SLUGS,
     RESERVED_APP_SLUGS,
 )
@@ -386,6 +387,7 @@ class AppService:
         name: str | None = None,
         description: str | None = None,
         framework: str | None = None,
+        path_templates: list[str] | None = None,
     ) -> App:
         """Update an app's details."""
         app = AppService.get_app_by_slug(project, slug)
@@ -406,6 +408,9 @@ class AppService:
                 raise ValidationError("Invalid framework")
             app.framework = normalized
 
+        if path_templates is not None:
+            app.path_templates = validate_path_templates(path_templates)
+
         app.save()
         return app
 
@@ -588,6 +593,10 @@ class IngestService:
     _api_logs_table_lock = threading.Lock()
     _api_spans_table_ready = False
     _api_spans_table_lock = threading.Lock()
+    _request_stats_ready = False
+    _request_stats_lock = threading.Lock()
+    # Latency sketch of api_request_rollups: bin i spans (GAMMA**(i-1), GAMMA**i] ms.
+    ROLLUP_SKETCH_GAMMA = 1.01 / 0.99
 
     @staticmethod
     def ensure_payload_columns(client) -> None:
@@ -779,9 +788,9 @@ class IngestService:
                         status LowCardinality(String) CODEC(ZSTD(1)),
                         status_code UInt16 CODEC(ZSTD(1)),
                         attributes_json String CODEC(ZSTD(3))
-                    ) ENGINE = MergeTree()
+                    ) ENGINE = ReplacingMergeTree()
                     PARTITION BY toYYYYMM(timestamp)
-                    ORDER BY (app_id, trace_id, timestamp)
+                    ORDER BY (app_id, trace_id, span_id)
                     TTL toDateTime(timestamp) + INTERVAL 30 DAY
                     SETTINGS index_granularity = 8192
                     """
@@ -792,11 +801,107 @@ class IngestService:
                 client.execute(
                     "ALTER TABLE api_spans ADD INDEX IF NOT EXISTS idx_api_spans_project_id project_id TYPE bloom_filter(0.01) GRANULARITY 1"
                 )
+                client.execute(
+                    "ALTER TABLE api_spans ADD COLUMN IF NOT EXISTS sample_rate Float32 DEFAULT 1 CODEC(ZSTD(1))"
+                )
             except Exception as exc:
                 logger.warning("Unable to ensure api_spans table: %s", exc)
                 return
             IngestService._api_spans_table_ready = True
 
+    @staticmethod
+    def ensure_request_stats_view(client) -> None:
+        """Create ``api_request_stats``: the source of every aggregate analytics query.
+
+        Raw requests (minus those an SDK also counted in a rollup) plus the
+        per-minute rollups of SDKs in rollup mode, one row per occupied
+        latency sketch bin. Every row has a ``weight``, the number of requests
+        it stands for: ``1 / sample_rate`` for a raw row (1 unless an SDK kept
+        it by sampling), the bin's count for a rollup row, whose latency is
+        the bin's midpoint (within 1% of the real value) and whose sizes are
+        the bucket's per-request averages. Queries aggregate with
+        ``sum(weight)``, ``sum(size * weight)``, ``avgWeighted`` and
+        ``quantileTDigestWeighted(q)(response_time_ms, quantile_weight)``.
+        Rollups carry no consumer id, ip or user agent. Keep the table in
+        lock-step with apps/ingest ensure_clickhouse_schema.
+        """
+        if IngestService._request_stats_ready:
+            return
+        IngestService.ensure_consumer_columns(client)
+        IngestService.ensure_base_url_column(client)
+        IngestService.ensure_trace_columns(client)
+        with IngestService._request_stats_lock:
+            if IngestService._request_stats_ready:
+                return
+            gamma = repr(IngestService.ROLLUP_SKETCH_GAMMA)
+            try:
+                client.execute(
+                    "ALTER TABLE api_requests ADD COLUMN IF NOT EXISTS rolled_up UInt8 DEFAULT 0 CODEC(ZSTD(1))"
+                )
+                client.execute(
+                    "ALTER TABLE api_requests ADD COLUMN IF NOT EXISTS sample_rate Float32 DEFAULT 1 CODEC(ZSTD(1))"
+                )
+                client.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS api_request_rollups (
+                        timestamp DateTime64(3) CODEC(DoubleDelta, ZSTD(1)),
+                        app_id String CODEC(ZSTD(1)),
+                        project_id String CODEC(ZSTD(1)),
+                        endpoint_id String CODEC(ZSTD(1)),
+                        environment LowCardinality(String) CODEC(ZSTD(1)),
+                        method LowCardinality(String) CODEC(ZSTD(1)),
+                        path String CODEC(ZSTD(1)),
+                        status_code UInt16 CODEC(ZSTD(1)),
+                        consumer_group String CODEC(ZSTD(1)),
+                        request_count UInt64 CODEC(ZSTD(1)),
+                        request_bytes UInt64 CODEC(ZSTD(1)),
+                        response_bytes UInt64 CODEC(ZSTD(1)),
+                        latency_bins Array(Int16) CODEC(ZSTD(1)),
+                        latency_counts Array(UInt64) CODEC(ZSTD(1))
+                    ) ENGINE = MergeTree()
+                    PARTITION BY toYYYYMM(timestamp)
+                    ORDER BY (app_id, timestamp, method, path, status_code)
+                    SETTINGS index_granularity = 8192
+                    """
+                )
+                # quantile_weight is weight in thousandths of a request: the
+                # weighted quantile functions take integer weights.
+                client.execute(
+                    f"""
+                    CREATE OR REPLACE VIEW api_request_stats AS
+                    SELECT
+                        timestamp, app_id, project_id, environment, method, path, status_code,
+                        response_time_ms, request_size, response_size, ip_address, user_agent,
+                        consumer_id, consumer_name, consumer_group, base_url,
+                        1 / toFloat64(sample_rate) AS weight, toUInt64(round(1000 / toFloat64(sample_rate))) AS quantile_weight
+                    FROM api_requests
+                    WHERE rolled_up = 0
+                    UNION ALL
+                    SELECT
+                        timestamp, app_id, project_id, environment, method, path, status_code,
+                        2 * pow({gamma}, bin) / ({gamma} + 1) AS response_time_ms,
+                        request_bytes / request_count AS request_size,
+                        response_bytes / request_count AS response_size,
+                        '' AS ip_address, '' AS user_agent, '' AS consumer_id, '' AS consumer_name,
+                        consumer_group, '' AS base_url,
+                        toFloat64(bin_count) AS weight, bin_count * 1000 AS quantile_weight
+                    FROM api_request_rollups
+                    ARRAY JOIN latency_bins AS bin, latency_counts AS bin_count
+                    """
+                )
+            except Exception as exc:
+                logger.warning("Unable to ensure api_request_stats view: %s", exc)
+                return
+            IngestService._request_stats_ready = True
+
+    @staticmethod
+    def request_stats_source(client) -> str:
+        """``api_request_stats`` for aggregate queries, or raw ``api_requests`` (weight 1) if the view can't be created."""
+        IngestService.ensure_request_stats_view(client)
+        if IngestService._request_stats_ready:
+            return "api_request_stats"
+        return "(SELECT *, toFloat64(1) AS weight, toUInt64(1000) AS quantile_weight FROM api_requests)"
+
     @staticmethod
     def _safe_log_text(value: str, *, limit: int) -> str:
         if not value:
@@ -991,19 +1096,20 @@ class EndpointStatsService:
             params["search"] = f"%{normalized_search}%"
             search_filter = "AND (lower(path) LIKE %(search)s OR lower(method) LIKE %(search)s)"
 
+        source = IngestService.request_stats_source(client) if client is not None else "api_requests"
         query = f"""
             SELECT
                 method,
                 path,
-                count() AS total_requests,
-                countIf(status_code >= 400) AS error_count,
-                if(count() > 0, countIf(status_code >= 400) / count() * 100, 0) AS error_rate,
-                avg(response_time_ms) AS avg_response_time_ms,
-                quantile(0.95)(response_time_ms) AS p95_response_time_ms,
-                sum(request_size) AS total_request_bytes,
-                sum(response_size) AS total_response_bytes,
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                if(sum(weight) > 0, sumIf(weight, status_code >= 400) / sum(weight) * 100, 0) AS error_rate,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms,
+                quantileTDigestWeighted(0.95)(response_time_ms, quantile_weight) AS p95_response_time_ms,
+                toUInt64(round(sum(request_size * weight))) AS total_request_bytes,
+                toUInt64(round(sum(response_size * weight))) AS total_response_bytes,
                 max(timestamp) AS last_seen_at
-            FROM api_requests
+            FROM {source}
             WHERE app_id = %(app_id)s
               AND timestamp >= %(since)s
               AND timestamp <= %(until)s
@@ -1169,11 +1275,12 @@ class EndpointStatsService:
             "until": until_dt,
             "limit": max(1, min(limit, 100)),
         }
-        query = """
+        source = IngestService.request_stats_source(client)
+        query = f"""
             SELECT
                 environment,
-                count() AS total_requests
-            FROM api_requests
+                toUInt64(round(sum(weight))) AS total_requests
+            FROM {source}
             WHERE app_id = %(app_id)s
               AND timestamp >= %(since)s
               AND timestamp <= %(until)s
@@ -1221,6 +1328,7 @@ class ConsumerStatsService:
             env_filter = "AND environment = %(environment)s"
             params["environment"] = environment
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
                 if(
@@ -1235,12 +1343,12 @@ class ConsumerStatsService:
                 if(consumer_id != '', consumer_id, '') AS consumer_identifier,
                 if(consumer_name != '', consumer_name, '') AS consumer_name,
                 if(consumer_group != '', consumer_group, '') AS consumer_group,
-                count() AS total_requests,
-                countIf(status_code >= 400) AS error_count,
-                if(count() > 0, countIf(status_code >= 400) / count() * 100, 0) AS error_rate,
-                avg(response_time_ms) AS avg_response_time_ms,
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                if(sum(weight) > 0, sumIf(weight, status_code >= 400) / sum(weight) * 100, 0) AS error_rate,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms,
                 max(timestamp) AS last_seen_at
-            FROM api_requests
+            FROM {source}
             WHERE app_id = %(app_id)s
               AND timestamp >= %(since)s
               AND timestamp <= %(until)s
@@ -1386,17 +1494,18 @@ class ConsumerStatsService:
             env_filter = "AND environment = %(environment)s"
             params["environment"] = environment
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
                 %(consumer)s AS consumer,
                 method,
                 path,
-                count() AS total_requests,
-                countIf(status_code >= 400) AS error_count,
-                if(count() > 0, countIf(status_code >= 400) / count() * 100, 0) AS error_rate,
-                avg(response_time_ms) AS avg_response_time_ms,
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                if(sum(weight) > 0, sumIf(weight, status_code >= 400) / sum(weight) * 100, 0) AS error_rate,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms,
                 max(timestamp) AS last_seen_at
-            FROM api_requests
+            FROM {source}
             WHERE app_id = %(app_id)s
               AND timestamp >= %(since)s
               AND timestamp <= %(until)s
@@ -1893,6 +2002,7 @@ class DataQueryService:
             WHERE project_id = %(project_id)s
               AND trace_id = %(trace_id)s
             ORDER BY timestamp ASC
+            LIMIT 1 BY span_id
             LIMIT 500
         """
         try:
@@ -2265,15 +2375,16 @@ class AnalyticsService:
             env_filter = "AND environment = %(environment)s"
             params["environment"] = environment
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
-                count() AS total_requests,
-                countIf(status_code >= 400) AS error_count,
-                if(count() > 0, countIf(status_code >= 400) / count() * 100, 0) AS error_rate,
-                avg(response_time_ms) AS avg_response_time_ms,
-                quantile(0.95)(response_time_ms) AS p95_response_time_ms,
-                sum(request_size) AS total_request_bytes,
-                sum(response_size) AS total_response_bytes,
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                if(sum(weight) > 0, sumIf(weight, status_code >= 400) / sum(weight) * 100, 0) AS error_rate,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms,
+                quantileTDigestWeighted(0.95)(response_time_ms, quantile_weight) AS p95_response_time_ms,
+                toUInt64(round(sum(request_size * weight))) AS total_request_bytes,
+                toUInt64(round(sum(response_size * weight))) AS total_response_bytes,
                 uniqExact((method, path)) AS unique_endpoints,
                 uniqExact(
                     if(
@@ -2286,7 +2397,7 @@ class AnalyticsService:
                         )
                     )
                 ) AS unique_consumers
-            FROM api_requests
+            FROM {source}
             WHERE app_id = %(app_id)s
               AND timestamp >= %(since)s
               AND timestamp <= %(until)s
@@ -2349,17 +2460,18 @@ class AnalyticsService:
             env_filter = "AND environment = %(environment)s"
             params["environment"] = environment
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
                 toTimeZone(toStartOfHour(toTimeZone(timestamp, %(timezone)s)), 'UTC') AS bucket,
-                count() AS total_requests,
-                countIf(status_code >= 400) AS error_count,
-                if(count() > 0, countIf(status_code >= 400) / count() * 100, 0) AS error_rate,
-                avg(response_time_ms) AS avg_response_time_ms,
-                quantile(0.95)(response_time_ms) AS p95_response_time_ms,
-                sum(request_size) AS total_request_bytes,
-                sum(response_size) AS total_response_bytes
-            FROM api_requests
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                if(sum(weight) > 0, sumIf(weight, status_code >= 400) / sum(weight) * 100, 0) AS error_rate,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms,
+                quantileTDigestWeighted(0.95)(response_time_ms, quantile_weight) AS p95_response_time_ms,
+                toUInt64(round(sum(request_size * weight))) AS total_request_bytes,
+                toUInt64(round(sum(response_size * weight))) AS total_response_bytes
+            FROM {source}
             WHERE app_id = %(app_id)s
               AND timestamp >= %(since)s
               AND timestamp <= %(until)s
@@ -2401,6 +2513,7 @@ class AnalyticsService:
             env_filter = "AND environment = %(environment)s"
             params["environment"] = environment
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
                 if(
@@ -2409,11 +2522,11 @@ class AnalyticsService:
                     concat('/', splitByChar('/', trim(BOTH '/' FROM path))[1])
                 ) AS family,
                 uniqExact((method, path)) AS endpoint_count,
-                count() AS total_requests,
-                countIf(status_code >= 400) AS error_count,
-                if(count() > 0, countIf(status_code >= 400) / count() * 100, 0) AS error_rate,
-                avg(response_time_ms) AS avg_response_time_ms
-            FROM api_requests
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                if(sum(weight) > 0, sumIf(weight, status_code >= 400) / sum(weight) * 100, 0) AS error_rate,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms
+            FROM {source}
             WHERE app_id = %(app_id)s
               AND timestamp >= %(since)s
               AND timestamp <= %(until)s
@@ -2469,19 +2582,20 @@ class AnalyticsService:
             env_filter = "AND environment = %(environment)s"
             params["environment"] = environment
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
                 method,
                 path,
-                count() AS total_requests,
-                countIf(status_code >= 400) AS error_count,
-                if(count() > 0, countIf(status_code >= 400) / count() * 100, 0) AS error_rate,
-                avg(response_time_ms) AS avg_response_time_ms,
-                quantile(0.95)(response_time_ms) AS p95_response_time_ms,
-                sum(request_size) AS total_request_bytes,
-                sum(response_size) AS total_response_bytes,
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                if(sum(weight) > 0, sumIf(weight, status_code >= 400) / sum(weight) * 100, 0) AS error_rate,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms,
+                quantileTDigestWeighted(0.95)(response_time_ms, quantile_weight) AS p95_response_time_ms,
+                toUInt64(round(sum(request_size * weight))) AS total_request_bytes,
+                toUInt64(round(sum(response_size * weight))) AS total_response_bytes,
                 max(timestamp) AS last_seen_at
-            FROM api_requests
+            FROM {source}
             WHERE app_id = %(app_id)s
               AND method = %(method)s
               AND path = %(path)s
@@ -2543,13 +2657,14 @@ class AnalyticsService:
             env_filter = "AND environment = %(environment)s"
             params["environment"] = environment
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
                 toTimeZone(toStartOfHour(toTimeZone(timestamp, %(timezone)s)), 'UTC') AS bucket,
-                count() AS total_requests,
-                countIf(status_code >= 400) AS error_count,
-                avg(response_time_ms) AS avg_response_time_ms
-            FROM api_requests
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms
+            FROM {source}
             WHERE app_id = %(app_id)s
               AND method = %(method)s
               AND path = %(path)s
@@ -2598,6 +2713,7 @@ class AnalyticsService:
             env_filter = "AND environment = %(environment)s"
             params["environment"] = environment
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
                 if(
@@ -2609,11 +2725,11 @@ class AnalyticsService:
                         'unknown'
                     )
                 ) AS consumer,
-                count() AS total_requests,
-                countIf(status_code >= 400) AS error_count,
-                if(count() > 0, countIf(status_code >= 400) / count() * 100, 0) AS error_rate,
-                avg(response_time_ms) AS avg_response_time_ms
-            FROM api_requests
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                if(sum(weight) > 0, sumIf(weight, status_code >= 400) / sum(weight) * 100, 0) AS error_rate,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms
+            FROM {source}
             WHERE app_id = %(app_id)s
               AND method = %(method)s
               AND path = %(path)s
@@ -2662,11 +2778,12 @@ class AnalyticsService:
             env_filter = "AND environment = %(environment)s"
             params["environment"] = environment
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
                 status_code,
-                count() AS total_requests
-            FROM api_requests
+                toUInt64(round(sum(weight))) AS total_requests
+            FROM {source}
             WHERE app_id = %(app_id)s
               AND method = %(method)s
               AND path = %(path)s
@@ -2836,15 +2953,16 @@ class AnalyticsService:
 
         filters.append(AnalyticsService.build_filter_clause(project_id, filter, params))
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
-                count() AS total_requests,
-                countIf(status_code >= 400) AS error_count,
-                if(count() > 0, countIf(status_code >= 400) / count() * 100, 0) AS error_rate,
-                avg(response_time_ms) AS avg_response_time_ms,
-                quantile(0.95)(response_time_ms) AS p95_response_time_ms,
-                sum(request_size) AS total_request_bytes,
-                sum(response_size) AS total_response_bytes,
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                if(sum(weight) > 0, sumIf(weight, status_code >= 400) / sum(weight) * 100, 0) AS error_rate,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms,
+                quantileTDigestWeighted(0.95)(response_time_ms, quantile_weight) AS p95_response_time_ms,
+                toUInt64(round(sum(request_size * weight))) AS total_request_bytes,
+                toUInt64(round(sum(response_size * weight))) AS total_response_bytes,
                 uniqExact((method, path)) AS unique_endpoints,
                 uniqExact(
                     if(
@@ -2857,7 +2975,7 @@ class AnalyticsService:
                         )
                     )
                 ) AS unique_consumers
-            FROM api_requests
+            FROM {source}
             {' '.join(filters)}
         """
         try:
@@ -2950,17 +3068,18 @@ class AnalyticsService:
         fill_from = f"toTimeZone({bucket_fn}(toTimeZone(toDateTime(%(since)s), %(timezone)s)), 'UTC')"
         fill_to = f"toTimeZone({bucket_fn}(toTimeZone(toDateTime(%(until)s), %(timezone)s)), 'UTC') + INTERVAL 1 {step_unit}"
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
                 {bucket_expr} AS bucket,
-                count() AS total_requests,
-                countIf(status_code >= 400) AS error_count,
-                if(count() > 0, countIf(status_code >= 400) / count() * 100, 0) AS error_rate,
-                avg(response_time_ms) AS avg_response_time_ms,
-                quantile(0.95)(response_time_ms) AS p95_response_time_ms,
-                sum(request_size) AS total_request_bytes,
-                sum(response_size) AS total_response_bytes
-            FROM api_requests
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                if(sum(weight) > 0, sumIf(weight, status_code >= 400) / sum(weight) * 100, 0) AS error_rate,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms,
+                quantileTDigestWeighted(0.95)(response_time_ms, quantile_weight) AS p95_response_time_ms,
+                toUInt64(round(sum(request_size * weight))) AS total_request_bytes,
+                toUInt64(round(sum(response_size * weight))) AS total_response_bytes
+            FROM {source}
             {' '.join(filters)}
             GROUP BY bucket
             ORDER BY bucket ASC
@@ -3066,9 +3185,10 @@ class AnalyticsService:
         sort_direction = "DESC" if sort_dir.lower() == "desc" else "ASC"
 
         # Count total matching endpoints
+        source = IngestService.request_stats_source(client)
         count_query = f"""
             SELECT count(DISTINCT (method, path))
-            FROM api_requests
+            FROM {source}
             {' '.join(filters)}
         """
 
@@ -3090,12 +3210,12 @@ class AnalyticsService:
             SELECT
                 method,
                 path,
-                count() AS total_requests,
-                countIf(status_code >= 400) AS error_count,
-                (countIf(status_code >= 400) / count()) * 100 AS error_rate,
-                avg(response_time_ms) AS avg_response_time_ms,
-                quantile(0.95)(response_time_ms) AS p95_response_time_ms
-            FROM api_requests
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                (sumIf(weight, status_code >= 400) / sum(weight)) * 100 AS error_rate,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms,
+                quantileTDigestWeighted(0.95)(response_time_ms, quantile_weight) AS p95_response_time_ms
+            FROM {source}
             {' '.join(filters)}
             GROUP BY method, path
             ORDER BY {sort_column} {sort_direction}
@@ -3262,9 +3382,10 @@ class AnalyticsService:
             filters.append("AND app_id IN %(app_ids)s")
             params["app_ids"] = app_ids
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT DISTINCT environment
-            FROM api_requests
+            FROM {source}
             {' '.join(filters)}
             AND environment != ''
             ORDER BY environment
@@ -3387,32 +3508,33 @@ class AnalyticsService:
         params["threshold"] = threshold_ms
         params["threshold4"] = threshold_ms * 4
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
-                count() AS total_requests,
-                countIf(status_code < 400) AS successful_requests,
-                countIf(status_code >= 400 AND status_code < 500) AS client_errors,
-                countIf(status_code >= 500) AS server_errors,
-                countIf(status_code >= 400) AS error_count,
-                if(count() > 0, countIf(status_code >= 400) / count() * 100, 0) AS error_rate,
-                avg(response_time_ms) AS avg_response_time_ms,
-                quantile(0.50)(response_time_ms) AS p50_response_time_ms,
-                quantile(0.75)(response_time_ms) AS p75_response_time_ms,
-                quantile(0.95)(response_time_ms) AS p95_response_time_ms,
-                countIf(response_time_ms > %(threshold)s) AS slow_requests,
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code < 400))) AS successful_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400 AND status_code < 500))) AS client_errors,
+                toUInt64(round(sumIf(weight, status_code >= 500))) AS server_errors,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                if(sum(weight) > 0, sumIf(weight, status_code >= 400) / sum(weight) * 100, 0) AS error_rate,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms,
+                quantileTDigestWeighted(0.50)(response_time_ms, quantile_weight) AS p50_response_time_ms,
+                quantileTDigestWeighted(0.75)(response_time_ms, quantile_weight) AS p75_response_time_ms,
+                quantileTDigestWeighted(0.95)(response_time_ms, quantile_weight) AS p95_response_time_ms,
+                toUInt64(round(sumIf(weight, response_time_ms > %(threshold)s))) AS slow_requests,
                 if(
-                    count() > 0,
-                    (countIf(response_time_ms <= %(threshold)s)
-                        + countIf(response_time_ms > %(threshold)s AND response_time_ms <= %(threshold4)s) / 2)
-                    / count(),
+                    sum(weight) > 0,
+                    (sumIf(weight, response_time_ms <= %(threshold)s)
+                        + sumIf(weight, response_time_ms > %(threshold)s AND response_time_ms <= %(threshold4)s) / 2)
+                    / sum(weight),
                     0
                 ) AS apdex,
-                sum(request_size) AS total_request_bytes,
-                sum(response_size) AS total_response_bytes,
-                avg(response_size) AS avg_response_size,
+                toUInt64(round(sum(request_size * weight))) AS total_request_bytes,
+                toUInt64(round(sum(response_size * weight))) AS total_response_bytes,
+                avgWeighted(response_size, weight) AS avg_response_size,
                 max(timestamp) AS last_seen_at,
                 anyIf(base_url, base_url != '') AS base_url
-            FROM api_requests
+            FROM {source}
             {' '.join(filters)}
         """
         try:
@@ -3457,20 +3579,21 @@ class AnalyticsService:
         )
         params["timezone"] = _resolve_bucket_timezone(timezone_name)
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
                 toTimeZone(toStartOfHour(toTimeZone(timestamp, %(timezone)s)), 'UTC') AS bucket,
-                count() AS total_requests,
-                countIf(status_code >= 400) AS error_count,
-                countIf(status_code >= 400 AND status_code < 500) AS client_errors,
-                countIf(status_code >= 500) AS server_errors,
-                avg(response_time_ms) AS avg_response_time_ms,
-                quantile(0.50)(response_time_ms) AS p50_response_time_ms,
-                quantile(0.95)(response_time_ms) AS p95_response_time_ms,
-                quantile(0.99)(response_time_ms) AS p99_response_time_ms,
-                sum(request_size) AS total_request_bytes,
-                sum(response_size) AS total_response_bytes
-            FROM api_requests
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                toUInt64(round(sumIf(weight, status_code >= 400 AND status_code < 500))) AS client_errors,
+                toUInt64(round(sumIf(weight, status_code >= 500))) AS server_errors,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms,
+                quantileTDigestWeighted(0.50)(response_time_ms, quantile_weight) AS p50_response_time_ms,
+                quantileTDigestWeighted(0.95)(response_time_ms, quantile_weight) AS p95_response_time_ms,
+                quantileTDigestWeighted(0.99)(response_time_ms, quantile_weight) AS p99_response_time_ms,
+                toUInt64(round(sum(request_size * weight))) AS total_request_bytes,
+                toUInt64(round(sum(response_size * weight))) AS total_response_bytes
+            FROM {source}
             {' '.join(filters)}
             GROUP BY bucket
             ORDER BY bucket ASC
@@ -3512,6 +3635,7 @@ class AnalyticsService:
         )
         params["limit"] = max(1, min(limit, 50))
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
                 if(
@@ -3524,11 +3648,11 @@ class AnalyticsService:
                     )
                 ) AS consumer,
                 if(consumer_id != '', consumer_id, '') AS consumer_identifier,
-                count() AS total_requests,
-                countIf(status_code >= 400) AS error_count,
-                if(count() > 0, countIf(status_code >= 400) / count() * 100, 0) AS error_rate,
-                avg(response_time_ms) AS avg_response_time_ms
-            FROM api_requests
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                if(sum(weight) > 0, sumIf(weight, status_code >= 400) / sum(weight) * 100, 0) AS error_rate,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms
+            FROM {source}
             {' '.join(filters)}
             GROUP BY consumer, consumer_identifier
             ORDER BY total_requests DESC
@@ -3583,6 +3707,7 @@ class AnalyticsService:
             filters.append("AND environment = %(environment)s")
             params["environment"] = environment
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
                 if(
@@ -3595,8 +3720,8 @@ class AnalyticsService:
                     )
                 ) AS consumer,
                 if(consumer_id != '', consumer_id, '') AS consumer_identifier,
-                count() AS total_requests
-            FROM api_requests
+                toUInt64(round(sum(weight))) AS total_requests
+            FROM {source}
             {' '.join(filters)}
             GROUP BY consumer, consumer_identifier
             HAVING consumer != 'unknown'
@@ -3766,6 +3891,7 @@ class AnalyticsService:
             having.append("positionCaseInsensitive(consumer, %(search)s) > 0")
             params["search"] = search.strip()
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
                 if(
@@ -3775,12 +3901,12 @@ class AnalyticsService:
                 ) AS consumer,
                 any(if(consumer_id != '', consumer_id, '')) AS consumer_identifier,
                 any(if(consumer_group != '', consumer_group, '')) AS consumer_group,
-                count() AS total_requests,
-                countIf(status_code >= 400) AS error_count,
-                if(count() > 0, countIf(status_code >= 400) / count() * 100, 0) AS error_rate,
-                avg(response_time_ms) AS avg_response_time_ms,
+                toUInt64(round(sum(weight))) AS total_requests,
+                toUInt64(round(sumIf(weight, status_code >= 400))) AS error_count,
+                if(sum(weight) > 0, sumIf(weight, status_code >= 400) / sum(weight) * 100, 0) AS error_rate,
+                avgWeighted(response_time_ms, weight) AS avg_response_time_ms,
                 max(timestamp) AS last_seen_at
-            FROM api_requests
+            FROM {source}
             {' '.join(filters)}
             GROUP BY consumer
             HAVING {' AND '.join(having)}
@@ -3818,11 +3944,12 @@ class AnalyticsService:
         )
         params["limit"] = max(1, min(limit, 50))
 
+        source = IngestService.request_stats_source(client)
         query = f"""
             SELECT
                 status_code,
-                count() AS total_requests
-            FROM api_requests
+                toUInt64(round(sum(weight))) AS total_requests
+            FROM {source}
             {' '.join(filters)}
             GROUP BY status_code
             ORDER BY total_requests DESC
@@ -3940,33 +4067,69 @@ class AnalyticsService:
         )
         bins = max(5, min(bins, 60))
 
+        # Equal-width bins summing ``weight``: ClickHouse's ``histogram`` can't
+        # weight rows, and a rollup row stands for a whole sketch bin.
+        source = IngestService.request_stats_source(client)
+        bounds_query = f"""
+            SELECT
+                sum(weight) AS total,
+                min(response_time_ms) AS time_min,
+                max(response_time_ms) AS time_max,
+                min(toFloat64(response_size)) AS size_min,
+                max(toFloat64(response_size)) AS size_max
+            FROM {source}
+            {' '.join(filters)}
+        """
         query = f"""
             SELECT
-                histogram({bins})(response_time_ms) AS response_time_hist,
-                histogram({bins})(toFloat64(response_size)) AS response_size_hist
-            FROM api_requests
+                sumMap(
+                    [least(toUInt32(floor((response_time_ms - %(time_min)s) / %(time_width)s)), {bins - 1})],
+                    [weight]
+                ) AS response_time_hist,
+                sumMap(
+                    [least(toUInt32(floor((toFloat64(response_size) - %(size_min)s) / %(size_width)s)), {bins - 1})],
+                    [weight]
+                ) AS response_size_hist
+            FROM {source}
             {' '.join(filters)}
         """
 
-        def _to_buckets(raw) -> list[dict]:
+        def _width(low: float, high: float) -> float:
+            return (high - low) / bins if high > low else 1.0
+
+        def _to_buckets(raw, low: float, width: float) -> list[dict]:
             buckets = []
-            for item in raw or []:
+            try:
+                indexes, counts = raw
+            except (TypeError, ValueError):
+                return buckets
+            for index, count in zip(indexes, counts):
                 try:
-                    lower, upper, height = float(item[0]), float(item[1]), float(item[2])
-                except (TypeError, IndexError, KeyError, ValueError):
+                    lower, height = low + int(index) * width, float(count)
+                except (TypeError, ValueError):
                     continue
-                if not (math.isfinite(lower) and math.isfinite(upper) and math.isfinite(height)):
+                if not (math.isfinite(lower) and math.isfinite(height)):
                     continue
                 if height <= 0:
                     continue
-                buckets.append({"lower": lower, "upper": upper, "count": height})
+                buckets.append({"lower": lower, "upper": lower + width, "count": height})
             return buckets
 
         try:
-            rows = client.execute(query, params)
+            bounds = client.execute(bounds_query, params)
+            if not bounds or not bounds[0].get("total"):
+                return result
+            bounds = bounds[0]
+            time_min, size_min = float(bounds["time_min"]), float(bounds["size_min"])
+            time_width = _width(time_min, float(bounds["time_max"]))
+            size_width = _width(size_min, float(bounds["size_max"]))
+            rows = client.execute(
+                query,
+                {**params, "time_min": time_min, "time_width": time_width, "size_min": size_min, "size_width": size_width},
+            )
             if rows:
-                result["response_time"] = _to_buckets(rows[0].get("response_time_hist"))
-                result["response_size"] = _to_buckets(rows[0].get("response_size_hist"))
+                result["response_time"] = _to_buckets(rows[0].get("response_time_hist"), time_min, time_width)
+                result["response_size"] = _to_buckets(rows[0].get("response_size_hist"), size_min, size_width)
         except Exception as exc:
             logger.warning("ClickHouse query failed for project endpoint histograms; returning empty histograms: %s", exc)
 
@@ -1,8 +1,10 @@
 """
-Slug validation utilities for projects and apps.
-Prevents conflicts with route paths and reserved keywords.
+Validation utilities for projects and apps.
+Slugs: prevents conflicts with route paths and reserved keywords.
 """
 
+import re
+
 from core.exceptions.base import ValidationError
 
 # Reserved slugs that conflict with frontend routes or API endpoints
@@ -153,3 +155,43 @@ def is_slug_reserved(slug: str, slug_type: str = "project") -> bool:
     """
     reserved_set = RESERVED_PROJECT_SLUGS if slug_type == "project" else RESERVED_APP_SLUGS
     return slug.lower() in reserved_set
+
+
+MAX_PATH_TEMPLATES = 100
+_TEMPLATE_PLACEHOLDER = re.compile(r"\{[A-Za-z_][A-Za-z0-9_]*(?::path)?\}")
+
+
+def validate_path_templates(templates: list[str]) -> list[str]:
+    """
+    Validate an app's route templates (used by the ingest service to group
+    concrete paths, e.g. "/v1/orders/{order_id}/items").
+
+    Each template starts with "/", contains at least one {placeholder}
+    ({name} = one path segment, {name:path} = the rest of the path) and has
+    balanced braces.
+
+    Returns:
+        The stripped, de-duplicated templates in their original order.
+
+    Raises:
+        ValidationError: If a template is invalid or there are too many
+    """
+    cleaned: list[str] = []
+    for raw in templates:
+        template = (raw or "").strip()
+        if not template:
+            continue
+        if not template.startswith("/"):
+            raise ValidationError(f"Path template '{template}' must start with '/'")
+        if len(template) > 500:
+            raise ValidationError("Path template is too long (max 500 characters)")
+        if not _TEMPLATE_PLACEHOLDER.search(template):
+            raise ValidationError(f"Path template '{template}' has no {{placeholder}}")
+        rest = _TEMPLATE_PLACEHOLDER.sub("", template)
+        if "{" in rest or "}" in rest:
+            raise ValidationError(f"Path template '{template}' has an invalid placeholder")
+        if template not in cleaned:
+            cleaned.append(template)
+    if len(cleaned) > MAX_PATH_TEMPLATES:
+        raise ValidationError(f"Maximum of {MAX_PATH_TEMPLATES} path templates allowed per app")
+    return cleaned
@@ -139,7 +139,9 @@ def update_app(request: HttpRequest, project_slug: str, app_slug: str, data: Upd
     """Update an app's details."""
     user: User = request.auth
     project = ProjectService.get_project_by_slug(user, project_slug, action="write")
-    app = AppService.update_app(project, app_slug, data.name, data.description, data.framework)
+    app = AppService.update_app(
+        project, app_slug, data.name, data.description, data.framework, data.path_templates
+    )
     return AppResponse.from_orm(app)
 
 
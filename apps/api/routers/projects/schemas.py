@@ -73,6 +73,7 @@ class UpdateAppRequest(Schema):
     name: str | None = None
     description: str | None = None
     framework: str | None = None
+    path_templates: list[str] | None = None
 
 
 class AppResponse(Schema):
@@ -83,6 +84,7 @@ class AppResponse(Schema):
     description: str
     framework: str
     icon: str
+    path_templates: list[str]
     created_at: datetime
     updated_at: datetime
 
@@ -96,6 +98,7 @@ class AppResponse(Schema):
             description=app.description,
             framework=app.framework,
             icon=app.icon,
+            path_templates=app.path_templates or [],
             created_at=app.created_at,
             updated_at=app.updated_at,
         )
@@ -0,0 +1,278 @@
+"""Async twins of the ingest entrypoints (``APILENS_INGEST_ASYNC=true``).
+
+The sync entrypoints run in Starlette's threadpool and hold a thread for
+every Postgres and ClickHouse round trip, so a worker serves about 40
+requests at once and a slow INSERT stalls all of them. These run on the
+event loop instead, with the same validation, caches, row building and
+``IngestError`` mapping (all shared with ingest.py). Only a cache miss awaits
+Postgres (asyncpg), and only an unbuffered insert awaits ClickHouse (asynch).
+With the writers on (the default) a warm batch does no I/O at all.
+
+Background work keeps its threads and sync clients: the table writers, the
+spool, trace sampling and ``last_seen_at`` flushes.
+"""
+
+from __future__ import annotations
+
+import time
+import uuid
+from typing import Iterable
+
+import asyncpg
+from starlette.concurrency import run_in_threadpool
+
+from . import ingest
+from .db import apg_conn, clickhouse, clickhouse_execute_async
+from .ingest import (
+    BATCH_TABLES,
+    TABLE_COLUMNS,
+    Templater,
+    cache_templaters,
+    check_batch,
+    endpoint_keys,
+    endpoint_sightings,
+    ensure_clickhouse_schema,
+    log_rows,
+    map_app_identifiers,
+    request_keys,
+    request_rows,
+    rollup_rows,
+    span_rows,
+    split_app_identifiers,
+    templates_column_missing,
+    touch_endpoints,
+    with_endpoint_ids,
+)
+from .metrics import INSERT_ERRORS, INSERT_ROWS, INSERT_SECONDS, STAGE_SECONDS
+from .timestamps import check_rows
+
+
+async def resolve_apps(project_id: str, identifiers: set[str]) -> dict[str, str]:
+    """Cached app resolution: {identifier: app uuid}."""
+    cached = ingest._app_cache.get_many((project_id, ident) for ident in identifiers)
+    mapping = {ident: app_uuid for (_, ident), app_uuid in cached.items()}
+    missing = identifiers - mapping.keys()
+    if not missing:
+        return mapping
+
+    uuids, slugs = split_app_identifiers(missing)
+    async with apg_conn() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT id, slug FROM apps
+            WHERE project_id = $1 AND is_active = true
+              AND (id = ANY($2::uuid[]) OR slug = ANY($3::text[]))
+            """,
+            project_id, list(uuids), list(slugs),
+        )
+    found = map_app_identifiers(((r["id"], r["slug"]) for r in rows), uuids, slugs)
+    ingest._app_cache.set_many({(project_id, ident): app_uuid for ident, app_uuid in found.items()})
+    mapping.update(found)
+    return mapping
+
+
+async def app_templaters(app_uuids: set[str]) -> dict[str, Templater]:
+    """Cached route templater per app, built from ``apps.path_templates``."""
+    if not ingest._path_templating:
+        return {app_uuid: ingest._identity for app_uuid in app_uuids}
+    templaters = ingest._templater_cache.get_many(app_uuids)
+    missing = app_uuids - templaters.keys()
+    if not missing:
+        return templaters
+
+    rows: list = []
+    if ingest._templates_column:
+        try:
+            async with apg_conn() as conn:
+                rows = await conn.fetch(
+                    "SELECT id, path_templates FROM apps WHERE id = ANY($1::uuid[])", list(missing)
+                )
+        except asyncpg.UndefinedColumnError:
+            templates_column_missing()
+    templaters.update(cache_templaters(missing, rows))
+    return templaters
+
+
+async def discover_endpoints(conn, last_seen: dict[tuple[str, str, str], object]) -> dict[tuple[str, str, str], str]:
+    """:func:`ingest.discover_endpoints` for asyncpg (arrays instead of VALUES)."""
+    if not last_seen:
+        return {}
+    keys = sorted(last_seen)
+    result = await conn.fetch(
+        """
+        WITH v AS (
+            SELECT * FROM unnest($1::uuid[], $2::uuid[], $3::text[], $4::text[], $5::timestamptz[])
+                AS t (id, app_id, path, method, last_seen_at)
+        ),
+        created AS (
+            INSERT INTO endpoints
+                (id, app_id, path, method, description, is_active, last_seen_at, created_at, updated_at)
+            SELECT id, app_id, path, method, '', true, last_seen_at, now(), now() FROM v
+            ON CONFLICT (app_id, path, method) DO NOTHING
+            RETURNING id, app_id, method, path
+        )
+        SELECT id, app_id, method, path FROM created
+        UNION ALL
+        SELECT e.id, e.app_id, e.method, e.path
+        FROM endpoints e JOIN v ON e.app_id = v.app_id AND e.path = v.path AND e.method = v.method
+        """,
+        [uuid.uuid4() for _ in keys],
+        [app_id for app_id, _, _ in keys],
+        [path for _, _, path in keys],
+        [method for _, method, _ in keys],
+        [last_seen[key] for key in keys],
+    )
+    endpoint_ids = {(str(r["app_id"]), r["method"], r["path"]): str(r["id"]) for r in result}
+
+    raced = [key for key in keys if key not in endpoint_ids]
+    if raced:
+        found = await conn.fetch(
+            """
+            SELECT e.id, e.app_id, e.method, e.path
+            FROM endpoints e JOIN unnest($1::uuid[], $2::text[], $3::text[]) AS v (app_id, method, path)
+              ON e.app_id = v.app_id AND e.method = v.method AND e.path = v.path
+            """,
+            [app_id for app_id, _, _ in raced],
+            [method for _, method, _ in raced],
+            [path for _, _, path in raced],
+        )
+        for r in found:
+            endpoint_ids[(str(r["app_id"]), r["method"], r["path"])] = str(r["id"])
+    return endpoint_ids
+
+
+async def resolve_endpoints(records: Iterable[tuple[str, str, str, object]]) -> dict[tuple[str, str, str], str]:
+    """Endpoint ids for every (app, method, route) in a batch, via the cache."""
+    last_seen = endpoint_sightings(records)
+    endpoint_ids = ingest._endpoint_cache.get_many(last_seen)
+    missing = {key: seen_at for key, seen_at in last_seen.items() if key not in endpoint_ids}
+    if missing:
+        async with apg_conn() as conn:
+            discovered = await discover_endpoints(conn, missing)
+        ingest._endpoint_cache.set_many(discovered)
+        endpoint_ids.update(discovered)
+    touch_endpoints(last_seen, endpoint_ids)
+    return endpoint_ids
+
+
+async def execute_insert(table: str, columns: list[str], rows: list[tuple]) -> None:
+    start = time.perf_counter()
+    try:
+        if not ingest._schema_ready:
+            await run_in_threadpool(ensure_clickhouse_schema, clickhouse())
+        await clickhouse_execute_async(f"INSERT INTO {table} ({', '.join(columns)}) VALUES", rows)
+    except Exception:
+        INSERT_ERRORS.inc(table)
+        raise
+    INSERT_SECONDS.observe(time.perf_counter() - start, table)
+    INSERT_ROWS.observe(len(rows), table)
+
+
+async def insert(table: str, rows: list[tuple]) -> None:
+    if not rows:
+        return
+    with STAGE_SECONDS.time("enqueue"):
+        if table in ingest._writers or ingest._spool is not None:
+            # A queue put, or a local spool append; both return at once.
+            ingest._enqueue(table, rows)
+        else:
+            await execute_insert(table, TABLE_COLUMNS[table], rows)
+
+
+async def insert_all(blocks: list[tuple[str, list[tuple]]]) -> None:
+    """:func:`insert` for blocks of several tables: all of them or none (see ``ingest._insert_all``)."""
+    blocks = [(table, rows) for table, rows in blocks if rows]
+    if not blocks:
+        return
+    with STAGE_SECONDS.time("enqueue"):
+        if ingest._writers or ingest._spool is not None:
+            ingest._enqueue_all(blocks)
+        else:
+            for table, rows in blocks:
+                await execute_insert(table, TABLE_COLUMNS[table], rows)
+
+
+async def handle_requests(project_id: str, project_slug: str, records, clock_offset: float = 0.0) -> int:
+    if not check_batch(project_slug, records):
+        return 0
+
+    with STAGE_SECONDS.time("resolve_apps"):
+        id_to_uuid = await resolve_apps(project_id, {r.app_id for r in records})
+    app_uuids = [id_to_uuid[r.app_id] for r in records]
+    keys = request_keys(records, app_uuids, await app_templaters(set(app_uuids)))
+    rows = check_rows("api_requests", request_rows(project_id, records, keys), clock_offset)
+    with STAGE_SECONDS.time("resolve_endpoints"):
+        rows = with_endpoint_ids(rows, await resolve_endpoints(endpoint_keys(rows)))
+    await insert("api_requests", rows)
+    return len(rows)
+
+
+async def handle_logs(project_id: str, project_slug: str, records, clock_offset: float = 0.0) -> int:
+    if not check_batch(project_slug, records):
+        return 0
+
+    with STAGE_SECONDS.time("resolve_apps"):
+        id_to_uuid = await resolve_apps(project_id, {r.app_id for r in records})
+    templaters = await app_templaters(set(id_to_uuid.values()))
+
+    rows = check_rows("api_logs", log_rows(project_id, records, id_to_uuid, templaters), clock_offset)
+    await insert("api_logs", rows)
+    return len(rows)
+
+
+async def handle_spans(project_id: str, project_slug: str, records, clock_offset: float = 0.0) -> int:
+    if not check_batch(project_slug, records):
+        return 0
+
+    with STAGE_SECONDS.time("resolve_apps"):
+        id_to_uuid = await resolve_apps(project_id, {r.app_id for r in records})
+
+    rows = check_rows("api_spans", span_rows(project_id, records, id_to_uuid), clock_offset)
+    if ingest._sampler is not None:
+        ingest._sampler.add(rows)
+    else:
+        await insert("api_spans", rows)
+    return len(rows)
+
+
+async def handle_rollups(project_id: str, project_slug: str, records, clock_offset: float = 0.0) -> int:
+    if not check_batch(project_slug, records):
+        return 0
+
+    with STAGE_SECONDS.time("resolve_apps"):
+        id_to_uuid = await resolve_apps(project_id, {r.app_id for r in records})
+    app_uuids = [id_to_uuid[r.app_id] for r in records]
+    keys = request_keys(records, app_uuids, await app_templaters(set(app_uuids)))
+    rows = check_rows("api_request_rollups", rollup_rows(project_id, records, keys), clock_offset)
+    with STAGE_SECONDS.time("resolve_endpoints"):
+        rows = with_endpoint_ids(rows, await resolve_endpoints(endpoint_keys(rows)))
+    await insert("api_request_rollups", rows)
+    return len(rows)
+
+
+async def handle_batch(project_id: str, project_slug: str, batch, clock_offset: float = 0.0) -> dict[str, int]:
+    signals = (batch.requests, batch.logs, batch.spans)
+    present = [check_batch(project_slug, records) for records in signals]
+    accepted = dict.fromkeys(BATCH_TABLES, 0)
+    if not any(present):
+        return accepted
+    requests, logs, spans = signals
+
+    with STAGE_SECONDS.time("resolve_apps"):
+        id_to_uuid = await resolve_apps(project_id, {r.app_id for records in signals for r in records})
+    app_uuids = [id_to_uuid[r.app_id] for r in requests]
+    templaters = await app_templaters(set(app_uuids) | {id_to_uuid[r.app_id] for r in logs})
+    keys = request_keys(requests, app_uuids, templaters)
+    request_block = check_rows("api_requests", request_rows(project_id, requests, keys), clock_offset)
+    with STAGE_SECONDS.time("resolve_endpoints"):
+        request_block = with_endpoint_ids(request_block, await resolve_endpoints(endpoint_keys(request_block)))
+    log_block = check_rows("api_logs", log_rows(project_id, logs, id_to_uuid, templaters), clock_offset)
+    span_block = check_rows("api_spans", span_rows(project_id, spans, id_to_uuid), clock_offset)
+    blocks = [("api_requests", request_block), ("api_logs", log_block)]
+    if ingest._sampler is not None:
+        await insert_all(blocks)
+        ingest._sampler.add(span_block)
+    else:
+        await insert_all(blocks + [("api_spans", span_block)])
+    accepted.update(api_requests=len(request_block), api_logs=len(log_block), api_spans=len(span_block))
+    return accepted
@@ -5,25 +5,68 @@ identity service (`POST {INTROSPECT_URL}` with a shared internal secret) and
 caches the result briefly. This keeps auth logic in one place (the IAM service)
 per the CNCF pattern; the short TTL cache bounds latency and tolerates brief
 identity blips for already-seen keys.
+
+The cache is a bounded LRU keyed by the key's SHA-256. Concurrent misses for
+one key share a single introspection call (single-flight). Once a valid key's
+TTL passes it is still served while one background refresh re-checks it
+(stale-while-revalidate), so request latency stays flat at the TTL boundary
+and the identity service sees about one call per key per TTL. Invalid keys
+are cached with a shorter TTL; identity failures are never cached as invalid.
 """
 
 from __future__ import annotations
 
 import hashlib
 import json
+import logging
+import random
 import threading
 import time
 import urllib.error
 import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import load_auth_cache, load_introspect
+
+logger = logging.getLogger("apilens.ingest.auth")
+
+AuthResult = tuple[str, str] | None
+MISS = object()  # cached(): not answerable without introspection
+
+_cfg = load_auth_cache()
+_WAIT_TIMEOUT = 10.0  # > the 5s introspection timeout
+
+
+class IntrospectUnavailable(Exception):
+    """The identity service could not answer (as opposed to 'key inactive')."""
+
+
+class _Entry:
+    __slots__ = ("value", "expires", "stale_until")
+
+    def __init__(self, value: AuthResult, expires: float, stale_until: float) -> None:
+        self.value = value
+        self.expires = expires
+        self.stale_until = stale_until
 
-from .config import load_introspect
 
-_TTL_SECONDS = 60.0
-_cache: dict[str, tuple[float, tuple[str, str] | None]] = {}
+class _Flight:
+    __slots__ = ("done", "result")
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: AuthResult = None
+
+
+_cache: OrderedDict[str, _Entry] = OrderedDict()
+_inflight: dict[str, _Flight] = {}
 _lock = threading.Lock()
+_refresher = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ingest-auth-refresh")
+_stats = {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0, "introspections": 0, "errors": 0}
 
 
-def _introspect(api_key: str) -> tuple[str, str] | None:
+def _introspect(api_key: str) -> AuthResult:
     cfg = load_introspect()
     body = json.dumps({"api_key": api_key}).encode()
     req = urllib.request.Request(
@@ -35,24 +78,112 @@ def _introspect(api_key: str) -> tuple[str, str] | None:
     try:
         with urllib.request.urlopen(req, timeout=5) as resp:
             data = json.loads(resp.read().decode())
-    except (urllib.error.URLError, TimeoutError, ValueError):
-        return None
+    except (urllib.error.URLError, TimeoutError, ValueError) as exc:
+        raise IntrospectUnavailable(str(exc)) from exc
     if not data.get("active"):
         return None
     return str(data["project_id"]), str(data["project_slug"])
 
 
+def _jittered(ttl: float) -> float:
+    return ttl * random.uniform(1.0 - _cfg.jitter, 1.0 + _cfg.jitter)
+
+
+def _store(cache_key: str, value: AuthResult) -> None:
+    now = time.monotonic()
+    if value is None:
+        entry = _Entry(None, now + _jittered(_cfg.negative_ttl), 0.0)
+    else:
+        expires = now + _jittered(_cfg.ttl)
+        entry = _Entry(value, expires, expires + _cfg.stale_ttl)
+    _cache[cache_key] = entry
+    _cache.move_to_end(cache_key)
+    while len(_cache) > _cfg.maxsize:
+        _cache.popitem(last=False)
+
+
+def _resolve(cache_key: str, api_key: str, flight: _Flight) -> AuthResult:
+    """Introspect for ``flight``'s leader, update the cache and wake waiters."""
+    result: AuthResult = None
+    try:
+        with _lock:
+            _stats["introspections"] += 1
+        result = _introspect(api_key)
+        with _lock:
+            _store(cache_key, result)
+    except Exception as exc:
+        # Keep serving a known-good key through identity blips until its
+        # stale window runs out (re-checking every negative_ttl, not on every
+        # request); never cache the failure as "invalid".
+        with _lock:
+            _stats["errors"] += 1
+            entry = _cache.get(cache_key)
+            now = time.monotonic()
+            if entry is not None and entry.value is not None and now < entry.stale_until:
+                entry.expires = min(now + _jittered(_cfg.negative_ttl), entry.stale_until)
+                result = entry.value
+        logger.warning("API key introspection failed: %s", exc)
+    finally:
+        flight.result = result
+        with _lock:
+            _inflight.pop(cache_key, None)
+        flight.done.set()
+    return result
+
+
+def _cached_locked(cache_key: str, api_key: str) -> AuthResult | object:
+    entry = _cache.get(cache_key)
+    if entry is None:
+        return MISS
+    _cache.move_to_end(cache_key)
+    now = time.monotonic()
+    if now < entry.expires:
+        _stats["hits"] += 1
+        return entry.value
+    if entry.value is not None and now < entry.stale_until:
+        _stats["stale_hits"] += 1
+        if cache_key not in _inflight:
+            flight = _inflight[cache_key] = _Flight()
+            _refresher.submit(_resolve, cache_key, api_key, flight)
+        return entry.value
+    return MISS
+
+
+def cached(api_key: str) -> AuthResult | object:
+    """:func:`authenticate` from the cache alone: the result, or ``MISS``.
+
+    Never blocks, so async callers can skip the threadpool on a hit.
+    """
+    if not api_key:
+        return None
+    cache_key = hashlib.sha256(api_key.encode()).hexdigest()
+    with _lock:
+        return _cached_locked(cache_key, api_key)
+
+
 def authenticate(api_key: str) -> tuple[str, str] | None:
     """Return (project_id, project_slug) for a valid key, else None (cached)."""
     if not api_key:
         return None
     cache_key = hashlib.sha256(api_key.encode()).hexdigest()
-    now = time.monotonic()
     with _lock:
-        entry = _cache.get(cache_key)
-        if entry and entry[0] > now:
-            return entry[1]
-    result = _introspect(api_key)
+        value = _cached_locked(cache_key, api_key)
+        if value is not MISS:
+            return value
+        flight = _inflight.get(cache_key)
+        leader = flight is None
+        if leader:
+            flight = _inflight[cache_key] = _Flight()
+            _stats["misses"] += 1
+        else:
+            _stats["coalesced"] += 1
+    if leader:
+        return _resolve(cache_key, api_key, flight)
+    if not flight.done.wait(_WAIT_TIMEOUT):
+        return None
+    return flight.result
+
+
+def auth_stats() -> dict[str, int]:
     with _lock:
-        _cache[cache_key] = (now + _TTL_SECONDS, result)
-    return result
+        return {**_stats, "entries": len(_cache), "inflight": len(_inflight)}
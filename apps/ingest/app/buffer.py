@@ -0,0 +1,386 @@
+"""Write-behind buffering between the HTTP handlers and ClickHouse.
+
+Handlers validate a batch, build its rows and hand them to the table's
+writer; a background thread coalesces rows from many SDK batches into one
+large INSERT once a row-count, byte or age threshold is reached. ClickHouse
+part creation then scales with flushes (one every few seconds per table)
+instead of with SDK uploads, and request latency no longer includes the
+ClickHouse round trip.
+
+Rows wait in one queue per project. Each INSERT block holds at most
+``flush_rows`` rows / ``flush_bytes`` bytes, and when more than that is
+pending the block is filled by deficit round robin over the projects: every
+turn a project may add ``fair_quantum_bytes`` (times its weight) worth of
+batches, so a tenant with a deep backlog gets its share of each block instead
+of all of it, and a small project's rows go out with the next flush.
+
+A failed INSERT puts the block back at the head of its projects' queues and
+retries with backoff. A project's queue is bounded by ``max_project_rows``;
+past it new batches are refused (the handler answers 503 so the SDK retries)
+or, with ``project_drop_policy = "drop_oldest"``, its oldest batches are
+dropped to make room. Independently, once the whole buffer reaches
+``max_pending_rows`` new batches are refused. :func:`put_all` enqueues the
+blocks of one ``/v1/batch`` upload into several writers under one check, so
+a refusal refuses every table of the upload.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable
+
+from .config import BufferConfig
+
+logger = logging.getLogger("apilens.ingest.buffer")
+
+_RETRY_BACKOFF_BASE = 0.5
+_RETRY_BACKOFF_MAX = 30.0
+
+# Row position of project_id in every table's columns.
+_PROJECT_ID = 2
+
+InsertFn = Callable[[str, list[str], list[tuple]], None]
+ShedFn = Callable[[str, str, int], None]  # (project_id, "rejected" | "dropped", rows)
+
+
+def estimate_bytes(rows: list[tuple]) -> int:
+    """Rough in-memory size of a block: string lengths plus 8 bytes per field."""
+    total = 0
+    for row in rows:
+        total += 8 * len(row)
+        for value in row:
+            if isinstance(value, str):
+                total += len(value)
+    return total
+
+
+class _Batch:
+    __slots__ = ("rows", "nbytes", "enqueued_at")
+
+    def __init__(self, rows: list[tuple], nbytes: int, enqueued_at: float) -> None:
+        self.rows = rows
+        self.nbytes = nbytes
+        self.enqueued_at = enqueued_at
+
+
+class _ProjectQueue:
+    __slots__ = ("batches", "rows", "nbytes", "deficit", "granted", "weight")
+
+    def __init__(self, weight: float) -> None:
+        self.batches: deque[_Batch] = deque()
+        self.rows = 0
+        self.nbytes = 0
+        self.deficit = 0.0
+        self.granted = False  # this turn's quantum was already added
+        self.weight = weight
+
+
+def put_all(blocks: list[tuple[TableWriter, list[tuple]]]) -> bool:
+    """Enqueue rows into one or more writers: into all of them, or into none
+    when any is full (caller should 503).
+
+    A ``/v1/batch`` upload spans three tables; refusing it part-way would
+    store some of its tables and then fail the request, and the SDK's retry
+    would store them again.
+    """
+    staged = []
+    for writer, rows in blocks:
+        if rows:
+            by_project: dict[str, list[tuple]] = {}
+            for row in rows:
+                by_project.setdefault(row[_PROJECT_ID], []).append(row)
+            staged.append((writer, by_project, []))
+    if not staged:
+        return True
+    # Writer locks are always taken in table order, so concurrent calls can't deadlock.
+    staged.sort(key=lambda item: item[0].table)
+    locked = []
+    try:
+        for writer, _, _ in staged:
+            writer._cond.acquire()
+            locked.append(writer)
+        accepted = all(writer._admits_locked(by_project) for writer, by_project, _ in staged)
+        for writer, by_project, shed in staged:
+            if accepted:
+                writer._put_locked(by_project, shed)
+            else:
+                writer._reject_locked(by_project, shed)
+    finally:
+        for writer in reversed(locked):
+            writer._cond.release()
+    for writer, _, shed in staged:
+        if writer._on_shed is not None:
+            for project_id, reason, n in shed:
+                writer._on_shed(project_id, reason, n)
+    return accepted
+
+
+class TableWriter:
+    """Per-table row buffer drained by one daemon writer thread."""
+
+    def __init__(
+        self,
+        table: str,
+        columns: list[str],
+        cfg: BufferConfig,
+        insert: InsertFn,
+        on_shed: ShedFn | None = None,
+    ) -> None:
+        self.table = table
+        self.columns = columns
+        self.cfg = cfg
+        self._insert = insert
+        self._on_shed = on_shed
+        self._cond = threading.Condition()
+        self._queues: dict[str, _ProjectQueue] = {}
+        self._active: deque[str] = deque()  # round-robin order of non-empty queues
+        self._rows = 0
+        self._bytes = 0
+        self._oldest = 0.0  # monotonic enqueue time of the oldest buffered row
+        self._inflight: list[tuple[str, _Batch]] = []
+        self._inflight_rows = 0
+        self._stopping = False
+        self._thread: threading.Thread | None = None
+
+        self.flushed_rows = 0
+        self.flushed_blocks = 0
+        self.failed_blocks = 0
+        self.rejected_rows = 0
+        self.dropped_rows = 0
+
+    # --- producer side ------------------------------------------------------
+
+    def put(self, rows: list[tuple]) -> bool:
+        """Enqueue rows; False when the buffer is full (caller should 503)."""
+        return put_all([(self, rows)])
+
+    def _admits_locked(self, by_project: dict[str, list[tuple]]) -> bool:
+        total = sum(len(rows) for rows in by_project.values())
+        if self._stopping or self._rows + self._inflight_rows + total > self.cfg.max_pending_rows:
+            return False
+        if self.cfg.project_drop_policy != "drop_oldest":
+            # All or nothing: one over-quota project refuses the whole batch.
+            limit = self.cfg.max_project_rows
+            if any(self._project_rows(p) + len(rows) > limit for p, rows in by_project.items()):
+                return False
+        return True
+
+    def _reject_locked(self, by_project: dict[str, list[tuple]], shed: list[tuple[str, str, int]]) -> None:
+        self.rejected_rows += sum(len(rows) for rows in by_project.values())
+        shed.extend((project_id, "rejected", len(rows)) for project_id, rows in by_project.items())
+
+    def _put_locked(self, by_project: dict[str, list[tuple]], shed: list[tuple[str, str, int]]) -> None:
+        limit = self.cfg.max_project_rows
+        now = time.monotonic()
+        if not self._rows:
+            self._oldest = now
+        dropped_any = False
+        for project_id, rows in by_project.items():
+            queue = self._queues.get(project_id)
+            if queue is None:
+                queue = self._queues[project_id] = _ProjectQueue(self.cfg.project_weights.get(project_id, 1.0))
+                self._active.append(project_id)
+            dropped = 0
+            while queue.batches and queue.rows + len(rows) > limit:
+                dropped += self._pop_oldest(queue)
+            if dropped:
+                dropped_any = True
+                self.dropped_rows += dropped
+                shed.append((project_id, "dropped", dropped))
+            nbytes = estimate_bytes(rows)
+            queue.batches.append(_Batch(rows, nbytes, now))
+            queue.rows += len(rows)
+            queue.nbytes += nbytes
+            self._rows += len(rows)
+            self._bytes += nbytes
+        if dropped_any:
+            self._oldest = self._oldest_enqueued()
+        if self._rows >= self.cfg.flush_rows or self._bytes >= self.cfg.flush_bytes:
+            self._cond.notify()
+
+    def _project_rows(self, project_id: str) -> int:
+        queue = self._queues.get(project_id)
+        return queue.rows if queue is not None else 0
+
+    def _pop_oldest(self, queue: _ProjectQueue) -> int:
+        batch = queue.batches.popleft()
+        queue.rows -= len(batch.rows)
+        queue.nbytes -= batch.nbytes
+        self._rows -= len(batch.rows)
+        self._bytes -= batch.nbytes
+        return len(batch.rows)
+
+    def _oldest_enqueued(self) -> float:
+        return min(q.batches[0].enqueued_at for q in self._queues.values() if q.batches)
+
+    # --- lifecycle ----------------------------------------------------------
+
+    def start(self) -> None:
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run, daemon=True, name=f"ingest-writer-{self.table}"
+            )
+            self._thread.start()
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """Stop accepting rows, flush what is buffered and join the thread."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            if self._thread.is_alive():
+                logger.error("Writer for %s did not drain within %.0fs", self.table, timeout)
+        with self._cond:
+            if self._rows:
+                logger.error("Dropping %d unflushed %s rows at shutdown", self._rows, self.table)
+                self.dropped_rows += self._rows
+                self._queues.clear()
+                self._active.clear()
+                self._rows = 0
+                self._bytes = 0
+
+    def stats(self) -> dict[str, float]:
+        with self._cond:
+            pending = self._rows
+            return {
+                "pending_rows": pending + self._inflight_rows,
+                "pending_bytes": self._bytes,
+                "oldest_age_seconds": round(time.monotonic() - self._oldest, 3) if pending else 0.0,
+                "projects": len(self._queues),
+                "flushed_rows": self.flushed_rows,
+                "flushed_blocks": self.flushed_blocks,
+                "failed_blocks": self.failed_blocks,
+                "rejected_rows": self.rejected_rows,
+                "dropped_rows": self.dropped_rows,
+            }
+
+    def project_stats(self) -> dict[str, dict[str, float]]:
+        """Buffered rows, bytes and oldest-row age per project with a queue."""
+        now = time.monotonic()
+        with self._cond:
+            return {
+                project_id: {
+                    "pending_rows": queue.rows,
+                    "pending_bytes": queue.nbytes,
+                    "oldest_age_seconds": round(now - queue.batches[0].enqueued_at, 3),
+                }
+                for project_id, queue in self._queues.items()
+                if queue.batches
+            }
+
+    # --- writer thread ------------------------------------------------------
+
+    def _due(self, now: float) -> bool:
+        if not self._rows:
+            return False
+        return (
+            self._stopping
+            or self._rows >= self.cfg.flush_rows
+            or self._bytes >= self.cfg.flush_bytes
+            or now - self._oldest >= self.cfg.flush_interval
+        )
+
+    def _next_block(self) -> list[tuple[str, _Batch]]:
+        """Dequeue up to one block of batches, deficit round robin over projects."""
+        cfg = self.cfg
+        block: list[tuple[str, _Batch]] = []
+        rows = nbytes = 0
+        active = self._active
+        while active and rows < cfg.flush_rows and nbytes < cfg.flush_bytes:
+            project_id = active[0]
+            queue = self._queues[project_id]
+            if not queue.granted:
+                queue.deficit += cfg.fair_quantum_bytes * queue.weight
+                queue.granted = True
+            while queue.batches and queue.batches[0].nbytes <= queue.deficit:
+                batch = queue.batches.popleft()
+                queue.deficit -= batch.nbytes
+                queue.rows -= len(batch.rows)
+                queue.nbytes -= batch.nbytes
+                block.append((project_id, batch))
+                rows += len(batch.rows)
+                nbytes += batch.nbytes
+                if rows >= cfg.flush_rows or nbytes >= cfg.flush_bytes:
+                    break
+            if queue.batches and queue.batches[0].nbytes <= queue.deficit:
+                # Block full mid-turn: the project keeps its turn and the
+                # rest of its deficit, and goes first in the next block.
+                break
+            queue.granted = False
+            active.popleft()
+            if queue.batches:
+                active.append(project_id)
+            else:
+                del self._queues[project_id]
+        self._rows -= rows
+        self._bytes -= nbytes
+        if self._rows:
+            self._oldest = self._oldest_enqueued()
+        return block
+
+    def _take(self) -> list[tuple] | None:
+        """Block until a flush is due; None once stopped and drained."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._due(now):
+                    block = self._next_block()
+                    self._inflight = block
+                    rows = [row for _, batch in block for row in batch.rows]
+                    self._inflight_rows = len(rows)
+                    return rows
+                if self._stopping:
+                    return None
+                timeout = None
+                if self._rows:
+                    timeout = max(self._oldest + self.cfg.flush_interval - now, 0.0)
+                self._cond.wait(timeout)
+
+    def _run(self) -> None:
+        failures = 0
+        while True:
+            rows = self._take()
+            if rows is None:
+                return
+            try:
+                self._insert(self.table, self.columns, rows)
+            except Exception as exc:
+                failures += 1
+                self._requeue(exc)
+                if self._stopping:
+                    return  # one attempt at shutdown; stop() accounts for leftovers
+                backoff = min(_RETRY_BACKOFF_BASE * (2 ** (failures - 1)), _RETRY_BACKOFF_MAX)
+                with self._cond:
+                    self._cond.wait_for(lambda: self._stopping, timeout=backoff)
+                continue
+            failures = 0
+            with self._cond:
+                self._inflight = []
+                self._inflight_rows = 0
+                self.flushed_rows += len(rows)
+                self.flushed_blocks += 1
+
+    def _requeue(self, exc: Exception) -> None:
+        with self._cond:
+            block, self._inflight = self._inflight, []
+            logger.warning("ClickHouse insert into %s failed (%d rows): %s", self.table, self._inflight_rows, exc)
+            self._inflight_rows = 0
+            self.failed_blocks += 1
+            for project_id, batch in reversed(block):
+                queue = self._queues.get(project_id)
+                if queue is None:
+                    queue = self._queues[project_id] = _ProjectQueue(self.cfg.project_weights.get(project_id, 1.0))
+                    self._active.appendleft(project_id)
+                queue.batches.appendleft(batch)
+                queue.rows += len(batch.rows)
+                queue.nbytes += batch.nbytes
+                self._rows += len(batch.rows)
+                self._bytes += batch.nbytes
+            self._oldest = self._oldest_enqueued()
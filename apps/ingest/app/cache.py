@@ -0,0 +1,83 @@
+"""Small in-process caches for the ingest hot path.
+
+Every SDK batch resolves the same handful of apps and the same few hundred
+endpoints; keeping those lookups in memory means a warm worker does not touch
+Postgres at all for a typical batch.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe LRU map whose entries expire ``ttl`` seconds after being set.
+
+    ``maxsize`` bounds memory: inserting past it evicts the least recently
+    used entry. Expired entries are dropped lazily on access.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _get_locked(self, key: Hashable, now: float) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return _MISSING
+        if entry[0] <= now:
+            del self._data[key]
+            self.misses += 1
+            return _MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            value = self._get_locked(key, time.monotonic())
+        return default if value is _MISSING else value
+
+    def get_many(self, keys: Iterable[Hashable]) -> dict:
+        """Return the cached subset of ``keys`` (one lock acquisition)."""
+        found: dict = {}
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                value = self._get_locked(key, now)
+                if value is not _MISSING:
+                    found[key] = value
+        return found
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        self.set_many({key: value}, ttl=ttl)
+
+    def set_many(self, items: dict, ttl: float | None = None) -> None:
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            for key, value in items.items():
+                self._data[key] = (expires, value)
+                self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
@@ -102,4 +102,334 @@ def load_introspect() -> IntrospectConfig:
     )
 
 
+@dataclass(frozen=True)
+class AuthCacheConfig:
+    ttl: float
+    negative_ttl: float
+    stale_ttl: float
+    maxsize: int
+    jitter: float
+
+
+def load_auth_cache() -> AuthCacheConfig:
+    # A revoked key keeps working for up to ttl (plus one refresh). After ttl a
+    # known-good key is served stale for up to stale_ttl more while it is
+    # re-checked in the background, which also rides out identity outages.
+    # TTLs are spread by +/- jitter (a fraction) so keys don't expire in step.
+    return AuthCacheConfig(
+        ttl=float(_first("APILENS_INGEST_AUTH_TTL", default="60")),
+        negative_ttl=float(_first("APILENS_INGEST_AUTH_NEGATIVE_TTL", default="10")),
+        stale_ttl=float(_first("APILENS_INGEST_AUTH_STALE_TTL", default="300")),
+        maxsize=int(_first("APILENS_INGEST_AUTH_CACHE_SIZE", default="10000")),
+        jitter=float(_first("APILENS_INGEST_AUTH_TTL_JITTER", default="0.1")),
+    )
+
+
+@dataclass(frozen=True)
+class RateLimitConfig:
+    records_per_sec: float
+    records_burst: float
+    bytes_per_sec: float
+    bytes_burst: float
+    redis_url: str
+    max_projects: int
+
+    @property
+    def enabled(self) -> bool:
+        return self.records_per_sec > 0 or self.bytes_per_sec > 0
+
+
+def load_rate_limit() -> RateLimitConfig:
+    # Per-project token buckets; a rate of 0 turns that dimension off (the
+    # default). Bursts default to 10s worth of the rate. With a Redis URL the
+    # buckets are shared by every replica instead of per worker process.
+    records = float(_first("APILENS_INGEST_RATE_RECORDS_PER_SEC", default="0"))
+    nbytes = float(_first("APILENS_INGEST_RATE_BYTES_PER_SEC", default="0"))
+    return RateLimitConfig(
+        records_per_sec=records,
+        records_burst=float(_first("APILENS_INGEST_RATE_RECORDS_BURST", default=str(records * 10))),
+        bytes_per_sec=nbytes,
+        bytes_burst=float(_first("APILENS_INGEST_RATE_BYTES_BURST", default=str(nbytes * 10))),
+        redis_url=_first("APILENS_INGEST_RATE_REDIS_URL"),
+        max_projects=int(_first("APILENS_INGEST_RATE_MAX_PROJECTS", default="50000")),
+    )
+
+
+@dataclass(frozen=True)
+class IdempotencyConfig:
+    enabled: bool
+    maxsize: int
+    ttl: float
+    wait: float
+    redis_url: str
+
+
+def load_idempotency() -> IdempotencyConfig:
+    # Recent Idempotency-Key results per worker. SDK retries come within
+    # seconds, so a short TTL covers them; with a Redis URL the index is
+    # shared by every replica (retries often land on another worker).
+    return IdempotencyConfig(
+        enabled=_flag("APILENS_INGEST_IDEMPOTENCY", True),
+        maxsize=int(_first("APILENS_INGEST_IDEMPOTENCY_MAXSIZE", default="100000")),
+        ttl=float(_first("APILENS_INGEST_IDEMPOTENCY_TTL", default="900")),
+        wait=float(_first("APILENS_INGEST_IDEMPOTENCY_WAIT", default="10")),
+        redis_url=_first("APILENS_INGEST_IDEMPOTENCY_REDIS_URL", "APILENS_INGEST_RATE_REDIS_URL"),
+    )
+
+
+@dataclass(frozen=True)
+class TimestampConfig:
+    policy: str
+    max_past: float
+    max_future: float
+    stamp_received: bool
+    skew_tolerance: float
+
+
+TIMESTAMP_POLICIES = ("off", "clamp", "reject", "restamp")
+
+
+def load_timestamps() -> TimestampConfig:
+    # Records stamped outside [now - max_past, now + max_future] are clamped
+    # to the window edge, dropped or re-stamped with the receive time. The
+    # default window matches the 30-day table TTL. stamp_received shifts a
+    # batch by the SDK's clock offset (its APILens-Sent-At header) when that
+    # offset exceeds skew_tolerance seconds.
+    policy = _first("APILENS_INGEST_TIMESTAMP_POLICY", default="clamp").strip().lower()
+    if policy not in TIMESTAMP_POLICIES:
+        policy = "clamp"
+    return TimestampConfig(
+        policy=policy,
+        max_past=float(_first("APILENS_INGEST_TIMESTAMP_MAX_PAST", default=str(30 * 86400))),
+        max_future=float(_first("APILENS_INGEST_TIMESTAMP_MAX_FUTURE", default="3600")),
+        stamp_received=_flag("APILENS_INGEST_STAMP_RECEIVED", False),
+        skew_tolerance=float(_first("APILENS_INGEST_CLOCK_SKEW_TOLERANCE", default="2.0")),
+    )
+
+
+@dataclass(frozen=True)
+class AsyncConfig:
+    enabled: bool
+    pg_min: int
+    pg_max: int
+    ch_max: int
+
+
+def load_async() -> AsyncConfig:
+    # Async request path (asyncpg + asynch, the "async" extra). Off by default:
+    # handlers then run in Starlette's threadpool as before.
+    return AsyncConfig(
+        enabled=_flag("APILENS_INGEST_ASYNC", False),
+        pg_min=int(_first("APILENS_INGEST_ASYNC_PG_MIN", default="1")),
+        pg_max=int(_first("APILENS_INGEST_ASYNC_PG_MAX", default="20")),
+        ch_max=int(_first("APILENS_INGEST_ASYNC_CH_MAX", default="10")),
+    )
+
+
+def _flag(name: str, default: bool) -> bool:
+    return _first(name, default="true" if default else "false").lower() in ("true", "1", "yes", "on")
+
+
+@dataclass(frozen=True)
+class BufferConfig:
+    enabled: bool
+    flush_rows: int
+    flush_bytes: int
+    flush_interval: float
+    max_pending_rows: int
+    max_project_rows: int
+    project_drop_policy: str
+    fair_quantum_bytes: int
+    project_weights: dict[str, float]
+
+
+PROJECT_DROP_POLICIES = ("reject", "drop_oldest")
+
+
+def _project_weights(raw: str) -> dict[str, float]:
+    # "project_id=2,other_id=0.5"; unlisted projects weigh 1.
+    weights: dict[str, float] = {}
+    for item in raw.split(","):
+        project_id, sep, weight = item.partition("=")
+        if not sep or not project_id.strip():
+            continue
+        try:
+            value = float(weight)
+        except ValueError:
+            continue
+        if value > 0:
+            weights[project_id.strip()] = value
+    return weights
+
+
+def load_buffer() -> BufferConfig:
+    # Write-behind thresholds: a table's buffer is flushed as one INSERT when
+    # any of rows / bytes / age is reached. max_pending_rows bounds memory;
+    # beyond it the handlers answer 503 so SDKs back off and retry. Rows are
+    # queued per project; max_project_rows bounds each queue (the policy says
+    # whether a full queue refuses new batches or drops its oldest), and
+    # blocks are shared between projects fair_quantum_bytes at a time.
+    policy = _first("APILENS_INGEST_PROJECT_DROP_POLICY", default="reject").strip().lower()
+    if policy not in PROJECT_DROP_POLICIES:
+        policy = "reject"
+    return BufferConfig(
+        enabled=_flag("APILENS_INGEST_BUFFER", True),
+        flush_rows=int(_first("APILENS_INGEST_FLUSH_ROWS", default="50000")),
+        flush_bytes=int(_first("APILENS_INGEST_FLUSH_BYTES", default=str(32 * 1024 * 1024))),
+        flush_interval=float(_first("APILENS_INGEST_FLUSH_INTERVAL", default="2.0")),
+        max_pending_rows=int(_first("APILENS_INGEST_MAX_PENDING_ROWS", default="500000")),
+        max_project_rows=int(_first("APILENS_INGEST_MAX_PROJECT_ROWS", default="100000")),
+        project_drop_policy=policy,
+        fair_quantum_bytes=max(int(_first("APILENS_INGEST_FAIR_QUANTUM_BYTES", default=str(1024 * 1024))), 1),
+        project_weights=_project_weights(_first("APILENS_INGEST_PROJECT_WEIGHTS", default="")),
+    )
+
+
+@dataclass(frozen=True)
+class CacheConfig:
+    app_ttl: float
+    app_maxsize: int
+    endpoint_ttl: float
+    endpoint_maxsize: int
+    last_seen_interval: float
+
+
+def load_cache() -> CacheConfig:
+    # An app deactivated in the dashboard keeps ingesting for up to app_ttl.
+    # endpoints.last_seen_at is written in bulk every last_seen_interval.
+    return CacheConfig(
+        app_ttl=float(_first("APILENS_INGEST_APP_CACHE_TTL", default="300")),
+        app_maxsize=int(_first("APILENS_INGEST_APP_CACHE_SIZE", default="10000")),
+        endpoint_ttl=float(_first("APILENS_INGEST_ENDPOINT_CACHE_TTL", default="600")),
+        endpoint_maxsize=int(_first("APILENS_INGEST_ENDPOINT_CACHE_SIZE", default="100000")),
+        last_seen_interval=float(_first("APILENS_INGEST_LAST_SEEN_INTERVAL", default="30")),
+    )
+
+
+@dataclass(frozen=True)
+class SpoolConfig:
+    directory: str
+    max_bytes: int
+    segment_bytes: int
+    fsync: str  # always | interval | never
+    fsync_interval: float
+    replay_rows_per_sec: float
+    # Failed replays of one block before it is moved to a .dead file.
+    max_attempts: int
+    breaker_threshold: int
+    breaker_cooldown: float
+
+
+def load_spool() -> SpoolConfig | None:
+    # Disabled unless a directory is configured; it should be a persistent
+    # volume so a restarted worker can replay what its predecessor spooled.
+    directory = _first("APILENS_INGEST_SPOOL_DIR")
+    if not directory:
+        return None
+    fsync = _first("APILENS_INGEST_SPOOL_FSYNC", default="interval").lower()
+    if fsync not in ("always", "interval", "never"):
+        raise ValueError(f"APILENS_INGEST_SPOOL_FSYNC must be always|interval|never, got {fsync!r}")
+    return SpoolConfig(
+        directory=directory,
+        max_bytes=int(_first("APILENS_INGEST_SPOOL_MAX_BYTES", default=str(2 * 1024**3))),
+        segment_bytes=int(_first("APILENS_INGEST_SPOOL_SEGMENT_BYTES", default=str(64 * 1024**2))),
+        fsync=fsync,
+        fsync_interval=float(_first("APILENS_INGEST_SPOOL_FSYNC_INTERVAL", default="1.0")),
+        replay_rows_per_sec=float(_first("APILENS_INGEST_SPOOL_REPLAY_ROWS_PER_SEC", default="50000")),
+        max_attempts=max(1, int(_first("APILENS_INGEST_SPOOL_MAX_ATTEMPTS", default="10"))),
+        breaker_threshold=int(_first("APILENS_INGEST_BREAKER_THRESHOLD", default="3")),
+        breaker_cooldown=float(_first("APILENS_INGEST_BREAKER_COOLDOWN", default="10")),
+    )
+
+
+@dataclass(frozen=True)
+class TraceSamplingConfig:
+    decision_wait: float
+    keep_percent: float
+    slow_root_ms: float
+    rare_threshold: int
+    rare_window: float
+    max_spans: int
+
+
+def load_trace_sampling() -> TraceSamplingConfig | None:
+    # Off by default: every span is stored, as before.
+    if not _flag("APILENS_INGEST_TRACE_SAMPLING", False):
+        return None
+    return TraceSamplingConfig(
+        decision_wait=float(_first("APILENS_INGEST_TRACE_DECISION_WAIT", default="10")),
+        keep_percent=min(max(float(_first("APILENS_INGEST_TRACE_KEEP_PERCENT", default="10")), 0.0), 100.0),
+        slow_root_ms=float(_first("APILENS_INGEST_TRACE_SLOW_ROOT_MS", default="1000")),
+        rare_threshold=int(_first("APILENS_INGEST_TRACE_RARE_THRESHOLD", default="5")),
+        rare_window=float(_first("APILENS_INGEST_TRACE_RARE_WINDOW", default="3600")),
+        max_spans=int(_first("APILENS_INGEST_TRACE_MAX_SPANS", default="200000")),
+    )
+
+
+@dataclass(frozen=True)
+class BodyLimits:
+    max_decompressed_bytes: int
+    # NDJSON bodies are streamed, so they get their own (much larger) cap.
+    max_stream_bytes: int
+    ndjson_max_line_bytes: int
+    ndjson_chunk_records: int
+    ndjson_chunk_bytes: int
+
+
+def load_body_limits() -> BodyLimits:
+    return BodyLimits(
+        max_decompressed_bytes=int(_first("APILENS_INGEST_MAX_DECOMPRESSED_BYTES", default=str(64 * 1024**2))),
+        max_stream_bytes=int(_first("APILENS_INGEST_MAX_STREAM_BYTES", default=str(1024**3))),
+        ndjson_max_line_bytes=int(_first("APILENS_INGEST_NDJSON_MAX_LINE_BYTES", default=str(1024**2))),
+        ndjson_chunk_records=min(
+            int(_first("APILENS_INGEST_NDJSON_CHUNK_RECORDS", default="500")), MAX_BATCH_SIZE
+        ),
+        ndjson_chunk_bytes=int(_first("APILENS_INGEST_NDJSON_CHUNK_BYTES", default=str(8 * 1024**2))),
+    )
+
+
+DECODERS = ("pydantic", "msgspec")
+
+
+def load_decoder() -> str:
+    """Wire decoder for ingest bodies (see decoding.py)."""
+    name = _first("APILENS_INGEST_DECODER", default="pydantic").lower()
+    if name not in DECODERS:
+        raise ValueError(f"APILENS_INGEST_DECODER must be one of {'|'.join(DECODERS)}, got {name!r}")
+    return name
+
+
+INSERT_FORMATS = ("rows", "columnar", "numpy")
+
+
+def load_insert_format() -> str:
+    """How ClickHouse INSERT blocks are sent (see columnar.py)."""
+    name = _first("APILENS_INGEST_INSERT_FORMAT", default="columnar").lower()
+    if name not in INSERT_FORMATS:
+        raise ValueError(f"APILENS_INGEST_INSERT_FORMAT must be one of {'|'.join(INSERT_FORMATS)}, got {name!r}")
+    return name
+
+
+def load_path_templating() -> bool:
+    """Rewrite request paths to route templates before storing (see routes.py)."""
+    return _flag("APILENS_INGEST_PATH_TEMPLATING", True)
+
+
+@dataclass(frozen=True)
+class MetricsConfig:
+    enabled: bool
+    # Projects get their own label up to this many; the rest report as "other".
+    max_projects: int
+    # If set, /v1/metrics requires "Authorization: Bearer <token>".
+    token: str
+
+
+def load_metrics() -> MetricsConfig:
+    return MetricsConfig(
+        enabled=_flag("APILENS_INGEST_METRICS", True),
+        max_projects=int(_first("APILENS_INGEST_METRICS_MAX_PROJECTS", default="1000")),
+        token=_first("APILENS_INGEST_METRICS_TOKEN"),
+    )
+
+
 MAX_BATCH_SIZE = 1000
@@ -1,23 +1,32 @@
 """Database connections: a Postgres pool + a per-thread ClickHouse client.
 
 Mirrors how apps/api connects (psycopg to Postgres, clickhouse_driver native to
-ClickHouse) so the ingest service reads/writes the exact same stores.
+ClickHouse) so the ingest service reads/writes the exact same stores. With
+``APILENS_INGEST_ASYNC`` the request path uses the asyncio pools at the end of
+this module instead (asyncpg, and asynch for the native ClickHouse protocol);
+background threads keep the sync ones.
 """
 
 from __future__ import annotations
 
+import asyncio
 import contextlib
 import threading
+import weakref
 
 import psycopg2
 from psycopg2.pool import ThreadedConnectionPool
 from clickhouse_driver import Client
 
-from .config import load_clickhouse, load_postgres
+from .config import AsyncConfig, load_clickhouse, load_insert_format, load_postgres
 
 _pg_pool: ThreadedConnectionPool | None = None
 _pg_lock = threading.Lock()
 _ch_local = threading.local()
+_ch_clients: weakref.WeakSet[Client] = weakref.WeakSet()
+_apg_pool = None  # asyncpg.Pool
+_ach_pool = None  # asynch.Pool
+_ach_slots: asyncio.Semaphore | None = None
 
 
 def init_postgres_pool(minconn: int = 1, maxconn: int = 10) -> None:
@@ -65,7 +74,89 @@ def clickhouse() -> Client:
             password=c.password,
             secure=c.secure,
             verify=c.verify,
-            settings={"use_numpy": False},
+            # NumPy mode only matters for (columnar) inserts; see columnar.py.
+            settings={"use_numpy": load_insert_format() == "numpy"},
         )
         _ch_local.client = client
+        _ch_clients.add(client)
     return client
+
+
+async def init_async_pools(cfg: AsyncConfig) -> None:
+    global _apg_pool, _ach_pool, _ach_slots
+    import asyncpg
+    from asynch import Pool
+
+    if _apg_pool is None:
+        c = load_postgres()
+        _apg_pool = await asyncpg.create_pool(
+            host=c.host,
+            port=c.port,
+            database=c.dbname,
+            user=c.user,
+            password=c.password,
+            min_size=cfg.pg_min,
+            max_size=cfg.pg_max,
+        )
+    if _ach_pool is None:
+        c = load_clickhouse()
+        _ach_pool = await Pool(
+            minsize=1,
+            maxsize=cfg.ch_max,
+            host=c.host,
+            port=c.port,
+            database=c.database,
+            user=c.user,
+            password=c.password,
+            secure=c.secure,
+            verify=c.verify,
+        ).startup()
+        # asynch raises instead of waiting when every connection is taken.
+        _ach_slots = asyncio.Semaphore(cfg.ch_max)
+
+
+async def close_async_pools() -> None:
+    global _apg_pool, _ach_pool
+    if _apg_pool is not None:
+        await _apg_pool.close()
+        _apg_pool = None
+    if _ach_pool is not None:
+        await _ach_pool.shutdown()
+        _ach_pool = None
+
+
+@contextlib.asynccontextmanager
+async def apg_conn():
+    """An asyncpg connection in a transaction (committed unless the block raises)."""
+    assert _apg_pool is not None, "init_async_pools() was not awaited"
+    async with _apg_pool.acquire() as conn:
+        async with conn.transaction():
+            yield conn
+
+
+async def clickhouse_execute_async(query: str, params=None) -> None:
+    assert _ach_pool is not None and _ach_slots is not None, "init_async_pools() was not awaited"
+    async with _ach_slots:
+        async with _ach_pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(query, params)
+
+
+def pool_stats() -> dict[str, dict[str, int]]:
+    """Connection counts: the Postgres pools and the ClickHouse clients."""
+    stats: dict[str, dict[str, int]] = {}
+    pool = _pg_pool
+    if pool is not None:
+        # ThreadedConnectionPool keeps checked-out connections in _used and
+        # idle ones in _pool; reading their sizes needs no lock.
+        stats["postgres"] = {"in_use": len(pool._used), "idle": len(pool._pool), "max": pool.maxconn}
+    apool = _apg_pool
+    if apool is not None:
+        idle = apool.get_idle_size()
+        stats["postgres_async"] = {"in_use": apool.get_size() - idle, "idle": idle, "max": apool.get_max_size()}
+    clients = list(_ch_clients)
+    stats["clickhouse"] = {
+        "clients": len(clients),
+        "connected": sum(1 for c in clients if c.connection.connected),
+    }
+    return stats
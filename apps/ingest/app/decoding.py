@@ -0,0 +1,112 @@
+"""Decoding of ingest bodies into wire records, selectable per deployment.
+
+``APILENS_INGEST_DECODER=pydantic`` (default) validates with the models in
+schemas.py; ``msgspec`` decodes straight from bytes into the structs in
+fastschemas.py, skipping the intermediate dicts and pydantic model
+construction that dominate CPU on large request batches. Both accept the same
+payloads and the ``handle_*`` entrypoints read either by attribute, so the
+switch is invisible to clients. ``benchmarks/decode_bench.py`` compares them.
+
+Endpoints take their body through :func:`json_body` rather than a pydantic
+parameter, so validation errors are re-shaped into FastAPI's usual 422 body
+and the request schemas are added to OpenAPI by :func:`openapi_schemas`.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Any, Callable
+
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
+from pydantic.json_schema import models_json_schema
+
+from .config import load_decoder
+from .metrics import STAGE_SECONDS
+
+_REF_TEMPLATE = "#/components/schemas/{model}"
+_MSGSPEC_PATH = re.compile(r" - at `\$(.*)`$")
+_PATH_PART = re.compile(r"\.([^.\[]+)|\[(\d+)\]")
+
+
+class DecodeError(Exception):
+    """Invalid body; ``errors`` are pydantic-style error dicts."""
+
+    def __init__(self, errors: list[dict]) -> None:
+        super().__init__(errors[0]["msg"] if errors else "invalid body")
+        self.errors = errors
+
+
+def _pydantic_decoder() -> Callable[[type[BaseModel], bytes], Any]:
+    def decode(model: type[BaseModel], data: bytes) -> Any:
+        try:
+            return model.model_validate_json(data)
+        except ValidationError as exc:
+            raise DecodeError(exc.errors(include_url=False)) from exc
+
+    return decode
+
+
+def _msgspec_error(message: str) -> dict:
+    loc: tuple = ()
+    match = _MSGSPEC_PATH.search(message)
+    if match:
+        message = message[: match.start()]
+        loc = tuple(key if key else int(index) for key, index in _PATH_PART.findall(match.group(1)))
+    return {"type": "value_error", "loc": loc, "msg": message}
+
+
+def _msgspec_decoder() -> Callable[[type[BaseModel], bytes], Any]:
+    import msgspec
+
+    from .fastschemas import MIRRORS
+
+    decoders = {model: msgspec.json.Decoder(struct, strict=False) for model, struct in MIRRORS.items()}
+
+    def decode(model: type[BaseModel], data: bytes) -> Any:
+        try:
+            return decoders[model].decode(data)
+        except msgspec.ValidationError as exc:
+            raise DecodeError([_msgspec_error(str(exc))]) from exc
+        except msgspec.DecodeError as exc:
+            raise DecodeError([{"type": "json_invalid", "loc": (), "msg": f"JSON decode error: {exc}"}]) from exc
+
+    return decode
+
+
+_BUILDERS = {"pydantic": _pydantic_decoder, "msgspec": _msgspec_decoder}
+
+# decode(model, data): ``data`` as ``model`` (or its msgspec mirror); raises
+# DecodeError. Chosen once at import so a missing msgspec fails at startup.
+decode: Callable[[type[BaseModel], bytes], Any] = _BUILDERS[load_decoder()]()
+
+
+def json_body(model: type[BaseModel]) -> Callable:
+    """Dependency yielding the request body decoded as ``model``."""
+
+    async def dependency(request: Request) -> Any:
+        body = await request.body()
+        try:
+            with STAGE_SECONDS.time("decode"):
+                return decode(model, body)
+        except DecodeError as exc:
+            raise RequestValidationError(
+                [{**err, "loc": ("body", *err["loc"])} for err in exc.errors], body=body
+            ) from exc
+
+    return dependency
+
+
+def openapi_body(batch_model: type[BaseModel], record_model: type[BaseModel] | None = None) -> dict:
+    """``openapi_extra`` describing the JSON batch and NDJSON record bodies."""
+    content = {"application/json": {"schema": {"$ref": _REF_TEMPLATE.format(model=batch_model.__name__)}}}
+    if record_model is not None:
+        content["application/x-ndjson"] = {"schema": {"$ref": _REF_TEMPLATE.format(model=record_model.__name__)}}
+    return {"requestBody": {"required": True, "content": content}}
+
+
+def openapi_schemas(models: list[type[BaseModel]]) -> dict:
+    """Component schemas for body models FastAPI doesn't see as parameters."""
+    _, top = models_json_schema([(m, "validation") for m in models], ref_template=_REF_TEMPLATE)
+    return top.get("$defs", {})
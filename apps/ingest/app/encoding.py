@@ -0,0 +1,213 @@
+"""Content-Encoding support for ingest request bodies (gzip / deflate / zstd).
+
+SDK batches are mostly JSON payload and header strings and compress 5-10x, so
+the SDKs may send them with ``Content-Encoding: gzip`` or ``zstd``. Bodies are
+decompressed incrementally as they are read, in bounded pieces, and reading
+aborts with 413 once the decompressed size passes
+``APILENS_INGEST_MAX_DECOMPRESSED_BYTES``, so a small compressed upload can't
+expand into an arbitrarily large one.
+
+Wired in through :class:`IngestRoute` (the FastAPI custom-route pattern), so
+the endpoints themselves see a plain JSON body. The route class also picks
+between the JSON endpoint and its streaming NDJSON twin (:class:`NdjsonRoute`)
+by Content-Type.
+"""
+
+from __future__ import annotations
+
+import time
+import zlib
+from typing import Callable, Iterator
+
+from fastapi import Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+from starlette.routing import Match
+from starlette.types import Scope
+
+from .config import load_body_limits
+from .ingest import IngestError
+from .metrics import ERRORS, REQUEST_SECONDS, STAGE_SECONDS
+from .ndjson import is_ndjson
+
+_CHUNK = 64 * 1024
+_ZSTD_SLICE = 256
+
+
+class _ZlibDecoder:
+    def __init__(self, wbits: int) -> None:
+        self._obj = zlib.decompressobj(wbits)
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        while data:
+            out = self._obj.decompress(data, _CHUNK)
+            if out:
+                yield out
+            data = self._obj.unconsumed_tail
+
+    def finish(self) -> Iterator[bytes]:
+        out = self._obj.flush()
+        if out:
+            yield out
+        if not self._obj.eof:
+            raise zlib.error("truncated compressed body")
+
+
+class _ZstdDecoder:
+    # zstandard's decompressobj has no output bound per call, and zstd expands
+    # up to ~32000x, so input goes in _ZSTD_SLICE pieces: one call then yields
+    # at most ~8 MiB before the caller counts it against the limit.
+    def __init__(self) -> None:
+        import zstandard
+
+        self._zstd = zstandard
+        self._dctx = zstandard.ZstdDecompressor()
+        self._obj = self._dctx.decompressobj()
+        self._in_frame = False
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        view = memoryview(data)
+        for start in range(0, len(view), _ZSTD_SLICE):
+            piece = view[start:start + _ZSTD_SLICE].tobytes()
+            while piece:
+                self._in_frame = True
+                out = self._obj.decompress(piece)
+                if out:
+                    yield out
+                piece = b""
+                if self._obj.eof:
+                    # Concatenated frames: the rest starts the next one.
+                    piece = self._obj.unused_data
+                    self._obj = self._dctx.decompressobj()
+                    self._in_frame = False
+
+    def finish(self) -> Iterator[bytes]:
+        if self._in_frame:
+            raise self._zstd.ZstdError("truncated compressed body")
+        return iter(())
+
+
+_DECODERS: dict[str, Callable[[], object]] = {
+    "gzip": lambda: _ZlibDecoder(zlib.MAX_WBITS | 16),
+    "x-gzip": lambda: _ZlibDecoder(zlib.MAX_WBITS | 16),
+    "deflate": lambda: _ZlibDecoder(zlib.MAX_WBITS),
+    "zstd": _ZstdDecoder,
+}
+
+
+def decoder_for(content_encoding: str):
+    """A fresh decoder for the header value, or None for an identity body."""
+    encoding = (content_encoding or "").strip().lower()
+    if encoding in ("", "identity"):
+        return None
+    factory = _DECODERS.get(encoding)
+    if factory is None:
+        raise IngestError(415, "unsupported_media_type", f"Unsupported Content-Encoding: {content_encoding}")
+    try:
+        return factory()
+    except ImportError as exc:
+        raise IngestError(415, "unsupported_media_type", f"Content-Encoding {encoding} is not enabled") from exc
+
+
+class DecompressingRequest(Request):
+    """Request whose body stream is transparently decompressed and capped."""
+
+    async def stream(self):
+        if hasattr(self, "_body"):
+            yield self._body
+            yield b""
+            return
+        decoder = decoder_for(self.headers.get("content-encoding", ""))
+        if decoder is None:
+            async for chunk in super().stream():
+                yield chunk
+            return
+
+        limits = load_body_limits()
+        if is_ndjson(self.headers.get("content-type", "")):
+            limit = limits.max_stream_bytes
+        else:
+            limit = limits.max_decompressed_bytes
+        total = 0
+        received = 0
+        try:
+            async for chunk in super().stream():
+                received += len(chunk)
+                if received > limit:
+                    raise IngestError(413, "payload_too_large", f"Compressed body exceeds {limit} bytes")
+                for out in decoder.feed(chunk):
+                    total += len(out)
+                    if total > limit:
+                        raise IngestError(413, "payload_too_large", f"Decompressed body exceeds {limit} bytes")
+                    yield out
+            for out in decoder.finish():
+                total += len(out)
+                if total > limit:
+                    raise IngestError(413, "payload_too_large", f"Decompressed body exceeds {limit} bytes")
+                yield out
+        except IngestError:
+            raise
+        except Exception as exc:  # zlib.error / zstandard.ZstdError
+            raise IngestError(400, "invalid_encoding", "Request body could not be decompressed") from exc
+        yield b""
+
+
+def _content_type(scope: Scope) -> str:
+    for name, value in scope.get("headers", ()):
+        if name == b"content-type":
+            return value.decode("latin-1")
+    return ""
+
+
+class IngestRoute(APIRoute):
+    # True for routes that take their body as an NDJSON stream.
+    streaming = False
+
+    def matches(self, scope: Scope) -> tuple[Match, Scope]:
+        match, child_scope = super().matches(scope)
+        if match is Match.FULL and "POST" in self.methods:
+            # JSON and NDJSON variants share a path; demote the one whose
+            # body format doesn't fit so the router picks its twin.
+            if is_ndjson(_content_type(scope)) != self.streaming:
+                match = Match.PARTIAL
+        return match, child_scope
+
+    def get_route_handler(self) -> Callable:
+        original = super().get_route_handler()
+        reads_body = self.body_field is not None
+
+        route = self.name
+
+        async def handler(request: Request) -> Response:
+            start = time.perf_counter()
+            status = 500
+            try:
+                request = DecompressingRequest(request.scope, request.receive)
+                if reads_body:
+                    # Read (and decompress) up front: FastAPI reports any error
+                    # raised while it reads the body as a generic 400, which
+                    # would hide the 413/415 answers above.
+                    await request.body()
+                    STAGE_SECONDS.observe(time.perf_counter() - start, "read")
+                response = await original(request)
+                status = response.status_code
+                return response
+            except IngestError as exc:
+                status = exc.status_code
+                ERRORS.inc(exc.error)
+                raise
+            except RequestValidationError:
+                status = 422
+                ERRORS.inc("validation_error")
+                raise
+            except Exception:
+                ERRORS.inc("internal_error")
+                raise
+            finally:
+                REQUEST_SECONDS.observe(time.perf_counter() - start, route, str(status))
+
+        return handler
+
+
+class NdjsonRoute(IngestRoute):
+    streaming = True
@@ -0,0 +1,136 @@
+"""msgspec mirrors of the wire schemas in schemas.py.
+
+Same field names, types and defaults, so ``handle_*`` reads either kind of
+record by attribute. Decoded with ``strict=False``, which accepts the same
+lax coercions pydantic does for these types (numeric strings for numbers,
+ISO-8601 strings or unix seconds for timestamps) and ignores unknown fields.
+The one difference: JSON booleans are rejected in integer fields, where
+pydantic would take them as 0/1.
+``gc=False`` is safe because records decoded from JSON can't form cycles.
+
+Keep in sync with schemas.py.
+"""
+
+from __future__ import annotations
+
+from datetime import datetime
+
+import msgspec
+
+from . import schemas
+
+
+class RequestRecord(msgspec.Struct, kw_only=True, gc=False):
+    project_slug: str = ""
+    app_id: str
+    timestamp: datetime
+    environment: str
+    method: str
+    path: str
+    status_code: int
+    response_time_ms: float
+    request_size: int = 0
+    response_size: int = 0
+    ip_address: str = ""
+    user_agent: str = ""
+    consumer_id: str = ""
+    consumer_name: str = ""
+    consumer_group: str = ""
+    request_payload: str = ""
+    response_payload: str = ""
+    request_headers: str = ""
+    response_headers: str = ""
+    base_url: str = ""
+    trace_id: str = ""
+    span_id: str = ""
+    rolled_up: bool = False
+    sample_rate: float = 1.0
+
+
+class IngestRequest(msgspec.Struct, gc=False):
+    requests: list[RequestRecord]
+
+
+class LogRecord(msgspec.Struct, kw_only=True, gc=False):
+    project_slug: str = ""
+    app_id: str
+    timestamp: datetime
+    environment: str
+    level: str
+    message: str
+    logger_name: str = ""
+    endpoint_method: str = ""
+    endpoint_path: str = ""
+    status_code: int = 0
+    consumer_id: str = ""
+    consumer_name: str = ""
+    consumer_group: str = ""
+    trace_id: str = ""
+    span_id: str = ""
+    payload: str = ""
+    attributes: dict = msgspec.field(default_factory=dict)
+
+
+class IngestLogsRequest(msgspec.Struct, gc=False):
+    logs: list[LogRecord]
+
+
+class SpanRecord(msgspec.Struct, kw_only=True, gc=False):
+    project_slug: str = ""
+    app_id: str
+    timestamp: datetime
+    environment: str = "production"
+    trace_id: str
+    span_id: str
+    parent_span_id: str = ""
+    name: str = ""
+    kind: str = "internal"
+    service_name: str = ""
+    duration_ms: float = 0.0
+    status: str = "ok"
+    status_code: int = 0
+    attributes: dict = msgspec.field(default_factory=dict)
+    sample_rate: float = 1.0
+
+
+class IngestSpansRequest(msgspec.Struct, gc=False):
+    spans: list[SpanRecord]
+
+
+class RollupRecord(msgspec.Struct, kw_only=True, gc=False):
+    project_slug: str = ""
+    app_id: str
+    timestamp: datetime
+    environment: str
+    method: str
+    path: str
+    status_code: int
+    consumer_group: str = ""
+    request_bytes: int = 0
+    response_bytes: int = 0
+    latency_bins: list[int]
+    latency_counts: list[int]
+
+
+class IngestRollupsRequest(msgspec.Struct, gc=False):
+    rollups: list[RollupRecord]
+
+
+class IngestBatchRequest(msgspec.Struct, gc=False):
+    requests: list[RequestRecord] = msgspec.field(default_factory=list)
+    logs: list[LogRecord] = msgspec.field(default_factory=list)
+    spans: list[SpanRecord] = msgspec.field(default_factory=list)
+
+
+# pydantic wire model -> msgspec mirror
+MIRRORS: dict[type, type] = {
+    schemas.RequestRecord: RequestRecord,
+    schemas.IngestRequest: IngestRequest,
+    schemas.LogRecord: LogRecord,
+    schemas.IngestLogsRequest: IngestLogsRequest,
+    schemas.SpanRecord: SpanRecord,
+    schemas.IngestSpansRequest: IngestSpansRequest,
+    schemas.RollupRecord: RollupRecord,
+    schemas.IngestRollupsRequest: IngestRollupsRequest,
+    schemas.IngestBatchRequest: IngestBatchRequest,
+}
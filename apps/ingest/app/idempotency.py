@@ -0,0 +1,248 @@
+"""Idempotent batches: an ``Idempotency-Key`` is processed at most once.
+
+The SDK stamps every batch with a fresh key and re-sends the same key when it
+retries after a timeout or a dropped connection. Without it a batch that was
+inserted but whose response was lost is inserted again, and every network
+blip shows up as duplicate rows.
+
+Each worker keeps the result (the accepted count, or counts per table for
+``/v1/batch``) of recently completed keys (bounded by
+``APILENS_INGEST_IDEMPOTENCY_MAXSIZE``, expiring after ``..._TTL`` seconds).
+A replay of a completed key gets the original response without touching the
+body. A replay that arrives while the first attempt is still running waits
+for it, and gets 409 with ``Retry-After`` if it is still running after
+``..._WAIT`` seconds. A failed attempt releases the key, so a retry
+processes the batch normally.
+
+With a Redis URL (``APILENS_INGEST_IDEMPOTENCY_REDIS_URL``, defaulting to
+the rate-limit one) keys are also claimed in Redis, so a retry that lands on
+another worker or replica is caught too. If Redis is unreachable, the local
+index is used on its own.
+
+Keys are scoped to the project and the target table. Requests without the
+header are processed as before.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from typing import Awaitable, Callable
+
+from .cache import TTLCache
+from .config import IdempotencyConfig, load_idempotency
+from .ingest import IngestError
+
+logger = logging.getLogger("apilens.ingest.idempotency")
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+_REDIS_KEY = "apilens:ingest:idem:{project_id}:{table}:{key}"
+_REDIS_ERROR_LOG_INTERVAL = 60.0
+_PENDING = b""
+_POLL = 0.05
+
+# An entrypoint's accepted count, or counts per table for /v1/batch.
+Result = int | dict[str, int]
+
+
+class _Shared:
+    """Key claims in Redis. On errors a claim succeeds, so the local index decides alone."""
+
+    def __init__(self, cfg: IdempotencyConfig) -> None:
+        import redis
+
+        self.cfg = cfg
+        self._client = redis.Redis.from_url(cfg.redis_url, socket_timeout=0.25, socket_connect_timeout=0.25)
+        self._last_error_log = 0.0
+
+    def _failed(self, exc: Exception) -> None:
+        now = time.monotonic()
+        if now - self._last_error_log >= _REDIS_ERROR_LOG_INTERVAL:
+            self._last_error_log = now
+            logger.warning("Idempotency Redis unavailable, using the local index only: %s", exc)
+
+    def claim(self, name: str) -> bytes | None:
+        """``None`` once claimed; else the stored value (``_PENDING`` while in flight)."""
+        try:
+            # The in-flight marker outlives the wait so a crashed worker's
+            # claim eventually frees the key.
+            if self._client.set(name, _PENDING, nx=True, ex=max(int(self.cfg.wait * 3), 1)):
+                return None
+            value = self._client.get(name)
+            return _PENDING if value is None else value
+        except Exception as exc:
+            self._failed(exc)
+            return None
+
+    def complete(self, name: str, accepted: Result) -> None:
+        try:
+            self._client.set(name, json.dumps(accepted), ex=max(int(self.cfg.ttl), 1))
+        except Exception as exc:
+            self._failed(exc)
+
+    def release(self, name: str) -> None:
+        try:
+            self._client.delete(name)
+        except Exception as exc:
+            self._failed(exc)
+
+
+class RecentKeys:
+    """Completed keys -> result, plus the keys currently in flight."""
+
+    def __init__(self, cfg: IdempotencyConfig) -> None:
+        self.cfg = cfg
+        self._done = TTLCache(cfg.maxsize, cfg.ttl)
+        self._inflight: dict[tuple[str, str, str], threading.Event] = {}
+        self._lock = threading.Lock()
+        self._shared = _Shared(cfg) if cfg.redis_url else None
+        self.replays = 0
+
+    def once(self, project_id: str, table: str, key: str, run: Callable[[], Result]) -> tuple[Result, bool]:
+        """``(accepted, replayed)``: ``run()``'s result, or the first attempt's."""
+        ident = (project_id, table, key)
+        deadline = time.monotonic() + self.cfg.wait
+        while True:
+            accepted = self._done.get(ident)
+            if accepted is not None:
+                return self._replayed(accepted)
+            with self._lock:
+                event = self._inflight.get(ident)
+                if event is None:
+                    event = self._inflight[ident] = threading.Event()
+                    break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not event.wait(remaining):
+                raise _in_progress()
+
+        try:
+            return self._run_claimed(ident, run)
+        finally:
+            with self._lock:
+                self._inflight.pop(ident, None)
+            event.set()
+
+    def _run_claimed(self, ident: tuple[str, str, str], run: Callable[[], Result]) -> tuple[Result, bool]:
+        shared = self._shared
+        name = _REDIS_KEY.format(project_id=ident[0], table=ident[1], key=ident[2])
+        if shared is not None:
+            deadline = time.monotonic() + self.cfg.wait
+            while (value := shared.claim(name)) is not None:
+                if value != _PENDING:
+                    accepted = json.loads(value)
+                    self._done.set(ident, accepted)
+                    return self._replayed(accepted)
+                if time.monotonic() >= deadline:
+                    raise _in_progress()
+                time.sleep(_POLL)
+        try:
+            accepted = run()
+        except BaseException:
+            if shared is not None:
+                shared.release(name)
+            raise
+        self._done.set(ident, accepted)
+        if shared is not None:
+            shared.complete(name, accepted)
+        return accepted, False
+
+    async def once_async(
+        self, project_id: str, table: str, key: str, run: Callable[[], Awaitable[Result]]
+    ) -> tuple[Result, bool]:
+        """:meth:`once` for the event loop: waiting polls instead of blocking."""
+        ident = (project_id, table, key)
+        deadline = time.monotonic() + self.cfg.wait
+        while True:
+            accepted = self._done.get(ident)
+            if accepted is not None:
+                return self._replayed(accepted)
+            with self._lock:
+                event = self._inflight.get(ident)
+                if event is None:
+                    event = self._inflight[ident] = threading.Event()
+                    break
+            if time.monotonic() >= deadline:
+                raise _in_progress()
+            await asyncio.sleep(_POLL)
+
+        try:
+            shared = self._shared
+            name = _REDIS_KEY.format(project_id=project_id, table=table, key=key)
+            if shared is not None:
+                while (value := shared.claim(name)) is not None:
+                    if value != _PENDING:
+                        accepted = json.loads(value)
+                        self._done.set(ident, accepted)
+                        return self._replayed(accepted)
+                    if time.monotonic() >= deadline:
+                        raise _in_progress()
+                    await asyncio.sleep(_POLL)
+            try:
+                accepted = await run()
+            except BaseException:
+                if shared is not None:
+                    shared.release(name)
+                raise
+            self._done.set(ident, accepted)
+            if shared is not None:
+                shared.complete(name, accepted)
+            return accepted, False
+        finally:
+            with self._lock:
+                self._inflight.pop(ident, None)
+            event.set()
+
+    def _replayed(self, accepted: Result) -> tuple[Result, bool]:
+        with self._lock:
+            self.replays += 1
+        return accepted, True
+
+    def stats(self) -> dict[str, object]:
+        with self._lock:
+            inflight = len(self._inflight)
+        return {"keys": len(self._done), "inflight": inflight, "replays": self.replays, "shared": self._shared is not None}
+
+
+def _in_progress() -> IngestError:
+    return IngestError(
+        409,
+        "conflict",
+        "A request with this Idempotency-Key is still being processed, retry later",
+        headers={"Retry-After": "1"},
+    )
+
+
+_cfg = load_idempotency()
+_index = RecentKeys(_cfg) if _cfg.enabled else None
+
+
+def once(project_id: str, table: str, key: str | None, run: Callable[[], Result]) -> tuple[Result, bool]:
+    """Run ``run`` at most once per ``key``; ``(accepted, replayed)``."""
+    if _index is None or key is None:
+        return run(), False
+    return _index.once(project_id, table, _checked(key), run)
+
+
+def _checked(key: str) -> str:
+    key = key.strip()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise IngestError(422, "validation_error", f"{HEADER} must be 1-{MAX_KEY_LENGTH} characters")
+    return key
+
+
+async def once_async(
+    project_id: str, table: str, key: str | None, run: Callable[[], Awaitable[Result]]
+) -> tuple[Result, bool]:
+    """:func:`once` for async entrypoints (``APILENS_INGEST_ASYNC``)."""
+    if _index is None or key is None:
+        return await run(), False
+    return await _index.once_async(project_id, table, _checked(key), run)
+
+
+def stats() -> dict[str, object] | None:
+    return _index.stats() if _index is not None else None
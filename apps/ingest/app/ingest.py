@@ -10,12 +10,42 @@ Kept deliberately in lock-step with:
 from __future__ import annotations
 
 import json
+import logging
+import struct
 import threading
+import time
 import uuid
-from collections import defaultdict
-
-from .config import MAX_BATCH_SIZE
+from functools import partial
+from typing import Iterable
+
+from clickhouse_driver import errors as ch_errors
+from psycopg2 import errors as pg_errors
+from psycopg2.extras import execute_values
+
+from .buffer import TableWriter, put_all
+from .cache import TTLCache
+from .columnar import timestamp_scale, to_columns, to_numpy_columns
+from .config import (
+    MAX_BATCH_SIZE, load_buffer, load_cache, load_insert_format, load_path_templating, load_spool,
+    load_trace_sampling,
+)
 from .db import clickhouse, pg_conn
+from .last_seen import LastSeenTracker, as_utc
+from .metrics import (
+    INSERT_ERRORS,
+    INSERT_ROWS,
+    INSERT_SECONDS,
+    STAGE_SECONDS,
+    TRACE_DECISIONS,
+    WRITER_SHED_ROWS,
+    project_label,
+)
+from .routes import DEFAULT as DEFAULT_TEMPLATER, Templater
+from .sampling import TailSampler
+from .spool import CircuitOpenError, Spool
+from .timestamps import check_rows
+
+logger = logging.getLogger("apilens.ingest")
 
 ALLOWED_METHODS = {"GET", "POST", "PUT", "PATCH", "DELETE"}
 
@@ -33,7 +63,7 @@ REQUEST_COLUMNS = [
     "path", "status_code", "response_time_ms", "request_size", "response_size",
     "ip_address", "user_agent", "consumer_id", "consumer_name", "consumer_group",
     "request_payload", "response_payload", "request_headers", "response_headers",
-    "base_url", "trace_id", "span_id",
+    "base_url", "trace_id", "span_id", "raw_path", "rolled_up", "sample_rate",
 ]
 LOG_COLUMNS = [
     "timestamp", "app_id", "project_id", "environment", "level", "message",
@@ -44,17 +74,36 @@ LOG_COLUMNS = [
 SPAN_COLUMNS = [
     "timestamp", "app_id", "project_id", "environment", "trace_id", "span_id",
     "parent_span_id", "name", "kind", "service_name", "duration_ms", "status",
-    "status_code", "attributes_json",
+    "status_code", "attributes_json", "sample_rate",
+]
+ROLLUP_COLUMNS = [
+    "timestamp", "app_id", "project_id", "endpoint_id", "environment", "method",
+    "path", "status_code", "consumer_group", "request_count", "request_bytes",
+    "response_bytes", "latency_bins", "latency_counts",
 ]
 
+# Latency sketch of a rollup (the SDK's apilens/client/rollups.py): bucket i
+# holds latencies in (GAMMA**(i-1), GAMMA**i] ms, so reading any quantile as
+# its bucket's midpoint is within 1% of the true value. Buckets are stored as
+# Int16; real latencies use about -700..1200.
+SKETCH_GAMMA = 1.01 / 0.99
+MAX_SKETCH_BINS = 4096
+_SKETCH_BIN_RANGE = range(-32768, 32768)
+
+# A record sent with sample_rate r stands for 1 / r requests or spans (SDK
+# head sampling, apilens/client/sampling.py). The dashboard weights request
+# rows by it, so lower rates are raised to this floor.
+MIN_SAMPLE_RATE = 0.001
+
 
 class IngestError(Exception):
     """Maps to an HTTP status (mirrors the backend's domain exceptions)."""
 
-    def __init__(self, status_code: int, error: str, detail):
+    def __init__(self, status_code: int, error: str, detail, headers: dict[str, str] | None = None):
         self.status_code = status_code
         self.error = error
         self.detail = detail
+        self.headers = headers
         super().__init__(detail if isinstance(detail, str) else error)
 
 
@@ -83,6 +132,17 @@ def _safe_trace_component(value: str, length: int) -> str:
     return text
 
 
+def _safe_sample_rate(value) -> float:
+    # Missing or nonsensical rates (0, negative, > 1, NaN) mean unsampled.
+    try:
+        rate = float(value)
+    except (TypeError, ValueError):
+        return 1.0
+    if not 0.0 < rate <= 1.0:
+        return 1.0
+    return max(rate, MIN_SAMPLE_RATE)
+
+
 def _normalize_log_level(value: str) -> str:
     level = (value or "INFO").strip().upper()
     if level in {"DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"}:
@@ -137,6 +197,12 @@ def ensure_clickhouse_schema(client) -> None:
             "ALTER TABLE api_requests ADD COLUMN IF NOT EXISTS trace_id String DEFAULT '' CODEC(ZSTD(1))",
             "ALTER TABLE api_requests ADD COLUMN IF NOT EXISTS span_id String DEFAULT '' CODEC(ZSTD(1))",
             "ALTER TABLE api_requests ADD INDEX IF NOT EXISTS idx_api_requests_trace_id trace_id TYPE bloom_filter(0.01) GRANULARITY 1",
+            # `path` holds the route template (routes.py); this is the path as sent.
+            "ALTER TABLE api_requests ADD COLUMN IF NOT EXISTS raw_path String DEFAULT '' CODEC(ZSTD(3))",
+            # 1 = also counted in api_request_rollups; aggregates skip these rows.
+            "ALTER TABLE api_requests ADD COLUMN IF NOT EXISTS rolled_up UInt8 DEFAULT 0 CODEC(ZSTD(1))",
+            # 1 / sample_rate requests were served per stored row (SDK head sampling).
+            "ALTER TABLE api_requests ADD COLUMN IF NOT EXISTS sample_rate Float32 DEFAULT 1 CODEC(ZSTD(1))",
             "ALTER TABLE api_logs ADD COLUMN IF NOT EXISTS project_id String CODEC(ZSTD(1))",
             "ALTER TABLE api_logs ADD COLUMN IF NOT EXISTS attributes_json String CODEC(ZSTD(3))",
             # Log-correlation columns exist in the 004 migration but not in the
@@ -152,6 +218,9 @@ def ensure_clickhouse_schema(client) -> None:
             "ALTER TABLE api_logs ADD INDEX IF NOT EXISTS idx_api_logs_trace_id trace_id TYPE bloom_filter(0.01) GRANULARITY 1",
             # Span storage for distributed traces (the waterfall view). The
             # legacy `traces` table (tenant_id model) is intentionally unused.
+            # Keyed on span_id so a span stored twice (a retry that got past
+            # the Idempotency-Key index) collapses on merge; readers add
+            # LIMIT 1 BY span_id to be exact before the merge.
             """
             CREATE TABLE IF NOT EXISTS api_spans (
                 timestamp DateTime64(3) CODEC(DoubleDelta, ZSTD(1)),
@@ -168,21 +237,265 @@ def ensure_clickhouse_schema(client) -> None:
                 status LowCardinality(String) CODEC(ZSTD(1)),
                 status_code UInt16 CODEC(ZSTD(1)),
                 attributes_json String CODEC(ZSTD(3))
-            ) ENGINE = MergeTree()
+            ) ENGINE = ReplacingMergeTree()
             PARTITION BY toYYYYMM(timestamp)
-            ORDER BY (app_id, trace_id, timestamp)
+            ORDER BY (app_id, trace_id, span_id)
             TTL toDateTime(timestamp) + INTERVAL 30 DAY
             SETTINGS index_granularity = 8192
             """,
             "ALTER TABLE api_spans ADD INDEX IF NOT EXISTS idx_api_spans_trace_id trace_id TYPE bloom_filter(0.01) GRANULARITY 1",
             "ALTER TABLE api_spans ADD INDEX IF NOT EXISTS idx_api_spans_project_id project_id TYPE bloom_filter(0.01) GRANULARITY 1",
             "ALTER TABLE api_spans ADD INDEX IF NOT EXISTS idx_api_spans_environment environment TYPE bloom_filter(0.01) GRANULARITY 1",
+            # 1 / sample_rate spans were seen per stored span (SDK head and
+            # ingest tail sampling).
+            "ALTER TABLE api_spans ADD COLUMN IF NOT EXISTS sample_rate Float32 DEFAULT 1 CODEC(ZSTD(1))",
+            # Per-minute request rollups from SDKs in rollup mode. Rows are
+            # additive (two workers may each send the same minute); the
+            # dashboard reads them through apps/api's api_request_stats view.
+            """
+            CREATE TABLE IF NOT EXISTS api_request_rollups (
+                timestamp DateTime64(3) CODEC(DoubleDelta, ZSTD(1)),
+                app_id String CODEC(ZSTD(1)),
+                project_id String CODEC(ZSTD(1)),
+                endpoint_id String CODEC(ZSTD(1)),
+                environment LowCardinality(String) CODEC(ZSTD(1)),
+                method LowCardinality(String) CODEC(ZSTD(1)),
+                path String CODEC(ZSTD(1)),
+                status_code UInt16 CODEC(ZSTD(1)),
+                consumer_group String CODEC(ZSTD(1)),
+                request_count UInt64 CODEC(ZSTD(1)),
+                request_bytes UInt64 CODEC(ZSTD(1)),
+                response_bytes UInt64 CODEC(ZSTD(1)),
+                latency_bins Array(Int16) CODEC(ZSTD(1)),
+                latency_counts Array(UInt64) CODEC(ZSTD(1))
+            ) ENGINE = MergeTree()
+            PARTITION BY toYYYYMM(timestamp)
+            ORDER BY (app_id, timestamp, method, path, status_code)
+            SETTINGS index_granularity = 8192
+            """,
         ]
         for s in stmts:
             client.execute(s)
+        engine = client.execute(
+            "SELECT engine FROM system.tables WHERE database = currentDatabase() AND name = 'api_spans'"
+        )
+        if engine and engine[0][0] == "MergeTree":
+            # CREATE TABLE IF NOT EXISTS leaves an older table as it was.
+            logger.warning(
+                "api_spans uses MergeTree, so retried spans are not collapsed; recreate it as "
+                "ReplacingMergeTree ORDER BY (app_id, trace_id, span_id) to deduplicate"
+            )
         _schema_ready = True
 
 
+# --- ClickHouse writes --------------------------------------------------------
+# With buffering on (the default) handlers only enqueue; one writer thread per
+# table coalesces rows from many batches into large INSERTs (see buffer.py).
+# With a spool configured, blocks that can't be inserted go to disk and are
+# replayed once ClickHouse is back (see spool.py).
+
+TABLE_COLUMNS = {
+    "api_requests": REQUEST_COLUMNS,
+    "api_logs": LOG_COLUMNS,
+    "api_spans": SPAN_COLUMNS,
+    "api_request_rollups": ROLLUP_COLUMNS,
+}
+# Tables a /v1/batch upload writes to.
+BATCH_TABLES = ("api_requests", "api_logs", "api_spans")
+
+_writers: dict[str, TableWriter] = {}
+_writers_lock = threading.Lock()
+_spool: Spool | None = None
+_sampler: TailSampler | None = None
+
+
+_insert_format = load_insert_format()
+_timestamp_scales: dict[str, int | None] = {}
+
+
+def _timestamp_scale(client, table: str) -> int | None:
+    """DateTime64 scale of ``table.timestamp`` (looked up once per table)."""
+    if table not in _timestamp_scales:
+        try:
+            found = client.execute(
+                "SELECT type FROM system.columns "
+                "WHERE database = currentDatabase() AND table = %(table)s AND name = 'timestamp'",
+                {"table": table},
+            )
+        except Exception as exc:
+            logger.warning("Could not read %s.timestamp type, sending datetimes: %s", table, exc)
+            return None
+        _timestamp_scales[table] = timestamp_scale(found[0][0]) if found else None
+    return _timestamp_scales[table]
+
+
+def _execute_insert(table: str, columns: list[str], rows: list[tuple]) -> None:
+    start = time.perf_counter()
+    try:
+        client = clickhouse()
+        ensure_clickhouse_schema(client)
+        query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES"
+        if _insert_format == "rows":
+            client.execute(query, rows)
+        elif _insert_format == "numpy":
+            client.execute(query, to_numpy_columns(columns, rows, _timestamp_scale(client, table)), columnar=True)
+        else:
+            client.execute(query, to_columns(columns, rows, _timestamp_scale(client, table)), columnar=True)
+    except Exception:
+        INSERT_ERRORS.inc(table)
+        raise
+    INSERT_SECONDS.observe(time.perf_counter() - start, table)
+    INSERT_ROWS.observe(len(rows), table)
+
+
+# Server errors about the block itself rather than ClickHouse's state: the
+# spool moves such a block aside at once instead of retrying it.
+_BAD_BLOCK_CODES = frozenset({
+    ch_errors.ErrorCodes.CANNOT_PARSE_TEXT,
+    ch_errors.ErrorCodes.INCORRECT_NUMBER_OF_COLUMNS,
+    ch_errors.ErrorCodes.SIZES_OF_COLUMNS_DOESNT_MATCH,
+    ch_errors.ErrorCodes.NO_SUCH_COLUMN_IN_TABLE,
+    ch_errors.ErrorCodes.NUMBER_OF_COLUMNS_DOESNT_MATCH,
+    ch_errors.ErrorCodes.CANNOT_PARSE_DATE,
+    ch_errors.ErrorCodes.CANNOT_PARSE_DATETIME,
+    ch_errors.ErrorCodes.ILLEGAL_TYPE_OF_ARGUMENT,
+    ch_errors.ErrorCodes.ILLEGAL_COLUMN,
+    ch_errors.ErrorCodes.TYPE_MISMATCH,
+    ch_errors.ErrorCodes.ARGUMENT_OUT_OF_BOUND,
+    ch_errors.ErrorCodes.CANNOT_CONVERT_TYPE,
+    ch_errors.ErrorCodes.CANNOT_PARSE_NUMBER,
+    ch_errors.ErrorCodes.INCORRECT_DATA,
+    ch_errors.ErrorCodes.TOO_LARGE_STRING_SIZE,
+    ch_errors.ErrorCodes.VALUE_IS_OUT_OF_RANGE_OF_DATA_TYPE,
+    ch_errors.ErrorCodes.CANNOT_INSERT_NULL_IN_ORDINARY_COLUMN,
+    ch_errors.ErrorCodes.CANNOT_PARSE_UUID,
+})
+
+
+def _classify_insert_error(exc: Exception) -> str:
+    """How the spool treats a failed replay: unavailable, rejected or error (see spool.py)."""
+    if isinstance(exc, (ch_errors.NetworkError, ch_errors.SocketTimeoutError, OSError, EOFError)):
+        return "unavailable"
+    if isinstance(exc, ch_errors.ServerException):
+        return "rejected" if exc.code in _BAD_BLOCK_CODES else "error"
+    # Raised by clickhouse_driver or columnar.py while serializing the block.
+    if isinstance(exc, (ch_errors.TypeMismatchError, ch_errors.CannotParseUuidError,
+                        TypeError, ValueError, OverflowError, struct.error)):
+        return "rejected"
+    return "error"
+
+
+def _deliver(table: str, columns: list[str], rows: list[tuple]) -> None:
+    if _spool is not None:
+        _spool.write(table, columns, rows)
+    else:
+        _execute_insert(table, columns, rows)
+
+
+def start_writers() -> None:
+    global _spool, _sampler
+    spool_cfg = load_spool()
+    sampling_cfg = load_trace_sampling()
+    cfg = load_buffer()
+    with _writers_lock:
+        if spool_cfg is not None and _spool is None:
+            _spool = Spool(spool_cfg, _execute_insert, _classify_insert_error)
+            logger.info("Ingest spool enabled at %s", _spool.slot)
+        if _spool is not None:
+            _spool.start()
+        if sampling_cfg is not None and _sampler is None:
+            _sampler = TailSampler(sampling_cfg, _emit_sampled_spans, _count_decision)
+            logger.info("Tail-based trace sampling enabled (keep %.4g%%)", sampling_cfg.keep_percent)
+        if _sampler is not None:
+            _sampler.start()
+        if not cfg.enabled:
+            return
+        for table, columns in TABLE_COLUMNS.items():
+            writer = _writers.get(table)
+            if writer is None:
+                writer = _writers[table] = TableWriter(table, columns, cfg, _deliver, partial(_count_shed, table))
+            writer.start()
+
+
+def stop_writers(timeout: float = 30.0) -> None:
+    """Flush every buffered row (called on shutdown)."""
+    # Stopped first: pending traces are decided into the writers below.
+    if _sampler is not None:
+        _sampler.stop()
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.stop(timeout=timeout)
+    # Stopped last: the writers' final flush may still need to spool.
+    if _spool is not None:
+        _spool.stop()
+
+
+def writer_stats() -> dict[str, dict[str, float]]:
+    return {table: writer.stats() for table, writer in _writers.items()}
+
+
+def writer_project_stats() -> dict[str, dict[str, dict[str, float]]]:
+    return {table: writer.project_stats() for table, writer in _writers.items()}
+
+
+def spool_stats() -> dict[str, object] | None:
+    return _spool.stats() if _spool is not None else None
+
+
+def sampler_stats() -> dict[str, object] | None:
+    return _sampler.stats() if _sampler is not None else None
+
+
+def _emit_sampled_spans(rows: list[tuple]) -> None:
+    _enqueue("api_spans", rows)
+
+
+def _count_decision(decision: str, traces: int) -> None:
+    TRACE_DECISIONS.inc(decision, amount=traces)
+
+
+def _count_shed(table: str, project_id: str, reason: str, rows: int) -> None:
+    WRITER_SHED_ROWS.inc(table, project_label(project_id), reason, amount=rows)
+
+
+def _insert(table: str, rows: list[tuple]) -> None:
+    if not rows:
+        return
+    with STAGE_SECONDS.time("enqueue"):
+        _enqueue(table, rows)
+
+
+def _enqueue(table: str, rows: list[tuple]) -> None:
+    _enqueue_all([(table, rows)])
+
+
+def _insert_all(blocks: list[tuple[str, list[tuple]]]) -> None:
+    """Enqueue blocks of several tables: all of them, or none when any is refused."""
+    blocks = [(table, rows) for table, rows in blocks if rows]
+    if not blocks:
+        return
+    with STAGE_SECONDS.time("enqueue"):
+        _enqueue_all(blocks)
+
+
+def _enqueue_all(blocks: list[tuple[str, list[tuple]]]) -> None:
+    writers = [_writers.get(table) for table, _ in blocks]
+    if None in writers:
+        # Writers exist for every table or for none (APILENS_INGEST_BUFFER).
+        try:
+            if _spool is not None:
+                _spool.write_all([(table, TABLE_COLUMNS[table], rows) for table, rows in blocks])
+            else:
+                for table, rows in blocks:
+                    _execute_insert(table, TABLE_COLUMNS[table], rows)
+        except CircuitOpenError as exc:
+            raise IngestError(503, "service_unavailable", "Ingest is temporarily unavailable, retry later") from exc
+        return
+    if not put_all([(writer, rows) for writer, (_, rows) in zip(writers, blocks)]):
+        raise IngestError(503, "service_unavailable", "Ingest is temporarily overloaded, retry later")
+
+
 # --- validation + resolution (mirrors router.py) ----------------------------
 
 def validate_project_slug(auth_slug: str, payload_slugs: set[str]) -> None:
@@ -193,7 +506,8 @@ def validate_project_slug(auth_slug: str, payload_slugs: set[str]) -> None:
         raise IngestError(422, "validation_error", f"project_slug must match the API key project '{auth_slug}'")
 
 
-def resolve_app_identifiers(cur, project_id: str, identifiers: set[str]) -> dict[str, str]:
+def split_app_identifiers(identifiers: set[str]) -> tuple[set[str], set[str]]:
+    """(uuids, slugs) of a batch's app identifiers."""
     if any(not (i or "").strip() for i in identifiers):
         raise IngestError(422, "validation_error", "app_id is required for every record")
 
@@ -204,7 +518,11 @@ def resolve_app_identifiers(cur, project_id: str, identifiers: set[str]) -> dict
             uuids.add(ident)
         except (ValueError, AttributeError):
             slugs.add(ident)
+    return uuids, slugs
+
 
+def resolve_app_identifiers(cur, project_id: str, identifiers: set[str]) -> dict[str, str]:
+    uuids, slugs = split_app_identifiers(identifiers)
     cur.execute(
         """
         SELECT id, slug FROM apps
@@ -213,9 +531,14 @@ def resolve_app_identifiers(cur, project_id: str, identifiers: set[str]) -> dict
         """,
         (project_id, list(uuids), list(slugs)),
     )
+    return map_app_identifiers(cur.fetchall(), uuids, slugs)
+
+
+def map_app_identifiers(found: Iterable[tuple], uuids: set[str], slugs: set[str]) -> dict[str, str]:
+    """{identifier: app uuid} from the (id, slug) rows found; 422 for unknown ones."""
     mapping: dict[str, str] = {}
     found_uuids, found_slugs = set(), set()
-    for app_id, slug in cur.fetchall():
+    for app_id, slug in found:
         u = str(app_id)
         mapping[u] = u
         mapping[slug] = u
@@ -228,178 +551,458 @@ def resolve_app_identifiers(cur, project_id: str, identifiers: set[str]) -> dict
     return mapping
 
 
-def discover_endpoints(cur, app_id: str, records) -> dict[tuple[str, str], str]:
-    """Upsert (app, method, path) endpoints, bumping last_seen_at; return id map."""
-    last_seen: dict[tuple[str, str], object] = {}
-    for r in records:
-        method = r.method.upper()
-        if method not in ALLOWED_METHODS:
-            continue
-        key = (method, r.path)
-        prev = last_seen.get(key)
-        if prev is None or r.timestamp > prev:
-            last_seen[key] = r.timestamp
+def discover_endpoints(cur, last_seen: dict[tuple[str, str, str], object]) -> dict[tuple[str, str, str], str]:
+    """Create unseen (app, method, path) endpoints in one statement and return
+    {(app_id, method, path): endpoint_id} for every key.
 
-    endpoint_map: dict[tuple[str, str], str] = {}
-    for (method, path), seen_at in last_seen.items():
-        cur.execute(
-            """
+    Existing rows are only read, never updated: their last_seen_at is bumped
+    asynchronously by the LastSeenTracker, so concurrent workers don't fight
+    over row locks on hot endpoints.
+    """
+    if not last_seen:
+        return {}
+    # Sorted so concurrent workers lock conflicting rows in the same order.
+    rows = [
+        (str(uuid.uuid4()), app_id, path, method, seen_at)
+        for (app_id, method, path), seen_at in sorted(last_seen.items(), key=lambda kv: kv[0])
+    ]
+    result = execute_values(
+        cur,
+        """
+        WITH v (id, app_id, path, method, last_seen_at) AS (VALUES %s),
+        created AS (
             INSERT INTO endpoints
                 (id, app_id, path, method, description, is_active, last_seen_at, created_at, updated_at)
-            VALUES (%s, %s, %s, %s, '', true, %s, now(), now())
-            ON CONFLICT (app_id, path, method) DO UPDATE
-                SET last_seen_at = GREATEST(endpoints.last_seen_at, EXCLUDED.last_seen_at),
-                    is_active = true,
-                    updated_at = now()
-            RETURNING id
+            SELECT id, app_id, path, method, '', true, last_seen_at, now(), now() FROM v
+            ON CONFLICT (app_id, path, method) DO NOTHING
+            RETURNING id, app_id, method, path
+        )
+        SELECT id, app_id, method, path FROM created
+        UNION ALL
+        SELECT e.id, e.app_id, e.method, e.path
+        FROM endpoints e JOIN v ON e.app_id = v.app_id AND e.path = v.path AND e.method = v.method
+        """,
+        rows,
+        template="(%s::uuid, %s::uuid, %s, %s, %s::timestamptz)",
+        page_size=len(rows),
+        fetch=True,
+    )
+    endpoint_ids = {(str(app_id), method, path): str(endpoint_id) for endpoint_id, app_id, method, path in result}
+
+    # A row committed by another worker after this statement's snapshot is
+    # neither inserted (conflict) nor visible to the join; read it back.
+    raced = [key for key in last_seen if key not in endpoint_ids]
+    if raced:
+        execute_values(
+            cur,
+            """
+            SELECT e.id, e.app_id, e.method, e.path
+            FROM endpoints e JOIN (VALUES %s) AS v (app_id, method, path)
+              ON e.app_id = v.app_id AND e.method = v.method AND e.path = v.path
             """,
-            (str(uuid.uuid4()), app_id, path, method, seen_at),
+            raced,
+            template="(%s::uuid, %s, %s)",
+            page_size=len(raced),
         )
-        endpoint_map[(method, path)] = str(cur.fetchone()[0])
-    return endpoint_map
+        for endpoint_id, app_id, method, path in cur.fetchall():
+            endpoint_ids[(str(app_id), method, path)] = str(endpoint_id)
+    return endpoint_ids
 
 
-# --- public entrypoints ------------------------------------------------------
+def flush_last_seen(seen: dict[str, object]) -> None:
+    """Bulk-advance endpoints.last_seen_at; rows already newer are left alone."""
+    with pg_conn() as conn:
+        with conn.cursor() as cur:
+            execute_values(
+                cur,
+                """
+                UPDATE endpoints AS e
+                SET last_seen_at = GREATEST(e.last_seen_at, v.seen_at),
+                    is_active = true,
+                    updated_at = now()
+                FROM (VALUES %s) AS v (id, seen_at)
+                WHERE e.id = v.id
+                  AND (e.last_seen_at IS NULL OR e.last_seen_at < v.seen_at OR NOT e.is_active)
+                """,
+                sorted(seen.items()),
+                template="(%s::uuid, %s::timestamptz)",
+                page_size=len(seen),
+            )
 
-def handle_requests(project_id: str, project_slug: str, records) -> int:
-    if len(records) > MAX_BATCH_SIZE:
-        raise IngestError(422, "validation_error", f"Batch size exceeds maximum of {MAX_BATCH_SIZE}")
-    if not records:
-        return 0
 
-    validate_project_slug(project_slug, {r.project_slug for r in records})
+# --- cached resolution -------------------------------------------------------
+# App and endpoint ids practically never change, so they are cached per
+# process and only unknown keys reach Postgres. Sightings of known endpoints
+# go to the LastSeenTracker, which writes them in bulk every few seconds.
 
-    with pg_conn() as conn:
-        with conn.cursor() as cur:
-            id_to_uuid = resolve_app_identifiers(cur, project_id, {r.app_id for r in records})
-            by_app: dict[str, list] = defaultdict(list)
-            for r in records:
-                by_app[id_to_uuid[r.app_id]].append(r)
-            endpoint_maps = {
-                app_uuid: discover_endpoints(cur, app_uuid, recs)
-                for app_uuid, recs in by_app.items()
-            }
-
-    client = clickhouse()
-    ensure_clickhouse_schema(client)
-    total = 0
-    for app_uuid, recs in by_app.items():
-        emap = endpoint_maps[app_uuid]
-        rows = []
-        for r in recs:
-            method = r.method.upper()
-            rows.append((
-                r.timestamp, app_uuid, project_id, emap.get((method, r.path), ""),
-                r.environment, method, r.path, r.status_code, r.response_time_ms,
-                r.request_size, r.response_size, r.ip_address, r.user_agent,
-                (r.consumer_id or "")[:256], (r.consumer_name or "")[:256],
-                (r.consumer_group or "")[:256],
-                _safe_payload(r.request_payload), _safe_payload(r.response_payload),
-                _safe_payload(r.request_headers), _safe_payload(r.response_headers),
-                (r.base_url or "")[:512],
-                _safe_trace_component(r.trace_id, 32), _safe_trace_component(r.span_id, 16),
-            ))
-        client.execute(
-            f"INSERT INTO api_requests ({', '.join(REQUEST_COLUMNS)}) VALUES",
-            rows,
-        )
-        total += len(rows)
-    return total
+_cache_cfg = load_cache()
+_app_cache = TTLCache(_cache_cfg.app_maxsize, _cache_cfg.app_ttl)
+_templater_cache = TTLCache(_cache_cfg.app_maxsize, _cache_cfg.app_ttl)
+_path_templating = load_path_templating()
+_templates_column = True  # False once Postgres turns out not to have apps.path_templates
+_endpoint_cache = TTLCache(_cache_cfg.endpoint_maxsize, _cache_cfg.endpoint_ttl)
+_last_seen = LastSeenTracker(_cache_cfg.last_seen_interval, flush_last_seen)
 
 
-def handle_logs(project_id: str, project_slug: str, records) -> int:
-    if len(records) > MAX_BATCH_SIZE:
-        raise IngestError(422, "validation_error", f"Batch size exceeds maximum of {MAX_BATCH_SIZE}")
-    if not records:
-        return 0
+def start_last_seen_tracker() -> None:
+    _last_seen.start()
 
-    validate_project_slug(project_slug, {r.project_slug for r in records})
+
+def stop_last_seen_tracker() -> None:
+    _last_seen.stop()
+
+
+def resolve_apps(project_id: str, identifiers: set[str]) -> dict[str, str]:
+    """Cached :func:`resolve_app_identifiers`: {identifier: app uuid}."""
+    cached = _app_cache.get_many((project_id, ident) for ident in identifiers)
+    mapping = {ident: app_uuid for (_, ident), app_uuid in cached.items()}
+    missing = identifiers - mapping.keys()
+    if not missing:
+        return mapping
 
     with pg_conn() as conn:
         with conn.cursor() as cur:
-            id_to_uuid = resolve_app_identifiers(cur, project_id, {r.app_id for r in records})
-            by_app: dict[str, list] = defaultdict(list)
-            for r in records:
-                by_app[id_to_uuid[r.app_id]].append(r)
-
-    client = clickhouse()
-    ensure_clickhouse_schema(client)
-    total = 0
-    for app_uuid, recs in by_app.items():
-        rows = []
-        for r in recs:
-            rows.append((
-                r.timestamp, app_uuid, project_id,
-                (r.environment or "production").strip().lower(),
-                _normalize_log_level(r.level),
-                _safe_log_text(r.message, limit=MAX_LOG_MESSAGE_CHARS),
-                _safe_log_text(r.logger_name, limit=256),
-                _safe_log_text((r.endpoint_method or "").upper(), limit=16),
-                _safe_log_text(r.endpoint_path, limit=2048),
-                max(0, min(int(r.status_code or 0), 599)),
-                _safe_log_text(r.consumer_id, limit=256),
-                _safe_log_text(r.consumer_name, limit=256),
-                _safe_log_text(r.consumer_group, limit=256),
-                _safe_trace_component(r.trace_id, 32),
-                _safe_trace_component(r.span_id, 16),
-                _safe_log_text(r.payload, limit=MAX_LOG_PAYLOAD_CHARS),
-                json.dumps(_sanitize_log_attributes(r.attributes), separators=(",", ":")),
-            ))
-        client.execute(
-            f"INSERT INTO api_logs ({', '.join(LOG_COLUMNS)}) VALUES",
-            rows,
-        )
-        total += len(rows)
-    return total
+            found = resolve_app_identifiers(cur, project_id, missing)
+    _app_cache.set_many({(project_id, ident): app_uuid for ident, app_uuid in found.items()})
+    mapping.update(found)
+    return mapping
 
 
-ALLOWED_SPAN_STATUSES = {"ok", "error"}
+def _identity(path: str) -> str:
+    return path
 
 
-def handle_spans(project_id: str, project_slug: str, records) -> int:
+def app_templaters(app_uuids: set[str]) -> dict[str, Templater]:
+    """Cached route templater per app, built from ``apps.path_templates``."""
+    if not _path_templating:
+        return {app_uuid: _identity for app_uuid in app_uuids}
+    templaters = _templater_cache.get_many(app_uuids)
+    missing = app_uuids - templaters.keys()
+    if not missing:
+        return templaters
+
+    rows: list[tuple] = []
+    if _templates_column:
+        try:
+            with pg_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT id, path_templates FROM apps WHERE id = ANY(%s::uuid[])",
+                        (list(missing),),
+                    )
+                    rows = cur.fetchall()
+        except pg_errors.UndefinedColumn:
+            templates_column_missing()
+    templaters.update(cache_templaters(missing, rows))
+    return templaters
+
+
+def templates_column_missing() -> None:
+    global _templates_column
+    # apps/api migrations not applied yet: built-in rules only.
+    logger.warning("apps.path_templates does not exist; using built-in path templating only")
+    _templates_column = False
+
+
+def cache_templaters(app_uuids: set[str], rows: Iterable[tuple]) -> dict[str, Templater]:
+    """Templaters for ``app_uuids`` from their (id, path_templates) rows, cached."""
+    found: dict[str, Templater] = {app_uuid: DEFAULT_TEMPLATER for app_uuid in app_uuids}
+    for app_id, templates in rows:
+        if isinstance(templates, str):
+            templates = json.loads(templates)  # jsonb without a codec (asyncpg)
+        if templates:
+            found[str(app_id)] = Templater(templates)
+    _templater_cache.set_many(found)
+    return found
+
+
+def resolve_endpoints(records: Iterable[tuple[str, str, str, object]]) -> dict[tuple[str, str, str], str]:
+    """Endpoint ids for every (app, method, route) in a batch, via the cache.
+
+    ``records`` yields (app uuid, method, route, timestamp); a batch may span
+    any number of apps.
+    """
+    last_seen = endpoint_sightings(records)
+    endpoint_ids = _endpoint_cache.get_many(last_seen)
+    missing = {key: seen_at for key, seen_at in last_seen.items() if key not in endpoint_ids}
+    if missing:
+        with pg_conn() as conn:
+            with conn.cursor() as cur:
+                discovered = discover_endpoints(cur, missing)
+        _endpoint_cache.set_many(discovered)
+        endpoint_ids.update(discovered)
+    touch_endpoints(last_seen, endpoint_ids)
+    return endpoint_ids
+
+
+def endpoint_sightings(records: Iterable[tuple[str, str, str, object]]) -> dict[tuple[str, str, str], object]:
+    """Newest timestamp per (app, method, route) with a known method."""
+    last_seen: dict[tuple[str, str, str], object] = {}
+    for app_uuid, method, route, timestamp in records:
+        if method not in ALLOWED_METHODS:
+            continue
+        key = (app_uuid, method, route)
+        timestamp = as_utc(timestamp)
+        prev = last_seen.get(key)
+        if prev is None or timestamp > prev:
+            last_seen[key] = timestamp
+    return last_seen
+
+
+def touch_endpoints(last_seen: dict[tuple[str, str, str], object], endpoint_ids: dict[tuple[str, str, str], str]) -> None:
+    # Freshly created rows already carry their last_seen_at; the tracker's
+    # UPDATE skips them because it only ever moves the timestamp forward.
+    _last_seen.touch_many({
+        endpoint_id: last_seen[key] for key, endpoint_id in endpoint_ids.items()
+    })
+
+
+# --- public entrypoints ------------------------------------------------------
+# Each entrypoint validates, resolves ids (the only Postgres I/O, cached) and
+# builds rows with the helpers below; aio.py has the async twins.
+
+def check_batch(project_slug: str, records) -> bool:
+    """Validate batch size and project; False for an empty batch."""
     if len(records) > MAX_BATCH_SIZE:
         raise IngestError(422, "validation_error", f"Batch size exceeds maximum of {MAX_BATCH_SIZE}")
     if not records:
+        return False
+    validate_project_slug(project_slug, {r.project_slug for r in records})
+    return True
+
+
+def request_keys(records, app_uuids: list[str], templaters: dict[str, Templater]) -> list[tuple]:
+    """(app uuid, method, route) per request record."""
+    return [
+        (app_uuid, r.method.upper(), templaters[app_uuid](r.path))
+        for app_uuid, r in zip(app_uuids, records)
+    ]
+
+
+# Request and rollup rows are built with an empty endpoint_id and go through
+# check_rows first, so endpoints are discovered (and last_seen_at bumped)
+# with corrected timestamps, and never for rows the window rejects.
+_ROW_TIMESTAMP, _ROW_APP_ID, _ROW_ENDPOINT_ID, _ROW_METHOD, _ROW_PATH = 0, 1, 3, 5, 6
+
+
+def endpoint_keys(rows: list[tuple]) -> list[tuple]:
+    """(app uuid, method, route, timestamp) of checked request or rollup rows."""
+    return [(row[_ROW_APP_ID], row[_ROW_METHOD], row[_ROW_PATH], row[_ROW_TIMESTAMP]) for row in rows]
+
+
+def with_endpoint_ids(rows: list[tuple], endpoint_ids: dict) -> list[tuple]:
+    if not endpoint_ids:
+        return rows
+    return [
+        row[:_ROW_ENDPOINT_ID]
+        + (endpoint_ids.get((row[_ROW_APP_ID], row[_ROW_METHOD], row[_ROW_PATH]), ""),)
+        + row[_ROW_ENDPOINT_ID + 1:]
+        for row in rows
+    ]
+
+
+def request_rows(project_id: str, records, keys: list[tuple]) -> list[tuple]:
+    rows = []
+    for (app_uuid, method, route), r in zip(keys, records):
+        rows.append((
+            r.timestamp, app_uuid, project_id, "",
+            r.environment, method, route, r.status_code, r.response_time_ms,
+            r.request_size, r.response_size, r.ip_address, r.user_agent,
+            (r.consumer_id or "")[:256], (r.consumer_name or "")[:256],
+            (r.consumer_group or "")[:256],
+            _safe_payload(r.request_payload), _safe_payload(r.response_payload),
+            _safe_payload(r.request_headers), _safe_payload(r.response_headers),
+            (r.base_url or "")[:512],
+            _safe_trace_component(r.trace_id, 32), _safe_trace_component(r.span_id, 16),
+            r.path, 1 if r.rolled_up else 0, _safe_sample_rate(r.sample_rate),
+        ))
+    return rows
+
+
+def _sketch(bins, counts) -> tuple[list[int], list[int]] | None:
+    """Sorted, merged (bins, counts) of a rollup's latency sketch; None if malformed."""
+    if not bins or len(bins) != len(counts) or len(bins) > MAX_SKETCH_BINS:
+        return None
+    merged: dict[int, int] = {}
+    for b, c in zip(bins, counts):
+        if b not in _SKETCH_BIN_RANGE or c <= 0:
+            return None
+        merged[b] = merged.get(b, 0) + c
+    ordered = sorted(merged)
+    return ordered, [merged[b] for b in ordered]
+
+
+def rollup_rows(project_id: str, records, keys: list[tuple]) -> list[tuple]:
+    rows = []
+    for (app_uuid, method, route), r in zip(keys, records):
+        sketch = _sketch(r.latency_bins, r.latency_counts)
+        if sketch is None:
+            continue  # a bucket without a usable count; drop silently (telemetry)
+        bins, counts = sketch
+        rows.append((
+            r.timestamp, app_uuid, project_id, "",
+            r.environment, method, route, max(0, min(int(r.status_code or 0), 599)),
+            (r.consumer_group or "")[:256], sum(counts),
+            max(int(r.request_bytes or 0), 0), max(int(r.response_bytes or 0), 0),
+            bins, counts,
+        ))
+    return rows
+
+
+def log_rows(project_id: str, records, id_to_uuid: dict[str, str], templaters: dict[str, Templater]) -> list[tuple]:
+    rows = []
+    for r in records:
+        app_uuid = id_to_uuid[r.app_id]
+        rows.append((
+            r.timestamp, app_uuid, project_id,
+            (r.environment or "production").strip().lower(),
+            _normalize_log_level(r.level),
+            _safe_log_text(r.message, limit=MAX_LOG_MESSAGE_CHARS),
+            _safe_log_text(r.logger_name, limit=256),
+            _safe_log_text((r.endpoint_method or "").upper(), limit=16),
+            # Same route as the request it belongs to, so logs join their endpoint.
+            _safe_log_text(templaters[app_uuid](r.endpoint_path) if r.endpoint_path else "", limit=2048),
+            max(0, min(int(r.status_code or 0), 599)),
+            _safe_log_text(r.consumer_id, limit=256),
+            _safe_log_text(r.consumer_name, limit=256),
+            _safe_log_text(r.consumer_group, limit=256),
+            _safe_trace_component(r.trace_id, 32),
+            _safe_trace_component(r.span_id, 16),
+            _safe_log_text(r.payload, limit=MAX_LOG_PAYLOAD_CHARS),
+            json.dumps(_sanitize_log_attributes(r.attributes), separators=(",", ":")),
+        ))
+    return rows
+
+
+ALLOWED_SPAN_STATUSES = {"ok", "error"}
+
+
+def span_rows(project_id: str, records, id_to_uuid: dict[str, str]) -> list[tuple]:
+    rows = []
+    for r in records:
+        app_uuid = id_to_uuid[r.app_id]
+        trace_id = _safe_trace_component(r.trace_id, 32)
+        span_id = _safe_trace_component(r.span_id, 16)
+        if not trace_id or not span_id:
+            continue  # unusable without valid ids; drop silently (telemetry)
+        status = (r.status or "ok").strip().lower()
+        rows.append((
+            r.timestamp, app_uuid, project_id,
+            (r.environment or "production").strip().lower(),
+            trace_id, span_id,
+            _safe_trace_component(r.parent_span_id, 16),
+            _safe_log_text(r.name, limit=256),
+            _safe_log_text((r.kind or "internal").strip().lower(), limit=16),
+            _safe_log_text(r.service_name, limit=128),
+            max(float(r.duration_ms or 0.0), 0.0),
+            status if status in ALLOWED_SPAN_STATUSES else "ok",
+            max(0, min(int(r.status_code or 0), 599)),
+            json.dumps(_sanitize_log_attributes(r.attributes), separators=(",", ":")),
+            _safe_sample_rate(r.sample_rate),
+        ))
+    return rows
+
+
+def store_spans(rows: list[tuple]) -> None:
+    if _sampler is not None:
+        # Held until the trace is decided; see sampling.py.
+        _sampler.add(rows)
+    else:
+        _insert("api_spans", rows)
+
+
+def handle_requests(project_id: str, project_slug: str, records, clock_offset: float = 0.0) -> int:
+    if not check_batch(project_slug, records):
         return 0
 
-    validate_project_slug(project_slug, {r.project_slug for r in records})
+    with STAGE_SECONDS.time("resolve_apps"):
+        id_to_uuid = resolve_apps(project_id, {r.app_id for r in records})
+    # Rows from every app go into one block: app_id is a column, so a batch
+    # costs one INSERT however many apps it covers.
+    app_uuids = [id_to_uuid[r.app_id] for r in records]
+    keys = request_keys(records, app_uuids, app_templaters(set(app_uuids)))
+    rows = check_rows("api_requests", request_rows(project_id, records, keys), clock_offset)
+    with STAGE_SECONDS.time("resolve_endpoints"):
+        rows = with_endpoint_ids(rows, resolve_endpoints(endpoint_keys(rows)))
+    _insert("api_requests", rows)
+    return len(rows)
+
+
+def handle_logs(project_id: str, project_slug: str, records, clock_offset: float = 0.0) -> int:
+    if not check_batch(project_slug, records):
+        return 0
 
-    with pg_conn() as conn:
-        with conn.cursor() as cur:
-            id_to_uuid = resolve_app_identifiers(cur, project_id, {r.app_id for r in records})
-            by_app: dict[str, list] = defaultdict(list)
-            for r in records:
-                by_app[id_to_uuid[r.app_id]].append(r)
-
-    client = clickhouse()
-    ensure_clickhouse_schema(client)
-    total = 0
-    for app_uuid, recs in by_app.items():
-        rows = []
-        for r in recs:
-            trace_id = _safe_trace_component(r.trace_id, 32)
-            span_id = _safe_trace_component(r.span_id, 16)
-            if not trace_id or not span_id:
-                continue  # unusable without valid ids; drop silently (telemetry)
-            status = (r.status or "ok").strip().lower()
-            rows.append((
-                r.timestamp, app_uuid, project_id,
-                (r.environment or "production").strip().lower(),
-                trace_id, span_id,
-                _safe_trace_component(r.parent_span_id, 16),
-                _safe_log_text(r.name, limit=256),
-                _safe_log_text((r.kind or "internal").strip().lower(), limit=16),
-                _safe_log_text(r.service_name, limit=128),
-                max(float(r.duration_ms or 0.0), 0.0),
-                status if status in ALLOWED_SPAN_STATUSES else "ok",
-                max(0, min(int(r.status_code or 0), 599)),
-                json.dumps(_sanitize_log_attributes(r.attributes), separators=(",", ":")),
-            ))
-        if not rows:
-            continue
-        client.execute(
-            f"INSERT INTO api_spans ({', '.join(SPAN_COLUMNS)}) VALUES",
-            rows,
-        )
-        total += len(rows)
-    return total
+    with STAGE_SECONDS.time("resolve_apps"):
+        id_to_uuid = resolve_apps(project_id, {r.app_id for r in records})
+    templaters = app_templaters(set(id_to_uuid.values()))
+
+    rows = check_rows("api_logs", log_rows(project_id, records, id_to_uuid, templaters), clock_offset)
+    _insert("api_logs", rows)
+    return len(rows)
+
+
+def handle_spans(project_id: str, project_slug: str, records, clock_offset: float = 0.0) -> int:
+    if not check_batch(project_slug, records):
+        return 0
+
+    with STAGE_SECONDS.time("resolve_apps"):
+        id_to_uuid = resolve_apps(project_id, {r.app_id for r in records})
+
+    rows = check_rows("api_spans", span_rows(project_id, records, id_to_uuid), clock_offset)
+    store_spans(rows)
+    return len(rows)
+
+
+def handle_rollups(project_id: str, project_slug: str, records, clock_offset: float = 0.0) -> int:
+    if not check_batch(project_slug, records):
+        return 0
+
+    with STAGE_SECONDS.time("resolve_apps"):
+        id_to_uuid = resolve_apps(project_id, {r.app_id for r in records})
+    # Same routes and endpoints as raw requests, so both land on one endpoint.
+    app_uuids = [id_to_uuid[r.app_id] for r in records]
+    keys = request_keys(records, app_uuids, app_templaters(set(app_uuids)))
+    rows = check_rows("api_request_rollups", rollup_rows(project_id, records, keys), clock_offset)
+    with STAGE_SECONDS.time("resolve_endpoints"):
+        rows = with_endpoint_ids(rows, resolve_endpoints(endpoint_keys(rows)))
+    _insert("api_request_rollups", rows)
+    return len(rows)
+
+
+def handle_batch(project_id: str, project_slug: str, batch, clock_offset: float = 0.0) -> dict[str, int]:
+    """``/v1/batch``: requests, logs and spans with one app resolution.
+
+    Returns the accepted count per table. Every app is resolved and every row
+    built before anything is enqueued, and the three blocks are enqueued
+    together (see ``_insert_all``), so an unknown app or a full buffer rejects
+    the whole upload and the SDK's retry doesn't store any table twice.
+    Without ``APILENS_INGEST_BUFFER`` the blocks are inserted one after
+    another and a failed insert can follow an accepted one, unless the spool
+    takes the rest.
+    """
+    signals = (batch.requests, batch.logs, batch.spans)
+    present = [check_batch(project_slug, records) for records in signals]
+    accepted = dict.fromkeys(BATCH_TABLES, 0)
+    if not any(present):
+        return accepted
+    requests, logs, spans = signals
+
+    with STAGE_SECONDS.time("resolve_apps"):
+        id_to_uuid = resolve_apps(project_id, {r.app_id for records in signals for r in records})
+    app_uuids = [id_to_uuid[r.app_id] for r in requests]
+    templaters = app_templaters(set(app_uuids) | {id_to_uuid[r.app_id] for r in logs})
+    keys = request_keys(requests, app_uuids, templaters)
+    request_block = check_rows("api_requests", request_rows(project_id, requests, keys), clock_offset)
+    with STAGE_SECONDS.time("resolve_endpoints"):
+        request_block = with_endpoint_ids(request_block, resolve_endpoints(endpoint_keys(request_block)))
+    log_block = check_rows("api_logs", log_rows(project_id, logs, id_to_uuid, templaters), clock_offset)
+    span_block = check_rows("api_spans", span_rows(project_id, spans, id_to_uuid), clock_offset)
+    blocks = [("api_requests", request_block), ("api_logs", log_block)]
+    if _sampler is not None:
+        # Held until the trace is decided; never refused.
+        _insert_all(blocks)
+        _sampler.add(span_block)
+    else:
+        _insert_all(blocks + [("api_spans", span_block)])
+    accepted.update(api_requests=len(request_block), api_logs=len(log_block), api_spans=len(span_block))
+    return accepted
@@ -0,0 +1,82 @@
+"""Debounced ``endpoints.last_seen_at`` bookkeeping.
+
+Bumping ``last_seen_at`` on every batch turns the hottest endpoint rows into a
+row-lock hot spot when several workers ingest for the same app. Instead each
+process keeps the newest sighting per endpoint in memory and a background
+thread writes them all in one bulk UPDATE every ``interval`` seconds. The
+dashboard only reads last_seen_at at minute granularity, so the staleness is
+invisible.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Callable
+
+logger = logging.getLogger("apilens.ingest.last_seen")
+
+FlushFn = Callable[[dict[str, object]], None]
+
+
+def as_utc(ts: datetime) -> datetime:
+    """``ts`` as an aware UTC datetime; naive values (no offset sent) are UTC.
+
+    Senders mix ``...Z`` and offset-less timestamps, and naive and aware
+    datetimes don't compare.
+    """
+    if ts.tzinfo is None:
+        return ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc)
+
+
+class LastSeenTracker:
+    """Newest-sighting map per endpoint id, flushed periodically by a thread."""
+
+    def __init__(self, interval: float, flush: FlushFn) -> None:
+        self.interval = interval
+        self._flush = flush
+        self._pending: dict[str, object] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def touch_many(self, seen: dict[str, object]) -> None:
+        with self._lock:
+            pending = self._pending
+            for endpoint_id, seen_at in seen.items():
+                seen_at = as_utc(seen_at)
+                prev = pending.get(endpoint_id)
+                if prev is None or seen_at > prev:
+                    pending[endpoint_id] = seen_at
+
+    def flush(self) -> int:
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        try:
+            self._flush(batch)
+        except Exception as exc:
+            logger.warning("last_seen_at flush failed (%d endpoints), will retry: %s", len(batch), exc)
+            self.touch_many(batch)
+            return 0
+        return len(batch)
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="ingest-last-seen")
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.flush()
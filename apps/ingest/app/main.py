@@ -8,24 +8,83 @@ carry app_id. Writes to the shared Postgres (endpoints) + ClickHouse stores.
 from __future__ import annotations
 
 import logging
+from functools import partial
 
-from fastapi import Depends, FastAPI, Header
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, Header, Request, Response
+from fastapi.openapi.utils import get_openapi
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 
-from .auth import authenticate
-from .db import clickhouse, init_postgres_pool
-from .ingest import IngestError, ensure_clickhouse_schema, handle_logs, handle_requests, handle_spans
+from . import auth
+from .auth import auth_stats, authenticate
+from .config import load_async, load_metrics
+from .db import clickhouse, close_async_pools, init_async_pools, init_postgres_pool, pool_stats
+from .decoding import json_body, openapi_body, openapi_schemas
+from .encoding import IngestRoute, NdjsonRoute
+from .ingest import (
+    IngestError,
+    ensure_clickhouse_schema,
+    handle_batch,
+    handle_logs,
+    handle_requests,
+    handle_rollups,
+    handle_spans,
+    sampler_stats,
+    spool_stats,
+    start_last_seen_tracker,
+    start_writers,
+    stop_last_seen_tracker,
+    stop_writers,
+    writer_project_stats,
+    writer_stats,
+)
+from . import idempotency, metrics, ratelimit, timestamps
+from .ndjson import ingest_ndjson
 from .schemas import (
+    IngestBatchRequest,
+    IngestBatchResponse,
     IngestLogsRequest,
     IngestLogsResponse,
     IngestRequest,
     IngestResponse,
+    IngestRollupsRequest,
+    IngestRollupsResponse,
     IngestSpansRequest,
     IngestSpansResponse,
+    LogRecord,
+    RequestRecord,
+    SpanRecord,
 )
 
 logger = logging.getLogger("apilens.ingest")
 
+_async_cfg = load_async()
+# Entrypoint per table: the async twins (aio.py) when APILENS_INGEST_ASYNC is
+# on, else the sync ones, which endpoints run in the threadpool.
+_HANDLERS = {
+    "api_requests": handle_requests,
+    "api_logs": handle_logs,
+    "api_spans": handle_spans,
+    "api_request_rollups": handle_rollups,
+    "batch": handle_batch,
+}
+if _async_cfg.enabled:
+    from . import aio
+
+    _HANDLERS = {
+        "api_requests": aio.handle_requests,
+        "api_logs": aio.handle_logs,
+        "api_spans": aio.handle_spans,
+        "api_request_rollups": aio.handle_rollups,
+        "batch": aio.handle_batch,
+    }
+
+# Sent on every JSON ingest response so SDKs can discover optional endpoints:
+# "batch" means /v1/batch takes requests, logs and spans in one upload;
+# "rollups" means /v1/rollups takes pre-aggregated request rollups.
+FEATURES_HEADER = "APILens-Features"
+FEATURES = "batch,rollups"
+
 app = FastAPI(
     title="APILens Ingest API",
     version="1.0.0",
@@ -33,6 +92,30 @@ app = FastAPI(
     docs_url="/v1/docs",
     openapi_url="/v1/openapi.json",
 )
+# Every route accepts gzip/deflate/zstd request bodies (see encoding.py).
+app.router.route_class = IngestRoute
+
+
+def _openapi() -> dict:
+    # Ingest bodies are decoded by a dependency (decoding.py), so FastAPI
+    # doesn't register their schemas; add them for the $refs in openapi_body.
+    if app.openapi_schema is None:
+        schema = get_openapi(
+            title=app.title,
+            version=app.version,
+            description=app.description,
+            routes=app.routes,
+        )
+        schema.setdefault("components", {}).setdefault("schemas", {}).update(
+            openapi_schemas(
+                [IngestRequest, IngestLogsRequest, IngestSpansRequest, IngestBatchRequest, IngestRollupsRequest]
+            )
+        )
+        app.openapi_schema = schema
+    return app.openapi_schema
+
+
+app.openapi = _openapi
 
 
 @app.on_event("startup")
@@ -42,18 +125,130 @@ def _startup() -> None:
         ensure_clickhouse_schema(clickhouse())
     except Exception as exc:  # non-fatal: base schema is owned by apps/api
         logger.warning("ClickHouse schema ensure skipped at startup: %s", exc)
+    start_writers()
+    start_last_seen_tracker()
+
 
+@app.on_event("startup")
+async def _startup_async() -> None:
+    if _async_cfg.enabled:
+        await init_async_pools(_async_cfg)
+
+
+@app.on_event("shutdown")
+def _shutdown() -> None:
+    # Buffered rows and last_seen_at sightings are only in memory: drain them
+    # before the worker exits.
+    stop_writers()
+    stop_last_seen_tracker()
+
+
+@app.on_event("shutdown")
+async def _shutdown_async() -> None:
+    await close_async_pools()
 
-def require_project(x_api_key: str | None = Header(default=None, alias="X-API-Key")) -> tuple[str, str]:
-    ctx = authenticate(x_api_key or "")
+
+async def require_project(x_api_key: str | None = Header(default=None, alias="X-API-Key")) -> tuple[str, str]:
+    with metrics.STAGE_SECONDS.time("auth"):
+        ctx = auth.cached(x_api_key or "")
+        if ctx is auth.MISS:
+            # Introspection is a blocking HTTP call; only cache misses pay it.
+            ctx = await run_in_threadpool(authenticate, x_api_key or "")
     if ctx is None:
         raise IngestError(401, "authentication_error", "Authentication required")
     return ctx
 
 
+def _content_length(request: Request) -> int:
+    value = request.headers.get("content-length", "")
+    return int(value) if value.isdigit() else 0
+
+
+_TABLES = {
+    "/v1/requests": "api_requests",
+    "/v1/logs": "api_logs",
+    "/v1/traces": "api_spans",
+    "/v1/rollups": "api_request_rollups",
+    "/v1/batch": "batch",
+}
+
+
+async def _rate(fn, *args):
+    # Shared (Redis) buckets cost a network round trip: keep them off the loop.
+    if ratelimit.is_shared():
+        return await run_in_threadpool(fn, *args)
+    return fn(*args)
+
+
+async def admit_project(request: Request, ctx: tuple[str, str] = Depends(require_project)) -> tuple[str, str]:
+    """require_project plus per-project admission, before the body is read."""
+    content_length = _content_length(request)
+    await _rate(ratelimit.admit, ctx[0], content_length)
+    metrics.record_accepted(_TABLES.get(request.url.path, ""), ctx[0], 0, content_length)
+    return ctx
+
+
+def _charge(project_id: str, table: str, records: int, nbytes: int = 0) -> float:
+    metrics.record_accepted(table, project_id, records, nbytes)
+    return ratelimit.charge(project_id, records, nbytes)
+
+
+def _charge_result(project_id: str, table: str, accepted: idempotency.Result) -> None:
+    if isinstance(accepted, int):
+        _charge(project_id, table, accepted)
+        return
+    # /v1/batch: counted per table, charged to the bucket once.
+    for name, records in accepted.items():
+        metrics.record_accepted(name, project_id, records)
+    ratelimit.charge(project_id, sum(accepted.values()), 0)
+
+
+def ndjson_meter(request: Request, project_id: str, table: str):
+    # Bytes were charged from Content-Length at admission when it was sent;
+    # a chunked stream is charged as its lines are processed instead.
+    sized = _content_length(request) > 0
+    return lambda records, nbytes: _charge(project_id, table, records, 0 if sized else nbytes)
+
+
+def _clock_offset(request: Request) -> float:
+    # Taken before the body is processed, so a long NDJSON stream's later
+    # chunks aren't shifted by the time spent reading it.
+    return timestamps.clock_offset(request.headers.get(timestamps.SENT_AT_HEADER))
+
+
+async def _accept(request: Request, response: Response, ctx: tuple[str, str], table: str, records):
+    """Ingest a decoded JSON batch, at most once per Idempotency-Key (see idempotency.py)."""
+    project_id, project_slug = ctx
+    handle = partial(_HANDLERS[table], project_id, project_slug, records, clock_offset=_clock_offset(request))
+    key = request.headers.get(idempotency.HEADER)
+    response.headers[FEATURES_HEADER] = FEATURES
+    if _async_cfg.enabled:
+        async def run() -> idempotency.Result:
+            accepted = await handle()
+            await _rate(_charge_result, project_id, table, accepted)
+            return accepted
+
+        accepted, replayed = await idempotency.once_async(project_id, table, key, run)
+    else:
+        def run() -> idempotency.Result:
+            accepted = handle()
+            _charge_result(project_id, table, accepted)
+            return accepted
+
+        accepted, replayed = await run_in_threadpool(idempotency.once, project_id, table, key, run)
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+        metrics.IDEMPOTENT_REPLAYS.inc(table)
+    return accepted
+
+
 @app.exception_handler(IngestError)
 def _ingest_error_handler(_request, exc: IngestError) -> JSONResponse:
-    return JSONResponse(status_code=exc.status_code, content={"error": exc.error, "detail": exc.detail})
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"error": exc.error, "detail": exc.detail},
+        headers=exc.headers,
+    )
 
 
 @app.exception_handler(Exception)
@@ -64,25 +259,234 @@ def _unhandled_handler(_request, exc: Exception) -> JSONResponse:
 
 @app.get("/v1/health", tags=["System"])
 def health() -> dict:
-    return {"status": "healthy", "service": "apilens-ingest"}
+    return {
+        "status": "healthy",
+        "service": "apilens-ingest",
+        "writers": writer_stats(),
+        "spool": spool_stats(),
+        "trace_sampling": sampler_stats(),
+        "idempotency": idempotency.stats(),
+        "auth": auth_stats(),
+    }
+
+
+_metrics_cfg = load_metrics()
+
+
+def _collect_stats():
+    """Scrape-time gauges from the writers, spool, trace sampler, auth cache and pools."""
+    writers = writer_stats()
+    for key, kind, help in (
+        ("pending_rows", "gauge", "Rows buffered or in flight per table writer."),
+        ("pending_bytes", "gauge", "Approximate bytes buffered per table writer."),
+        ("oldest_age_seconds", "gauge", "Age of the oldest buffered row per table writer."),
+        ("flushed_rows", "counter", "Rows written to ClickHouse by the table writer."),
+        ("failed_blocks", "counter", "INSERT blocks that failed and were requeued."),
+        ("rejected_rows", "counter", "Rows refused because the writer buffer was full."),
+    ):
+        name = f"apilens_ingest_writer_{key}" if kind == "gauge" else f"apilens_ingest_writer_{key}_total"
+        yield name, help, kind, ("table",), {(t,): st[key] for t, st in writers.items()}
+    # Projects past the label budget share "other": its age is the max, its rows the sum.
+    ages: dict[tuple[str, str], float] = {}
+    pending: dict[tuple[str, str], float] = {}
+    for table, projects in writer_project_stats().items():
+        for project_id, st in projects.items():
+            key = (table, metrics.project_label(project_id))
+            ages[key] = max(ages.get(key, 0.0), st["oldest_age_seconds"])
+            pending[key] = pending.get(key, 0) + st["pending_rows"]
+    yield (
+        "apilens_ingest_writer_project_queue_age_seconds",
+        "Age of the oldest buffered row per table writer and project.",
+        "gauge", ("table", "project"), ages,
+    )
+    yield (
+        "apilens_ingest_writer_project_pending_rows",
+        "Rows buffered per table writer and project.",
+        "gauge", ("table", "project"), pending,
+    )
+    spool = spool_stats()
+    if spool is not None:
+        yield "apilens_ingest_circuit_open", "1 while the ClickHouse circuit breaker is open.", "gauge", (), {
+            (): float(spool["circuit_open"]),
+        }
+        yield "apilens_ingest_spool_bytes", "Bytes waiting in the spool per table.", "gauge", ("table",), {
+            (t,): st["bytes"] for t, st in spool["tables"].items()
+        }
+        yield (
+            "apilens_ingest_spool_dead_rows_total",
+            "Spooled rows moved to a .dead file after failing replay, per table.",
+            "counter", ("table",), {(t,): st["dead_rows"] for t, st in spool["tables"].items()},
+        )
+    sampler = sampler_stats()
+    if sampler is not None:
+        yield "apilens_ingest_trace_buffer_spans", "Spans held for a tail-sampling decision.", "gauge", (), {
+            (): sampler["spans"],
+        }
+        yield "apilens_ingest_trace_buffer_traces", "Traces held for a tail-sampling decision.", "gauge", (), {
+            (): sampler["traces"],
+        }
+    auth = auth_stats()
+    yield "apilens_ingest_auth_lookups_total", "API-key lookups by cache outcome.", "counter", ("outcome",), {
+        (k,): auth[k] for k in ("hits", "stale_hits", "misses", "coalesced", "errors")
+    }
+    yield "apilens_ingest_auth_cache_entries", "Cached API keys.", "gauge", (), {(): auth["entries"]}
+    pools = pool_stats()
+    yield "apilens_ingest_pool_connections", "Connections per pool and state.", "gauge", ("pool", "state"), {
+        (pool, state): value for pool, st in pools.items() for state, value in st.items()
+    }
+
+
+metrics.register_collector(_collect_stats)
+
+
+@app.get("/v1/metrics", tags=["System"], response_class=PlainTextResponse)
+def metrics_endpoint(authorization: str | None = Header(default=None)) -> PlainTextResponse:
+    if not _metrics_cfg.enabled:
+        raise IngestError(404, "not_found", "Metrics are disabled")
+    if _metrics_cfg.token and authorization != f"Bearer {_metrics_cfg.token}":
+        raise IngestError(401, "authentication_error", "Authentication required")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def ndjson_route(path: str, response_model):
+    """Register the streaming NDJSON twin of a JSON ingest endpoint.
+
+    Same path and method; :class:`NdjsonRoute` only matches NDJSON bodies.
+    Documented on the JSON operation via ``openapi_body``.
+    """
+
+    def decorator(endpoint):
+        app.router.add_api_route(
+            path,
+            endpoint,
+            methods=["POST"],
+            response_model=response_model,
+            include_in_schema=False,
+            route_class_override=NdjsonRoute,
+        )
+        return endpoint
+
+    return decorator
+
+
+@app.post(
+    "/v1/requests",
+    response_model=IngestResponse,
+    tags=["Ingest"],
+    openapi_extra=openapi_body(IngestRequest, RequestRecord),
+)
+async def ingest_requests(
+    request: Request,
+    response: Response,
+    ctx: tuple[str, str] = Depends(admit_project),
+    data: IngestRequest = Depends(json_body(IngestRequest)),
+) -> IngestResponse:
+    accepted = await _accept(request, response, ctx, "api_requests", data.requests)
+    return IngestResponse(accepted=accepted)
 
 
-@app.post("/v1/requests", response_model=IngestResponse, tags=["Ingest"])
-def ingest_requests(data: IngestRequest, ctx: tuple[str, str] = Depends(require_project)) -> IngestResponse:
+@ndjson_route("/v1/requests", IngestResponse)
+async def ingest_requests_ndjson(request: Request, ctx: tuple[str, str] = Depends(admit_project)) -> IngestResponse:
     project_id, project_slug = ctx
-    accepted = handle_requests(project_id, project_slug, data.requests)
+    accepted = await ingest_ndjson(
+        request,
+        RequestRecord,
+        partial(_HANDLERS["api_requests"], project_id, project_slug, clock_offset=_clock_offset(request)),
+        ndjson_meter(request, project_id, "api_requests"),
+    )
     return IngestResponse(accepted=accepted)
 
 
-@app.post("/v1/logs", response_model=IngestLogsResponse, tags=["Ingest"])
-def ingest_logs(data: IngestLogsRequest, ctx: tuple[str, str] = Depends(require_project)) -> IngestLogsResponse:
+@app.post(
+    "/v1/logs",
+    response_model=IngestLogsResponse,
+    tags=["Ingest"],
+    openapi_extra=openapi_body(IngestLogsRequest, LogRecord),
+)
+async def ingest_logs(
+    request: Request,
+    response: Response,
+    ctx: tuple[str, str] = Depends(admit_project),
+    data: IngestLogsRequest = Depends(json_body(IngestLogsRequest)),
+) -> IngestLogsResponse:
+    accepted = await _accept(request, response, ctx, "api_logs", data.logs)
+    return IngestLogsResponse(accepted=accepted)
+
+
+@ndjson_route("/v1/logs", IngestLogsResponse)
+async def ingest_logs_ndjson(request: Request, ctx: tuple[str, str] = Depends(admit_project)) -> IngestLogsResponse:
     project_id, project_slug = ctx
-    accepted = handle_logs(project_id, project_slug, data.logs)
+    accepted = await ingest_ndjson(
+        request,
+        LogRecord,
+        partial(_HANDLERS["api_logs"], project_id, project_slug, clock_offset=_clock_offset(request)),
+        ndjson_meter(request, project_id, "api_logs"),
+    )
     return IngestLogsResponse(accepted=accepted)
 
 
-@app.post("/v1/traces", response_model=IngestSpansResponse, tags=["Ingest"])
-def ingest_spans(data: IngestSpansRequest, ctx: tuple[str, str] = Depends(require_project)) -> IngestSpansResponse:
+@app.post(
+    "/v1/traces",
+    response_model=IngestSpansResponse,
+    tags=["Ingest"],
+    openapi_extra=openapi_body(IngestSpansRequest, SpanRecord),
+)
+async def ingest_spans(
+    request: Request,
+    response: Response,
+    ctx: tuple[str, str] = Depends(admit_project),
+    data: IngestSpansRequest = Depends(json_body(IngestSpansRequest)),
+) -> IngestSpansResponse:
+    accepted = await _accept(request, response, ctx, "api_spans", data.spans)
+    return IngestSpansResponse(accepted=accepted)
+
+
+@ndjson_route("/v1/traces", IngestSpansResponse)
+async def ingest_spans_ndjson(request: Request, ctx: tuple[str, str] = Depends(admit_project)) -> IngestSpansResponse:
     project_id, project_slug = ctx
-    accepted = handle_spans(project_id, project_slug, data.spans)
+    accepted = await ingest_ndjson(
+        request,
+        SpanRecord,
+        partial(_HANDLERS["api_spans"], project_id, project_slug, clock_offset=_clock_offset(request)),
+        ndjson_meter(request, project_id, "api_spans"),
+    )
     return IngestSpansResponse(accepted=accepted)
+
+
+@app.post(
+    "/v1/rollups",
+    response_model=IngestRollupsResponse,
+    tags=["Ingest"],
+    openapi_extra=openapi_body(IngestRollupsRequest),
+)
+async def ingest_rollups(
+    request: Request,
+    response: Response,
+    ctx: tuple[str, str] = Depends(admit_project),
+    data: IngestRollupsRequest = Depends(json_body(IngestRollupsRequest)),
+) -> IngestRollupsResponse:
+    """Per-minute request rollups from SDKs in rollup mode."""
+    accepted = await _accept(request, response, ctx, "api_request_rollups", data.rollups)
+    return IngestRollupsResponse(accepted=accepted)
+
+
+@app.post(
+    "/v1/batch",
+    response_model=IngestBatchResponse,
+    tags=["Ingest"],
+    openapi_extra=openapi_body(IngestBatchRequest),
+)
+async def ingest_batch(
+    request: Request,
+    response: Response,
+    ctx: tuple[str, str] = Depends(admit_project),
+    data: IngestBatchRequest = Depends(json_body(IngestBatchRequest)),
+) -> IngestBatchResponse:
+    """Requests, logs and spans in one upload: one auth, one app resolution."""
+    accepted = await _accept(request, response, ctx, "batch", data)
+    return IngestBatchResponse(
+        accepted=sum(accepted.values()),
+        requests=accepted["api_requests"],
+        logs=accepted["api_logs"],
+        spans=accepted["api_spans"],
+    )
@@ -0,0 +1,250 @@
+"""Prometheus metrics for the ingest service, served at ``/v1/metrics``.
+
+Everything on the request path is pre-aggregated in memory: a counter is a
+dict of floats and a histogram a list of bucket counts per label set, each
+behind one short lock. A scrape renders the text exposition format from that
+state and asks the registered collectors for point-in-time gauges (writer
+queues, pools, caches), so nothing is computed per request beyond a
+``perf_counter()`` pair and a bisect.
+
+Metrics are per process: with several gunicorn workers each one answers for
+itself, so scrape every worker or aggregate by instance in Prometheus.
+Project ids are a label on the throughput counters, bounded by
+``APILENS_INGEST_METRICS_MAX_PROJECTS`` (later projects report as "other").
+"""
+
+from __future__ import annotations
+
+import logging
+import math
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+from .config import load_metrics
+
+logger = logging.getLogger("apilens.ingest.metrics")
+
+_cfg = load_metrics()
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ROW_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10_000, 50_000, 100_000, 500_000)
+
+OTHER_PROJECT = "other"
+
+# (name, help, type, label names, {label values: value}) from a collector.
+Family = tuple[str, str, str, tuple[str, ...], dict[tuple[str, ...], float]]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        if not _cfg.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_labels(self.labels, k)} {_number(v)}" for k, v in values)
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Per label set: one (non-cumulative) count per bucket, then +Inf, then the sum.
+        self._series: dict[tuple[str, ...], list[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        if not _cfg.enabled:
+            return
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0.0] * (len(self.buckets) + 2)
+            series[idx] += 1
+            series[-1] += value
+
+    def time(self, *labels: str) -> "_Timer":
+        """``with hist.time("stage"):`` observes the block's wall time."""
+        return _Timer(self, labels)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            series = [(k, list(v)) for k, v in self._series.items()]
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, counts in series:
+            running = 0.0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                running += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {_number(running)}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_number(counts[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {_number(running)}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("_hist", "_labels", "_start")
+
+    def __init__(self, hist: Histogram, labels: tuple[str, ...]) -> None:
+        self._hist = hist
+        self._labels = labels
+
+    def __enter__(self) -> None:
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc) -> None:
+        self._hist.observe(time.perf_counter() - self._start, *self._labels)
+
+
+STAGE_SECONDS = Histogram(
+    "apilens_ingest_stage_seconds",
+    "Time spent per ingest stage (read, auth, decode, resolve_apps, resolve_endpoints, enqueue).",
+    ("stage",),
+)
+REQUEST_SECONDS = Histogram(
+    "apilens_ingest_request_seconds",
+    "End-to-end handling time of ingest requests.",
+    ("route", "status"),
+)
+INSERT_SECONDS = Histogram(
+    "apilens_ingest_insert_seconds",
+    "ClickHouse INSERT round trip per block.",
+    ("table",),
+)
+INSERT_ROWS = Histogram(
+    "apilens_ingest_insert_block_rows",
+    "Rows per ClickHouse INSERT block.",
+    ("table",),
+    buckets=ROW_BUCKETS,
+)
+RECORDS = Counter(
+    "apilens_ingest_records_total",
+    "Records accepted, per table and project.",
+    ("table", "project"),
+)
+BYTES = Counter(
+    "apilens_ingest_received_bytes_total",
+    "Request body bytes admitted (Content-Length; decompressed line bytes for chunked NDJSON).",
+    ("table", "project"),
+)
+ERRORS = Counter(
+    "apilens_ingest_errors_total",
+    "Failed ingest requests by error code (IngestError.error).",
+    ("error",),
+)
+INSERT_ERRORS = Counter(
+    "apilens_ingest_insert_errors_total",
+    "Failed ClickHouse INSERT attempts.",
+    ("table",),
+)
+TRACE_DECISIONS = Counter(
+    "apilens_ingest_trace_decisions_total",
+    "Tail-sampling decisions per trace (error, slow, rare, sampled, dropped).",
+    ("decision",),
+)
+IDEMPOTENT_REPLAYS = Counter(
+    "apilens_ingest_idempotent_replays_total",
+    "Batches answered from the Idempotency-Key index instead of being ingested again.",
+    ("table",),
+)
+WRITER_SHED_ROWS = Counter(
+    "apilens_ingest_writer_shed_rows_total",
+    "Rows a full project queue refused (rejected) or evicted (dropped) per table writer.",
+    ("table", "project", "reason"),
+)
+TIMESTAMP_CORRECTIONS = Counter(
+    "apilens_ingest_timestamp_corrections_total",
+    "Rows whose timestamp was clamped, rejected or restamped for the sanity window, or shifted for clock skew.",
+    ("table", "project", "action"),
+)
+
+_METRICS: list[Counter | Histogram] = [
+    STAGE_SECONDS, REQUEST_SECONDS, INSERT_SECONDS, INSERT_ROWS, RECORDS, BYTES, ERRORS, INSERT_ERRORS,
+    TRACE_DECISIONS, IDEMPOTENT_REPLAYS, WRITER_SHED_ROWS, TIMESTAMP_CORRECTIONS,
+]
+_collectors: list[Callable[[], Iterable[Family]]] = []
+
+_projects: set[str] = set()
+_projects_lock = threading.Lock()
+
+
+def project_label(project_id: str) -> str:
+    """``project_id`` while under the label budget, else "other"."""
+    if project_id in _projects:
+        return project_id
+    with _projects_lock:
+        if len(_projects) < _cfg.max_projects:
+            _projects.add(project_id)
+            return project_id
+    return OTHER_PROJECT
+
+
+def record_accepted(table: str, project_id: str, records: int, nbytes: int = 0) -> None:
+    project = project_label(project_id)
+    if records:
+        RECORDS.inc(table, project, amount=records)
+    if nbytes:
+        BYTES.inc(table, project, amount=nbytes)
+
+
+def register_collector(collect: Callable[[], Iterable[Family]]) -> None:
+    """Add a scrape-time source of gauges/counters (e.g. pool or queue stats)."""
+    _collectors.append(collect)
+
+
+def _render_family(family: Family) -> list[str]:
+    name, help, kind, names, values = family
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{_labels(names, k)} {_number(v)}" for k, v in values.items())
+    return lines
+
+
+def render() -> str:
+    """The Prometheus text exposition (format 0.0.4) of every metric."""
+    lines: list[str] = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        try:
+            for family in collect():
+                lines.extend(_render_family(family))
+        except Exception:
+            logger.exception("Metrics collector %r failed", collect)
+    lines.append("")
+    return "\n".join(lines)
@@ -0,0 +1,160 @@
+"""Streaming ``application/x-ndjson`` variants of the ingest endpoints.
+
+The JSON endpoints make FastAPI read the whole body and build every pydantic
+model before ``handle_*`` runs, so peak memory follows the largest batch. An
+NDJSON body carries one record per line instead; lines are read off the
+(already decompressed) request stream, validated one by one and handed to the
+same ``handle_*`` entrypoints in chunks of ``APILENS_INGEST_NDJSON_CHUNK_RECORDS``,
+so memory per request stays constant and a backfill can be streamed in one
+request.
+
+Records are accepted chunk by chunk. On the first invalid line the records
+before it are still inserted and the request fails with 422 naming the line
+and how many records were accepted, so a client can resume from there. The
+same goes for the project's rate limit: once a chunk exhausts it, the stream
+is cut with 429 + Retry-After at the next line.
+"""
+
+from __future__ import annotations
+
+import inspect
+import time
+from typing import AsyncIterator, Awaitable, Callable
+
+from fastapi import Request
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+from .config import BodyLimits, load_body_limits
+from .decoding import DecodeError, decode
+from .ingest import IngestError
+from .metrics import STAGE_SECONDS
+from .ratelimit import rate_limited
+
+NDJSON_MEDIA_TYPES = frozenset({"application/x-ndjson", "application/jsonl"})
+
+HandleFn = Callable[[list], int] | Callable[[list], Awaitable[int]]
+# (records, bytes) of a processed chunk -> seconds the project is over its limit
+MeterFn = Callable[[int, int], float]
+
+
+def is_ndjson(content_type: str) -> bool:
+    return content_type.split(";", 1)[0].strip().lower() in NDJSON_MEDIA_TYPES
+
+
+async def iter_lines(request: Request, limits: BodyLimits) -> AsyncIterator[tuple[int, bytes]]:
+    """Yield ``(line_number, line)`` for every non-blank line of the body."""
+    buf = bytearray()
+    lineno = 0
+    total = 0
+    max_line = limits.ndjson_max_line_bytes
+    async for chunk in request.stream():
+        total += len(chunk)
+        if total > limits.max_stream_bytes:
+            raise IngestError(413, "payload_too_large", f"Body exceeds {limits.max_stream_bytes} bytes")
+        buf += chunk
+        start = 0
+        while True:
+            end = buf.find(b"\n", start)
+            if end < 0:
+                break
+            lineno += 1
+            if end - start > max_line:
+                raise IngestError(413, "payload_too_large", f"Line {lineno} exceeds {max_line} bytes")
+            line = bytes(buf[start:end]).strip()
+            start = end + 1
+            if line:
+                yield lineno, line
+        del buf[:start]
+        if len(buf) > max_line:
+            raise IngestError(413, "payload_too_large", f"Line {lineno + 1} exceeds {max_line} bytes")
+    line = bytes(buf).strip()
+    if line:
+        yield lineno + 1, line
+
+
+def _describe(exc: DecodeError) -> str:
+    err = exc.errors[0]
+    loc = ".".join(str(part) for part in err.get("loc", ()))
+    return f"{loc}: {err['msg']}" if loc else err["msg"]
+
+
+def _decode_lines(model: type[BaseModel], lines: list[tuple[int, bytes]]) -> tuple[list, tuple[int, DecodeError] | None]:
+    """Records up to the first invalid line, and that line's (number, error)."""
+    records = []
+    start = time.perf_counter()
+    for lineno, line in lines:
+        try:
+            records.append(decode(model, line))
+        except DecodeError as exc:
+            return records, (lineno, exc)
+    STAGE_SECONDS.observe(time.perf_counter() - start, "decode")
+    return records, None
+
+
+def _invalid_line(failure: tuple[int, DecodeError], accepted: int) -> IngestError:
+    lineno, exc = failure
+    return IngestError(
+        422,
+        "validation_error",
+        f"Line {lineno}: {_describe(exc)} ({accepted} records before it were accepted)",
+    )
+
+
+def _process(model: type[BaseModel], handle: HandleFn, lines: list[tuple[int, bytes]], accepted: int) -> int:
+    records, failure = _decode_lines(model, lines)
+    if failure is not None:
+        if records:
+            accepted += handle(records)
+        raise _invalid_line(failure, accepted) from failure[1]
+    return handle(records)
+
+
+async def _process_async(model: type[BaseModel], handle: HandleFn, lines: list[tuple[int, bytes]], accepted: int) -> int:
+    records, failure = _decode_lines(model, lines)
+    if failure is not None:
+        if records:
+            accepted += await handle(records)
+        raise _invalid_line(failure, accepted) from failure[1]
+    return await handle(records)
+
+
+async def ingest_ndjson(
+    request: Request, model: type[BaseModel], handle: HandleFn, meter: MeterFn | None = None
+) -> int:
+    """Stream an NDJSON body into ``handle`` in bounded chunks; returns records accepted.
+
+    A sync ``handle`` runs in the threadpool; an async one (aio.py) on the loop.
+    """
+    limits = load_body_limits()
+    if inspect.iscoroutinefunction(handle):
+        process = _process_async
+    else:
+        # Validation and the insert path are sync and CPU/IO bound: keep
+        # them off the event loop.
+        def process(*args) -> Awaitable[int]:
+            return run_in_threadpool(_process, *args)
+    accepted = 0
+    over_limit = 0.0
+    chunk: list[tuple[int, bytes]] = []
+    chunk_bytes = 0
+    async for lineno, line in iter_lines(request, limits):
+        if over_limit > 0:
+            raise rate_limited(
+                over_limit,
+                f"Project ingest rate limit reached at line {lineno} ({accepted} records before it were accepted)",
+            )
+        chunk.append((lineno, line))
+        chunk_bytes += len(line)
+        if len(chunk) >= limits.ndjson_chunk_records or chunk_bytes >= limits.ndjson_chunk_bytes:
+            done = await process(model, handle, chunk, accepted)
+            accepted += done
+            if meter is not None:
+                over_limit = await run_in_threadpool(meter, done, chunk_bytes)
+            chunk, chunk_bytes = [], 0
+    if chunk:
+        done = await process(model, handle, chunk, accepted)
+        accepted += done
+        if meter is not None:
+            await run_in_threadpool(meter, done, chunk_bytes)
+    return accepted
@@ -0,0 +1,183 @@
+"""Per-project admission control: token buckets in records/sec and bytes/sec.
+
+Each project has two buckets. A request is admitted while both still hold
+tokens, checked right after authentication and before the body is read, so
+an over-limit client gets a cheap 429 with ``Retry-After``. The actual cost
+is charged afterwards: bytes from Content-Length at admission, records once
+the body is decoded. A batch may take a bucket into debt, and the debt delays
+the project's next batches. Accepting the batch already parsed beats
+rejecting it and having the SDK resend the same bytes.
+
+Buckets live in this process by default. With ``APILENS_INGEST_RATE_REDIS_URL``
+they live in Redis (one hash per project, updated atomically by a Lua
+script), so the limit holds across every replica and worker. If Redis is
+unreachable, the local buckets take over until it's back.
+"""
+
+from __future__ import annotations
+
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from .config import RateLimitConfig, load_rate_limit
+from .ingest import IngestError
+
+logger = logging.getLogger("apilens.ingest.ratelimit")
+
+_REDIS_KEY = "apilens:ingest:rate:{project_id}"
+_REDIS_ERROR_LOG_INTERVAL = 60.0
+
+# KEYS[1] = bucket hash; ARGV = records_rate, records_burst, bytes_rate,
+# bytes_burst, records_cost, bytes_cost, force (1 = charge even if empty).
+# Returns seconds until both buckets are positive again (as a string).
+_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rr, rb, br, bb = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'r', 'b', 'ts')
+local r = tonumber(state[1]) or rb
+local b = tonumber(state[2]) or bb
+local ts = tonumber(state[3]) or now
+local dt = math.max(now - ts, 0)
+r = math.min(rb, r + dt * rr)
+b = math.min(bb, b + dt * br)
+local function wait(r, b)
+  local w = 0
+  if rr > 0 and r <= 0 then w = math.max(w, (1 - r) / rr) end
+  if br > 0 and b <= 0 then w = math.max(w, (1 - b) / br) end
+  return w
+end
+local w = wait(r, b)
+if w == 0 or ARGV[7] == '1' then
+  if rr > 0 then r = r - tonumber(ARGV[5]) end
+  if br > 0 then b = b - tonumber(ARGV[6]) end
+  w = wait(r, b)
+  if ARGV[7] ~= '1' then w = 0 end
+end
+redis.call('HSET', KEYS[1], 'r', r, 'b', b, 'ts', now)
+local full = 1
+if rr > 0 then full = math.max(full, (rb - r) / rr) end
+if br > 0 then full = math.max(full, (bb - b) / br) end
+redis.call('EXPIRE', KEYS[1], math.ceil(full) + 60)
+return tostring(w)
+"""
+
+
+class LocalBuckets:
+    """In-process buckets, LRU-bounded to ``max_projects``."""
+
+    def __init__(self, cfg: RateLimitConfig) -> None:
+        self.cfg = cfg
+        self._state: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _wait(self, r: float, b: float) -> float:
+        cfg = self.cfg
+        wait = 0.0
+        if cfg.records_per_sec > 0 and r <= 0:
+            wait = max(wait, (1 - r) / cfg.records_per_sec)
+        if cfg.bytes_per_sec > 0 and b <= 0:
+            wait = max(wait, (1 - b) / cfg.bytes_per_sec)
+        return wait
+
+    def take(self, project_id: str, records: float, nbytes: float, force: bool) -> float:
+        """Mirror of the Lua script: returns seconds to wait (0 = admitted)."""
+        cfg = self.cfg
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(project_id)
+            if state is None:
+                state = self._state[project_id] = [cfg.records_burst, cfg.bytes_burst, now]
+                while len(self._state) > cfg.max_projects:
+                    self._state.popitem(last=False)
+            else:
+                self._state.move_to_end(project_id)
+            dt = max(now - state[2], 0.0)
+            r = min(cfg.records_burst, state[0] + dt * cfg.records_per_sec)
+            b = min(cfg.bytes_burst, state[1] + dt * cfg.bytes_per_sec)
+            wait = self._wait(r, b)
+            if wait == 0 or force:
+                if cfg.records_per_sec > 0:
+                    r -= records
+                if cfg.bytes_per_sec > 0:
+                    b -= nbytes
+                wait = self._wait(r, b) if force else 0.0
+            state[0], state[1], state[2] = r, b, now
+            return wait
+
+
+class RedisBuckets:
+    """Buckets shared through Redis; falls back to ``LocalBuckets`` on errors."""
+
+    def __init__(self, cfg: RateLimitConfig, fallback: LocalBuckets) -> None:
+        import redis
+
+        self.cfg = cfg
+        self._fallback = fallback
+        self._client = redis.Redis.from_url(cfg.redis_url, socket_timeout=0.25, socket_connect_timeout=0.25)
+        self._script = self._client.register_script(_LUA)
+        self._last_error_log = 0.0
+
+    def take(self, project_id: str, records: float, nbytes: float, force: bool) -> float:
+        cfg = self.cfg
+        try:
+            wait = self._script(
+                keys=[_REDIS_KEY.format(project_id=project_id)],
+                args=[
+                    cfg.records_per_sec, cfg.records_burst, cfg.bytes_per_sec, cfg.bytes_burst,
+                    records, nbytes, 1 if force else 0,
+                ],
+            )
+            return float(wait)
+        except Exception as exc:
+            now = time.monotonic()
+            if now - self._last_error_log >= _REDIS_ERROR_LOG_INTERVAL:
+                self._last_error_log = now
+                logger.warning("Rate-limit Redis unavailable, using local buckets: %s", exc)
+            return self._fallback.take(project_id, records, nbytes, force)
+
+
+def _build():
+    cfg = load_rate_limit()
+    if not cfg.enabled:
+        return None
+    local = LocalBuckets(cfg)
+    if cfg.redis_url:
+        return RedisBuckets(cfg, local)
+    return local
+
+
+_buckets = _build()
+
+
+def rate_limited(wait: float, detail: str) -> IngestError:
+    return IngestError(
+        429,
+        "rate_limited",
+        detail,
+        headers={"Retry-After": str(max(1, math.ceil(wait)))},
+    )
+
+
+def is_shared() -> bool:
+    """True when buckets live in Redis (each call is a network round trip)."""
+    return isinstance(_buckets, RedisBuckets)
+
+
+def admit(project_id: str, content_length: int) -> None:
+    """Admission check before the body is read; raises 429 when exhausted."""
+    if _buckets is None:
+        return
+    wait = _buckets.take(project_id, 0, content_length, force=False)
+    if wait > 0:
+        raise rate_limited(wait, "Project ingest rate limit exceeded, retry later")
+
+
+def charge(project_id: str, records: int, nbytes: int = 0) -> float:
+    """Charge work already done; returns how long the project is now over."""
+    if _buckets is None or (not records and not nbytes):
+        return 0.0
+    return _buckets.take(project_id, records, nbytes, force=True)
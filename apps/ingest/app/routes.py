@@ -0,0 +1,87 @@
+"""Collapse concrete request paths into route templates at ingest.
+
+SDKs report the path as requested (``/v1/orders/8123/items``), so every id
+became its own endpoint row in Postgres and its own ``(method, path)`` group
+in ClickHouse. Before endpoint discovery each path is rewritten to its route:
+
+1. the app's own templates (``apps.path_templates``, set in the dashboard),
+   first match wins. ``{name}`` matches one segment and ``{name:path}`` the
+   rest of the path, e.g. ``/v1/files/{key:path}``;
+2. otherwise segment by segment: integers become ``{id}``, UUIDs ``{uuid}``,
+   ULIDs ``{ulid}`` and long hex strings (object ids, hashes) ``{hex}``.
+   Segments already templated by the SDK (``{id}``, ``:id``) are kept.
+
+The route is what endpoints and analytics key on (the ``path`` column); the
+verbatim path is kept in ``api_requests.raw_path``. Set
+``APILENS_INGEST_PATH_TEMPLATING=false`` to store paths unchanged.
+"""
+
+from __future__ import annotations
+
+import re
+from functools import lru_cache
+
+_UUID = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+# Crockford base32; the first character encodes the top bits of a 48-bit
+# millisecond timestamp, so it is 0-7 for any real ULID.
+_ULID = re.compile(r"[0-7][0-9A-HJKMNP-TV-Za-hjkmnp-tv-z]{25}")
+_HEX = re.compile(r"[0-9a-fA-F]{16,}")
+_PLACEHOLDER = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)(?::path)?\}")
+
+MAX_TEMPLATES = 100
+
+
+def _segment(seg: str) -> str:
+    if not seg or seg[0] in "{:":
+        return seg
+    if seg.isdigit():
+        return "{id}"
+    n = len(seg)
+    if n == 36 and _UUID.fullmatch(seg):
+        return "{uuid}"
+    if n == 26 and _ULID.fullmatch(seg) and any(c.isdigit() for c in seg):
+        return "{ulid}"
+    if n >= 16 and _HEX.fullmatch(seg) and any(c.isdigit() for c in seg):
+        return "{hex}"
+    return seg
+
+
+@lru_cache(maxsize=65536)
+def builtin_route(path: str) -> str:
+    """``path`` with id-like segments replaced by placeholders."""
+    path = path.split("?", 1)[0].split("#", 1)[0]
+    return "/".join(_segment(seg) for seg in path.split("/"))
+
+
+def compile_template(template: str) -> re.Pattern:
+    """Regex matching the concrete paths of a user template."""
+    pattern, pos = [], 0
+    for m in _PLACEHOLDER.finditer(template):
+        pattern.append(re.escape(template[pos:m.start()]))
+        pattern.append(".+" if m.group(0).endswith(":path}") else "[^/]+")
+        pos = m.end()
+    pattern.append(re.escape(template[pos:]))
+    return re.compile("".join(pattern))
+
+
+class Templater:
+    """Path -> route for one app: its own templates, then the built-in rules."""
+
+    __slots__ = ("_templates",)
+
+    def __init__(self, templates: list[str] | None = None) -> None:
+        compiled = []
+        for template in (templates or [])[:MAX_TEMPLATES]:
+            if isinstance(template, str) and template.startswith("/"):
+                compiled.append((compile_template(template), template))
+        self._templates = compiled
+
+    def __call__(self, path: str) -> str:
+        path = path.split("?", 1)[0]
+        for pattern, template in self._templates:
+            if pattern.fullmatch(path):
+                return template
+        return builtin_route(path)
+
+
+DEFAULT = Templater()
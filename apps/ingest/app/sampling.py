@@ -0,0 +1,213 @@
+"""Tail-based sampling of ``api_spans``.
+
+Most traces are fast 200s nobody opens, but they dominate span storage and
+every ``trace_id`` scan. With ``APILENS_INGEST_TRACE_SAMPLING`` on, spans are
+held per trace for ``decision_wait`` seconds after the trace's first span
+arrives, then the whole trace is either written or dropped. A trace is kept
+when it has
+
+- an error span (``status = 'error'`` or a 5xx status code),
+- a root span slower than ``slow_root_ms``,
+- a rare root endpoint: fewer than ``rare_threshold`` traces for that
+  (app, route) in the current ``rare_window``,
+
+and otherwise with probability ``keep_percent``. The coin is a hash of the
+trace id, so every worker makes the same call for spans of one trace that
+land on different processes. Kept traces store the rate they were kept at in
+``api_spans.sample_rate`` (1 for rule-kept traces), so span-derived counts
+are reweighted with ``sum(1 / sample_rate)``. Spans an SDK already sampled
+keep the lower of its rate and this one.
+
+The buffer is bounded by ``max_spans`` per process: past it the oldest traces
+are decided early. :meth:`TailSampler.stop` decides everything still pending,
+so a shutdown loses nothing that would have been kept.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+from .config import TraceSamplingConfig
+from .routes import builtin_route
+
+logger = logging.getLogger("apilens.ingest.sampling")
+
+EmitFn = Callable[[list[tuple]], None]
+
+# Row positions in ingest.SPAN_COLUMNS.
+_APP_ID, _PROJECT_ID, _TRACE_ID = 1, 2, 4
+_PARENT_SPAN_ID, _NAME, _DURATION_MS, _STATUS, _STATUS_CODE = 6, 7, 10, 11, 12
+
+# Bound on distinct (app, route) keys counted for the rare-endpoint rule.
+MAX_ROUTE_KEYS = 100_000
+
+DECISIONS = ("error", "slow", "rare", "sampled", "dropped")
+
+
+class _Trace:
+    __slots__ = ("rows", "first_seen", "error", "root")
+
+    def __init__(self, now: float) -> None:
+        self.rows: list[tuple] = []
+        self.first_seen = now
+        self.error = False
+        self.root: tuple | None = None
+
+
+def keep_probability(trace_id: str) -> float:
+    """A uniform [0, 1) value derived from the trace id (low 32 bits)."""
+    try:
+        return int(trace_id[-8:], 16) / 2**32
+    except ValueError:
+        return 0.0
+
+
+class TailSampler:
+    """Per-trace span buffer with a background decision thread."""
+
+    def __init__(self, cfg: TraceSamplingConfig, emit: EmitFn, on_decision: Callable[[str, int], None] | None = None) -> None:
+        self.cfg = cfg
+        self._emit = emit
+        self._on_decision = on_decision
+        self._rate = cfg.keep_percent / 100.0
+        self._traces: OrderedDict[tuple[str, str], _Trace] = OrderedDict()
+        self._spans = 0
+        self._routes: dict[tuple[str, str], int] = {}
+        self._routes_reset_at = time.monotonic() + cfg.rare_window
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._decided = dict.fromkeys(DECISIONS, 0)
+        self._emit_failures = 0
+
+    def add(self, rows: list[tuple]) -> None:
+        now = time.monotonic()
+        evicted: list[_Trace] = []
+        with self._lock:
+            traces = self._traces
+            for row in rows:
+                key = (row[_PROJECT_ID], row[_TRACE_ID])
+                trace = traces.get(key)
+                if trace is None:
+                    trace = traces[key] = _Trace(now)
+                trace.rows.append(row)
+                if row[_STATUS] == "error" or row[_STATUS_CODE] >= 500:
+                    trace.error = True
+                if not row[_PARENT_SPAN_ID]:
+                    trace.root = row
+            self._spans += len(rows)
+            while self._spans > self.cfg.max_spans and traces:
+                _, trace = traces.popitem(last=False)
+                self._spans -= len(trace.rows)
+                evicted.append(trace)
+        if evicted:
+            self._decide(evicted)
+
+    def flush(self, force: bool = False) -> int:
+        """Decide every trace past its wait (all of them with ``force``)."""
+        deadline = time.monotonic() - self.cfg.decision_wait
+        ready: list[_Trace] = []
+        with self._lock:
+            traces = self._traces
+            # Insertion order is first-seen order, so stop at the first young one.
+            while traces:
+                key, trace = next(iter(traces.items()))
+                if not force and trace.first_seen > deadline:
+                    break
+                del traces[key]
+                self._spans -= len(trace.rows)
+                ready.append(trace)
+        if ready:
+            self._decide(ready)
+        return len(ready)
+
+    def _decide(self, traces: list[_Trace]) -> None:
+        kept: list[tuple] = []
+        counts = dict.fromkeys(DECISIONS, 0)
+        for trace in traces:
+            decision = self._decision(trace)
+            counts[decision] += 1
+            if decision == "dropped":
+                continue
+            rate = self._rate if decision == "sampled" else 1.0
+            # SDK head sampling draws the same coin, so the combined rate is
+            # the lower of the two, not their product.
+            kept.extend(row[:-1] + (min(row[-1], rate),) for row in trace.rows)
+        with self._lock:
+            for decision, n in counts.items():
+                self._decided[decision] += n
+        if self._on_decision is not None:
+            for decision, n in counts.items():
+                if n:
+                    self._on_decision(decision, n)
+        if not kept:
+            return
+        try:
+            self._emit(kept)
+        except Exception as exc:
+            # Writer full or ClickHouse (and spool) unavailable; there's no
+            # client left to retry, so the decided spans are lost.
+            with self._lock:
+                self._emit_failures += 1
+            logger.warning("Dropped %d sampled spans: %s", len(kept), exc)
+
+    def _decision(self, trace: _Trace) -> str:
+        if trace.error:
+            return "error"
+        root = trace.root
+        if root is not None:
+            if root[_DURATION_MS] >= self.cfg.slow_root_ms:
+                return "slow"
+            if self._rare(root[_APP_ID], builtin_route(root[_NAME])):
+                return "rare"
+        if keep_probability(trace.rows[0][_TRACE_ID]) < self._rate:
+            return "sampled"
+        return "dropped"
+
+    def _rare(self, app_id: str, route: str) -> bool:
+        key = (app_id, route)
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._routes_reset_at or len(self._routes) >= MAX_ROUTE_KEYS:
+                self._routes.clear()
+                self._routes_reset_at = now + self.cfg.rare_window
+            seen = self._routes.get(key, 0)
+            self._routes[key] = seen + 1
+        return seen < self.cfg.rare_threshold
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="ingest-trace-sampler")
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+        self.flush(force=True)
+
+    def _run(self) -> None:
+        tick = min(max(self.cfg.decision_wait / 4, 0.1), 1.0)
+        while not self._stop.wait(tick):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Trace sampling pass failed")
+
+    def stats(self) -> dict[str, object]:
+        with self._lock:
+            return {
+                "traces": len(self._traces),
+                "spans": self._spans,
+                "max_spans": self.cfg.max_spans,
+                "keep_percent": self.cfg.keep_percent,
+                "decisions": dict(self._decided),
+                "emit_failures": self._emit_failures,
+            }
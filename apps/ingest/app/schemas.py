@@ -34,6 +34,10 @@ class RequestRecord(BaseModel):
     base_url: str = ""
     trace_id: str = ""
     span_id: str = ""
+    # Already counted in a rollup (RollupRecord); kept for its detail only.
+    rolled_up: bool = False
+    # Kept by SDK head sampling at this rate: stands for 1 / sample_rate requests.
+    sample_rate: float = 1.0
 
 
 class IngestRequest(BaseModel):
@@ -87,6 +91,7 @@ class SpanRecord(BaseModel):
     status: str = "ok"  # ok | error
     status_code: int = 0
     attributes: dict = Field(default_factory=dict)
+    sample_rate: float = 1.0
 
 
 class IngestSpansRequest(BaseModel):
@@ -95,3 +100,46 @@ class IngestSpansRequest(BaseModel):
 
 class IngestSpansResponse(BaseModel):
     accepted: int
+
+
+class RollupRecord(BaseModel):
+    # One minute of one route's requests, aggregated by the SDK: the bucket
+    # is keyed by (method, path, status_code, environment, consumer_group)
+    # and carries sums instead of one record per request.
+    project_slug: str = ""
+    app_id: str
+    timestamp: datetime  # start of the minute, UTC
+    environment: str
+    method: str
+    path: str  # route, e.g. /v1/orders/{id}
+    status_code: int
+    consumer_group: str = ""
+    request_bytes: int = 0
+    response_bytes: int = 0
+    # Latency sketch: requests per log-spaced bucket (see ingest.py
+    # SKETCH_GAMMA); the bucket's request count is the sum of the counts.
+    latency_bins: list[int]
+    latency_counts: list[int]
+
+
+class IngestRollupsRequest(BaseModel):
+    rollups: list[RollupRecord]
+
+
+class IngestRollupsResponse(BaseModel):
+    accepted: int
+
+
+class IngestBatchRequest(BaseModel):
+    # Any mix of the three signals in one upload; each list has the same
+    # size limit as its own endpoint.
+    requests: list[RequestRecord] = Field(default_factory=list)
+    logs: list[LogRecord] = Field(default_factory=list)
+    spans: list[SpanRecord] = Field(default_factory=list)
+
+
+class IngestBatchResponse(BaseModel):
+    accepted: int
+    requests: int
+    logs: int
+    spans: int
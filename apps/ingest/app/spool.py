@@ -0,0 +1,580 @@
+"""Durable on-disk spool for ClickHouse inserts that cannot be delivered.
+
+When ClickHouse is down or slow, blocks that fail to insert (or that arrive
+while the circuit breaker is open) are appended to a local, segment-rotated
+log instead of being bounced back to the SDKs as 500s. A background drainer
+replays the log in order once ClickHouse recovers, at a bounded row rate so
+the recovery itself doesn't look like an insert storm.
+
+Layout (one directory per worker slot, one sub-directory per table)::
+
+    {spool_dir}/slot-{n}/.lock
+    {spool_dir}/slot-{n}/{table}/{seq:012d}.seg      sealed or active segment
+    {spool_dir}/slot-{n}/{table}/{seq:012d}.cursor   replay offset of a segment
+
+Each record is ``length (4B) | crc32 (4B) | JSON {"columns", "rows"}``; a torn
+tail record (crash mid-append) fails the length/CRC check and ends replay of
+that segment. Gunicorn workers each lock their own slot, and a restarted
+worker picks up (and drains) whatever its slot's previous owner left behind;
+the drainer also adopts slots no live worker holds (after scaling down).
+
+A block ClickHouse rejects (``rejected``, e.g. a type mismatch) or that keeps
+failing for ``max_attempts`` replays is moved, in the same record format, to
+``{seq:012d}.dead`` next to its segment so it can't hold up the blocks behind
+it; one rejected on its first insert goes there directly, without being
+spooled or counting as a breaker failure; renaming a ``.dead`` file to ``.seg`` replays it again. Failures with
+ClickHouse unreachable (``unavailable``) never count toward the limit.
+"""
+
+from __future__ import annotations
+
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+from .config import SpoolConfig
+
+logger = logging.getLogger("apilens.ingest.spool")
+
+_HEADER = struct.Struct("<II")
+_SEGMENT_SUFFIX = ".seg"
+_CURSOR_SUFFIX = ".cursor"
+_DEAD_SUFFIX = ".dead"
+# Columns that hold datetimes; JSON carries them as ISO-8601 strings.
+_DATETIME_COLUMNS = frozenset({"timestamp"})
+
+InsertFn = Callable[[str, list[str], list[tuple]], None]
+# Sorts a failed replay: "unavailable", "rejected" or "error" (see above).
+ClassifyFn = Callable[[Exception], str]
+
+
+class CircuitOpenError(Exception):
+    """ClickHouse is considered down; the insert was not attempted."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: ``threshold`` failures open it for
+    ``cooldown`` seconds, after which one probe call is let through."""
+
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._failures >= self.threshold
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._failures < self.threshold:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._failures >= self.threshold:
+                logger.info("ClickHouse circuit closed")
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._failures >= self.threshold:
+                if self._failures == self.threshold:
+                    logger.warning("ClickHouse circuit opened after %d consecutive failures", self._failures)
+                self._opened_at = time.monotonic()
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot spool value of type {type(value).__name__}")
+
+
+class TableSpool:
+    """Append-only segment log of insert blocks for one table."""
+
+    def __init__(self, directory: Path, cfg: SpoolConfig) -> None:
+        self.directory = directory
+        self.cfg = cfg
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._active: tuple[int, object] | None = None  # (seq, file object)
+        self._last_fsync = time.monotonic()
+        self._bytes = sum(p.stat().st_size for p in self._segments())
+        self.spooled_rows = 0
+        self.replayed_rows = 0
+        self.rejected_rows = 0
+        self.dead_rows = 0
+        # Failed replays of the block at (segment, offset).
+        self._failures: tuple[Path, int, int] | None = None
+
+    # --- bookkeeping --------------------------------------------------------
+
+    def _segments(self) -> list[Path]:
+        return sorted(self.directory.glob(f"*{_SEGMENT_SUFFIX}"))
+
+    def _segment_path(self, seq: int) -> Path:
+        return self.directory / f"{seq:012d}{_SEGMENT_SUFFIX}"
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._bytes == 0
+
+    # --- append side --------------------------------------------------------
+
+    def append(self, columns: list[str], rows: list[tuple]) -> bool:
+        """Durably queue a block; False when the spool is at its size cap."""
+        return _append_all([(self, _record(columns, rows), len(rows))])
+
+    def _append_locked(self, record: bytes, rows: int) -> None:
+        fh = self._writable(len(record))
+        fh.write(record)
+        fh.flush()
+        self._bytes += len(record)
+        self.spooled_rows += rows
+        self._maybe_fsync(fh)
+
+    def _writable(self, nbytes: int):
+        if self._active is not None:
+            seq, fh = self._active
+            if fh.tell() + nbytes <= self.cfg.segment_bytes:
+                return fh
+            self._seal_locked()
+        segments = self._segments()
+        seq = int(segments[-1].stem) + 1 if segments else 1
+        fh = open(self._segment_path(seq), "ab")
+        self._active = (seq, fh)
+        return fh
+
+    def _maybe_fsync(self, fh) -> None:
+        policy = self.cfg.fsync
+        if policy == "never":
+            return
+        now = time.monotonic()
+        if policy == "always" or now - self._last_fsync >= self.cfg.fsync_interval:
+            os.fsync(fh.fileno())
+            self._last_fsync = now
+
+    def _seal_locked(self) -> None:
+        if self._active is None:
+            return
+        _, fh = self._active
+        fh.flush()
+        if self.cfg.fsync != "never":
+            os.fsync(fh.fileno())
+        fh.close()
+        self._active = None
+
+    def close(self) -> None:
+        with self._lock:
+            self._seal_locked()
+
+    # --- replay side --------------------------------------------------------
+
+    def _oldest_sealed(self) -> Path | None:
+        with self._lock:
+            segments = self._segments()
+            if not segments:
+                return None
+            if self._active is not None and int(segments[0].stem) == self._active[0]:
+                # Only the active segment is left: seal it so it can be drained.
+                self._seal_locked()
+            return segments[0]
+
+    def replay(
+        self,
+        insert: Callable[[list[str], list[tuple]], None],
+        pace: Callable[[int], bool],
+        classify: ClassifyFn,
+    ) -> int:
+        """Replay the oldest segment in order; returns rows replayed.
+
+        Stops at the first failing insert (leaving the cursor on that block)
+        so ordering is preserved across retries, unless the block is
+        quarantined instead. ``pace`` is called after every block and returns
+        False to pause replay (on shutdown).
+        """
+        segment = self._oldest_sealed()
+        if segment is None:
+            return 0
+        cursor_path = segment.with_suffix(_CURSOR_SUFFIX)
+        offset = int(cursor_path.read_text() or 0) if cursor_path.exists() else 0
+        replayed = 0
+        with open(segment, "rb") as fh:
+            fh.seek(offset)
+            while True:
+                header = fh.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                length, crc = _HEADER.unpack(header)
+                payload = fh.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    logger.error("Truncated or corrupt record in %s at offset %d; skipping rest", segment, offset)
+                    break
+                try:
+                    block = json.loads(payload)
+                    columns = block["columns"]
+                    rows = _decode_rows(columns, block["rows"])
+                except (ValueError, KeyError, TypeError) as exc:
+                    self._quarantine(segment, header + payload, 0, exc)
+                    offset = fh.tell()
+                    _write_cursor(cursor_path, offset)
+                    continue
+                try:
+                    insert(columns, rows)
+                except Exception as exc:
+                    # Raising leaves the cursor on this block.
+                    kind = classify(exc)
+                    if kind == "unavailable":
+                        raise
+                    if kind != "rejected" and self._count_failure(segment, offset) < self.cfg.max_attempts:
+                        raise
+                    self._quarantine(segment, header + payload, len(rows), exc)
+                else:
+                    replayed += len(rows)
+                    with self._lock:
+                        self.replayed_rows += len(rows)
+                offset = fh.tell()
+                _write_cursor(cursor_path, offset)
+                if not pace(len(rows)):
+                    return replayed
+
+        size = segment.stat().st_size
+        segment.unlink()
+        cursor_path.unlink(missing_ok=True)
+        with self._lock:
+            self._bytes = max(self._bytes - size, 0)
+        return replayed
+
+    def _count_failure(self, segment: Path, offset: int) -> int:
+        """Failed replays so far of the block at ``offset``, this one included."""
+        if self._failures is not None and self._failures[:2] == (segment, offset):
+            count = self._failures[2] + 1
+        else:
+            count = 1
+        self._failures = (segment, offset, count)
+        return count
+
+    def _quarantine(self, segment: Path, record: bytes, rows: int, exc: Exception) -> None:
+        self._failures = None
+        dead = self._bury(segment, record, rows)
+        logger.error("Moved a %d-row block that failed replay to %s: %s", rows, dead, exc)
+
+    def reject(self, columns: list[str], rows: list[tuple], exc: Exception) -> None:
+        """Quarantine a block ClickHouse rejected on its first insert, without spooling it."""
+        with self._lock:
+            if self._active is not None:
+                seq = self._active[0]
+            else:
+                segments = self._segments()
+                seq = int(segments[-1].stem) + 1 if segments else 1
+        try:
+            record = _record(columns, rows)
+        except (TypeError, ValueError) as encode_exc:
+            with self._lock:
+                self.dead_rows += len(rows)
+            logger.error("Dropped a %d-row block ClickHouse rejected (%s), unspoolable: %s", len(rows), exc, encode_exc)
+            return
+        dead = self._bury(self._segment_path(seq), record, len(rows))
+        logger.error("Moved a %d-row block ClickHouse rejected to %s: %s", len(rows), dead, exc)
+
+    def _bury(self, segment: Path, record: bytes, rows: int) -> Path:
+        dead = segment.with_suffix(_DEAD_SUFFIX)
+        with open(dead, "ab") as fh:
+            fh.write(record)
+            fh.flush()
+            if self.cfg.fsync != "never":
+                os.fsync(fh.fileno())
+        with self._lock:
+            self.dead_rows += rows
+        return dead
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            return {
+                "bytes": self._bytes,
+                "segments": len(self._segments()),
+                "spooled_rows": self.spooled_rows,
+                "replayed_rows": self.replayed_rows,
+                "rejected_rows": self.rejected_rows,
+                "dead_rows": self.dead_rows,
+            }
+
+
+def _record(columns: list[str], rows: list[tuple]) -> bytes:
+    payload = json.dumps({"columns": columns, "rows": rows}, separators=(",", ":"), default=_encode).encode()
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _append_all(entries: list[tuple[TableSpool, bytes, int]]) -> bool:
+    """Append ``(spool, record, rows)`` entries to all their spools, or to none
+    when any is at its size cap."""
+    # Spool locks are always taken in directory order, so concurrent calls can't deadlock.
+    entries = sorted(entries, key=lambda entry: entry[0].directory)
+    locked = []
+    try:
+        for spool, _, _ in entries:
+            spool._lock.acquire()
+            locked.append(spool)
+        if any(spool._bytes + len(record) > spool.cfg.max_bytes for spool, record, _ in entries):
+            for spool, _, rows in entries:
+                spool.rejected_rows += rows
+            return False
+        for spool, record, rows in entries:
+            spool._append_locked(record, rows)
+        return True
+    finally:
+        for spool in reversed(locked):
+            spool._lock.release()
+
+
+def _write_cursor(path: Path, offset: int) -> None:
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(str(offset))
+    os.replace(tmp, path)
+
+
+def _decode_rows(columns: list[str], rows: list[list]) -> list[tuple]:
+    dt_indexes = [i for i, c in enumerate(columns) if c in _DATETIME_COLUMNS]
+    if not dt_indexes:
+        return [tuple(r) for r in rows]
+    out = []
+    for r in rows:
+        for i in dt_indexes:
+            if isinstance(r[i], str):
+                r[i] = datetime.fromisoformat(r[i])
+        out.append(tuple(r))
+    return out
+
+
+def _lock_slot(slot: Path):
+    """The open, locked ``.lock`` of ``slot``, or None when another process holds it."""
+    lock = open(slot / ".lock", "a")
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+
+def _claim_slot(root: Path) -> tuple[Path, object]:
+    """Lock the first free slot-N directory under ``root`` for this process."""
+    root.mkdir(parents=True, exist_ok=True)
+    n = 0
+    while True:
+        slot = root / f"slot-{n}"
+        slot.mkdir(exist_ok=True)
+        lock = _lock_slot(slot)
+        if lock is None:
+            n += 1
+            continue
+        return slot, lock
+
+
+def _unlock_slot(lock) -> None:
+    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+    lock.close()
+
+
+class Spool:
+    """Spools for every table of one worker, plus the breaker and drainer."""
+
+    def __init__(self, cfg: SpoolConfig, insert: InsertFn, classify: ClassifyFn) -> None:
+        self.cfg = cfg
+        self._insert = insert
+        self._classify = classify
+        self.breaker = CircuitBreaker(cfg.breaker_threshold, cfg.breaker_cooldown)
+        self.slot, self._slot_lock = _claim_slot(Path(cfg.directory))
+        self._tables: dict[str, TableSpool] = {}
+        self._tables_lock = threading.Lock()
+        # Slots no live worker holds (their worker count went down): locked
+        # and drained by this worker, then released. {slot: (lock, spools)}
+        self._adopted: dict[Path, tuple[object, dict[str, TableSpool]]] = {}
+        self._next_adopt = 0.0
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread: threading.Thread | None = None
+        # Pick up segments a previous owner of this slot left behind.
+        for child in sorted(self.slot.iterdir()):
+            if child.is_dir():
+                self._table(child.name)
+
+    def _table(self, table: str) -> TableSpool:
+        with self._tables_lock:
+            spool = self._tables.get(table)
+            if spool is None:
+                spool = self._tables[table] = TableSpool(self.slot / table, self.cfg)
+            return spool
+
+    def write(self, table: str, columns: list[str], rows: list[tuple]) -> None:
+        """Insert via the breaker, falling back to the on-disk spool.
+
+        Raises only when the insert failed (or was skipped) *and* the spool is
+        full, in which case the caller keeps the rows and retries.
+        """
+        self.write_all([(table, columns, rows)])
+
+    def write_all(self, blocks: list[tuple[str, list[str], list[tuple]]]) -> None:
+        """:meth:`write` for blocks of several tables (a ``/v1/batch`` upload).
+
+        Blocks are inserted in order until one fails; that block and the ones
+        after it are spooled together or, when any spool is full, not at all.
+        Blocks already inserted stay inserted: ClickHouse has no transaction
+        across tables.
+        """
+        pending = list(blocks)
+        failure: Exception | None = None
+        while pending and self.breaker.allow():
+            table, columns, rows = pending[0]
+            try:
+                self._insert(table, columns, rows)
+            except Exception as exc:
+                if self._classify(exc) == "rejected":
+                    # ClickHouse answered, so this is no failure for the
+                    # breaker (and ends a probe); retrying or spooling the
+                    # block would fail the same way.
+                    self.breaker.record_success()
+                    self._table(table).reject(columns, rows, exc)
+                    pending.pop(0)
+                    continue
+                self.breaker.record_failure()
+                failure = exc
+                break
+            self.breaker.record_success()
+            pending.pop(0)
+        if not pending:
+            return
+        entries = [(self._table(table), _record(columns, rows), len(rows)) for table, columns, rows in pending]
+        if not _append_all(entries):
+            if failure is not None:
+                raise failure
+            tables = ", ".join(table for table, _, _ in pending)
+            raise CircuitOpenError(f"ClickHouse unavailable and spool for {tables} is full")
+        if failure is not None:
+            for table, _, rows in pending:
+                logger.warning("Spooled %d %s rows after insert failure: %s", len(rows), table, failure)
+        self._wakeup.set()
+
+    # --- drainer ------------------------------------------------------------
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="ingest-spool-drain")
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+        with self._tables_lock:
+            spools = list(self._tables.values())
+            adopted = list(self._adopted.values())
+            self._adopted.clear()
+        for spool in spools:
+            spool.close()
+        for lock, _ in adopted:
+            _unlock_slot(lock)
+
+    def _adopt_orphans(self) -> None:
+        """Lock every other slot no process holds that still has segments."""
+        self._next_adopt = time.monotonic() + self.cfg.breaker_cooldown
+        for slot in sorted(self.slot.parent.glob("slot-*")):
+            if slot == self.slot or slot in self._adopted or not slot.is_dir():
+                continue
+            tables = [child for child in slot.iterdir() if child.is_dir() and any(child.glob(f"*{_SEGMENT_SUFFIX}"))]
+            if not tables:
+                continue
+            lock = _lock_slot(slot)
+            if lock is None:
+                continue
+            spools = {child.name: TableSpool(child, self.cfg) for child in tables}
+            with self._tables_lock:
+                self._adopted[slot] = (lock, spools)
+            logger.info("Adopted orphaned spool slot %s (%s)", slot, ", ".join(sorted(spools)))
+
+    def _release_drained(self) -> None:
+        with self._tables_lock:
+            drained = [slot for slot, (_, spools) in self._adopted.items()
+                       if all(s.is_empty() for s in spools.values())]
+            released = [self._adopted.pop(slot) for slot in drained]
+        for (lock, _), slot in zip(released, drained):
+            _unlock_slot(lock)
+            logger.info("Drained and released spool slot %s", slot)
+
+    def _pace(self, rows: int) -> bool:
+        rate = self.cfg.replay_rows_per_sec
+        if rate > 0:
+            return not self._stop.wait(rows / rate)
+        return not self._stop.is_set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            if time.monotonic() >= self._next_adopt:
+                self._adopt_orphans()
+            self._release_drained()
+            with self._tables_lock:
+                spools = list(self._tables.items())
+                for _, adopted in self._adopted.values():
+                    spools.extend(adopted.items())
+            pending = [(t, s) for t, s in spools if not s.is_empty()]
+            if not pending:
+                self._wakeup.wait(self.cfg.breaker_cooldown)
+                self._wakeup.clear()
+                continue
+            if not self.breaker.allow():
+                self._stop.wait(1.0)
+                continue
+            for table, spool in pending:
+                if self._stop.is_set():
+                    return
+                try:
+                    spool.replay(lambda cols, rows, t=table: self._insert(t, cols, rows), self._pace, self._classify)
+                except Exception as exc:
+                    self.breaker.record_failure()
+                    logger.warning("Spool replay for %s failed, will retry: %s", table, exc)
+                    break
+                self.breaker.record_success()
+
+    def stats(self) -> dict[str, object]:
+        with self._tables_lock:
+            spools = list(self._tables.items())
+            for _, adopted in self._adopted.values():
+                spools.extend(adopted.items())
+            adopted_slots = len(self._adopted)
+        tables: dict[str, dict[str, float]] = {}
+        for table, spool in spools:
+            totals = tables.setdefault(table, {})
+            for key, value in spool.stats().items():
+                totals[key] = totals.get(key, 0) + value
+        return {
+            "circuit_open": self.breaker.is_open,
+            "adopted_slots": adopted_slots,
+            "tables": tables,
+        }
@@ -0,0 +1,105 @@
+"""Timestamp sanity window for ingested rows.
+
+``api_requests``, ``api_logs`` and ``api_spans`` are partitioned by month. A
+record from a client whose clock is years off, or an unset (epoch)
+timestamp, creates a partition of its own that never merges and that every
+query has to prune. Rows outside [now - ``max_past``, now + ``max_future``]
+are therefore handled by ``APILENS_INGEST_TIMESTAMP_POLICY``:
+
+- ``clamp`` (default): moved to the nearest edge of the window,
+- ``reject``: dropped (the batch is accepted without them),
+- ``restamp``: stamped with the time the batch was received,
+- ``off``: stored as sent.
+
+Every corrected row is counted per project in
+``apilens_ingest_timestamp_corrections_total``.
+
+With ``APILENS_INGEST_STAMP_RECEIVED`` the SDK's send time
+(``APILens-Sent-At``, unix seconds) is compared with the receive time and, if
+they differ by more than ``..._CLOCK_SKEW_TOLERANCE`` seconds, the whole
+batch is shifted by the difference before the window is applied. Latency
+charts then line up with server time even when an SDK host's clock drifts,
+and the spacing between its records is preserved. A header that isn't a
+finite number, or that is further off than the whole window
+(``max_past + max_future``), is ignored.
+"""
+
+from __future__ import annotations
+
+import math
+import time
+from datetime import datetime, timedelta, timezone
+
+from .config import load_timestamps
+from .metrics import TIMESTAMP_CORRECTIONS, project_label
+
+SENT_AT_HEADER = "APILens-Sent-At"
+
+# Row positions shared by every table's columns.
+_TIMESTAMP, _PROJECT_ID = 0, 2
+
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_UTC = _EPOCH.replace(tzinfo=timezone.utc)
+
+_cfg = load_timestamps()
+
+
+def _seconds(ts: datetime) -> float:
+    # Naive timestamps are taken as UTC (the ClickHouse server timezone).
+    return (ts - (_EPOCH if ts.tzinfo is None else _EPOCH_UTC)).total_seconds()
+
+
+def _at(seconds: float, like: datetime) -> datetime:
+    return (_EPOCH if like.tzinfo is None else _EPOCH_UTC) + timedelta(seconds=seconds)
+
+
+def clock_offset(sent_at: str | None) -> float:
+    """Seconds to add to a batch's timestamps (0 unless stamping is on and the skew is real)."""
+    if not _cfg.stamp_received or not sent_at:
+        return 0.0
+    try:
+        offset = time.time() - float(sent_at)
+    except ValueError:
+        return 0.0
+    # A skew no row could survive is a bad header, not a bad clock.
+    if not math.isfinite(offset) or abs(offset) > _cfg.max_past + _cfg.max_future:
+        return 0.0
+    return offset if abs(offset) > _cfg.skew_tolerance else 0.0
+
+
+def check_rows(table: str, rows: list[tuple], offset: float = 0.0) -> list[tuple]:
+    """``rows`` shifted by ``offset`` and held to the window; may drop rows under ``reject``."""
+    policy = _cfg.policy
+    if not rows or (policy == "off" and not offset):
+        return rows
+    received = time.time()
+    low, high = received - _cfg.max_past, received + _cfg.max_future
+    if not offset and all(low <= _seconds(row[_TIMESTAMP]) <= high for row in rows):
+        return rows
+
+    shift = timedelta(seconds=offset)
+    out: list[tuple] = []
+    corrected: dict[str, int] = {}
+    for row in rows:
+        try:
+            ts = row[_TIMESTAMP] + shift if offset else row[_TIMESTAMP]
+            seconds = _seconds(ts)
+        except OverflowError:
+            # Shifted past year 1 or 9999: outside any window.
+            ts, seconds = row[_TIMESTAMP], math.copysign(math.inf, offset)
+        if policy != "off" and not low <= seconds <= high:
+            project_id = row[_PROJECT_ID]
+            corrected[project_id] = corrected.get(project_id, 0) + 1
+            if policy == "reject":
+                continue
+            ts = _at(received if policy == "restamp" else min(max(seconds, low), high), ts)
+        elif not offset:
+            out.append(row)
+            continue
+        out.append((ts,) + row[1:])
+    action = {"clamp": "clamped", "reject": "rejected", "restamp": "restamped"}.get(policy)
+    for project_id, n in corrected.items():
+        TIMESTAMP_CORRECTIONS.inc(table, project_label(project_id), action, amount=n)
+    if offset:
+        TIMESTAMP_CORRECTIONS.inc(table, project_label(rows[0][_PROJECT_ID]), "shifted", amount=len(rows))
+    return out
@@ -0,0 +1,111 @@
+"""Records/sec per core for the ingest decode path, pydantic vs msgspec.
+
+Decodes a batch body of SDK-shaped request records and then builds the
+ClickHouse rows through ``handle_requests`` (app/endpoint resolution and the
+insert itself are replaced with no-ops, so only CPU work in this process is
+measured). Single-threaded and timed with process CPU time, so the numbers
+are per core.
+
+    cd apps/ingest
+    python -m benchmarks.decode_bench --records 1000 --batches 200
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from app import decoding, ingest
+from app.schemas import IngestRequest
+
+_PATHS = ["/v1/orders", "/v1/orders/{id}", "/v1/users/{id}", "/v1/search", "/health"]
+_METHODS = ["GET", "GET", "GET", "POST", "PUT", "DELETE"]
+
+
+def make_body(n: int, payload_bytes: int, seed: int = 7) -> bytes:
+    rnd = random.Random(seed)
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    payload = json.dumps({"data": "x" * max(payload_bytes - 12, 0)})
+    records = [
+        {
+            "app_id": f"app-{rnd.randrange(3)}",
+            "timestamp": (start + timedelta(milliseconds=i * 37)).isoformat(),
+            "environment": "production",
+            "method": rnd.choice(_METHODS),
+            "path": rnd.choice(_PATHS),
+            "status_code": rnd.choice([200, 200, 200, 201, 404, 500]),
+            "response_time_ms": round(rnd.uniform(1, 900), 3),
+            "request_size": rnd.randrange(4096),
+            "response_size": rnd.randrange(65536),
+            "ip_address": f"10.0.{rnd.randrange(256)}.{rnd.randrange(256)}",
+            "user_agent": "python-requests/2.32.3",
+            "consumer_id": f"c-{rnd.randrange(500)}",
+            "consumer_name": "Acme",
+            "consumer_group": "paid",
+            "request_payload": payload,
+            "response_payload": payload,
+            "request_headers": '{"content-type":"application/json"}',
+            "response_headers": '{"content-type":"application/json"}',
+            "base_url": "https://api.example.com",
+            "trace_id": f"{rnd.getrandbits(128):032x}",
+            "span_id": f"{rnd.getrandbits(64):016x}",
+        }
+        for i in range(n)
+    ]
+    return json.dumps({"requests": records}).encode()
+
+
+def _stub_backends() -> None:
+    ingest.validate_project_slug = lambda slug, slugs: None
+    ingest.resolve_apps = lambda project_id, ids: {i: f"00000000-0000-0000-0000-00000000000{n}" for n, i in enumerate(ids)}
+    ingest.resolve_endpoints = lambda records: {}
+    ingest._templates_column = False  # built-in route templating, no Postgres
+    ingest._insert = lambda table, rows: None
+
+
+def run(name: str, body: bytes, batches: int) -> tuple[float, float]:
+    decode = decoding._BUILDERS[name]()
+    n = len(decode(IngestRequest, body).requests)
+
+    t0 = time.process_time()
+    for _ in range(batches):
+        decode(IngestRequest, body)
+    decode_s = time.process_time() - t0
+
+    t0 = time.process_time()
+    for _ in range(batches):
+        ingest.handle_requests("project", "", decode(IngestRequest, body).requests)
+    total_s = time.process_time() - t0
+    return n * batches / decode_s, n * batches / total_s
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=1000, help="records per batch body")
+    parser.add_argument("--batches", type=int, default=100)
+    parser.add_argument("--payload-bytes", type=int, default=512, help="size of each captured payload")
+    args = parser.parse_args()
+
+    _stub_backends()
+    body = make_body(args.records, args.payload_bytes)
+    print(f"batch: {args.records} records, {len(body) / 1024:.0f} KiB; {args.batches} batches")
+    print(f"{'decoder':<10}{'decode rec/s':>16}{'decode+rows rec/s':>20}")
+    results = {}
+    for name in decoding._BUILDERS:
+        try:
+            results[name] = run(name, body, args.batches)
+        except ImportError as exc:
+            print(f"{name:<10}skipped ({exc})")
+            continue
+        decode_rate, total_rate = results[name]
+        print(f"{name:<10}{decode_rate:>16,.0f}{total_rate:>20,.0f}")
+    if len(results) == 2:
+        base, fast = results["pydantic"], results["msgspec"]
+        print(f"msgspec speedup: decode x{fast[0] / base[0]:.2f}, decode+rows x{fast[1] / base[1]:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Rows/sec for ClickHouse insert blocks: row-wise vs columnar vs NumPy.
+
+Builds realistic ``api_requests`` blocks the way the writers do (row tuples
+from ``handle_requests``), then times the client-side work of each insert
+format: our conversion (columnar.py) plus clickhouse_driver serializing the
+block into native protocol bytes. By default nothing is sent anywhere, so it
+runs without a server; ``--clickhouse`` additionally inserts into a temporary
+table on the server configured via APILENS_CLICKHOUSE_URL / CLICKHOUSE_*.
+
+    cd apps/ingest
+    python -m benchmarks.insert_bench --sizes 200 10000
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+
+from clickhouse_driver import defines
+from clickhouse_driver.block import ColumnOrientedBlock, RowOrientedBlock
+from clickhouse_driver.bufferedwriter import BufferedSocketWriter
+from clickhouse_driver.connection import ServerInfo
+from clickhouse_driver.context import Context
+from clickhouse_driver.streams.native import BlockOutputStream
+
+from app import ingest
+from app.columnar import timestamp_scale, to_columns, to_numpy_columns
+from app.schemas import IngestRequest
+
+from .decode_bench import make_body
+
+# api_requests as created by apps/api's ClickHouse migrations.
+REQUEST_TYPES = {
+    "timestamp": "DateTime64(3)",
+    "app_id": "String",
+    "project_id": "String",
+    "endpoint_id": "String",
+    "environment": "LowCardinality(String)",
+    "method": "LowCardinality(String)",
+    "path": "String",
+    "status_code": "UInt16",
+    "response_time_ms": "Float64",
+    "request_size": "UInt32",
+    "response_size": "UInt32",
+    "ip_address": "String",
+    "user_agent": "String",
+    "consumer_id": "String",
+    "consumer_name": "String",
+    "consumer_group": "String",
+    "request_payload": "String",
+    "response_payload": "String",
+    "request_headers": "String",
+    "response_headers": "String",
+    "base_url": "String",
+    "trace_id": "String",
+    "span_id": "String",
+    "raw_path": "String",
+    "rolled_up": "UInt8",
+    "sample_rate": "Float32",
+}
+COLUMNS = ingest.REQUEST_COLUMNS
+COLUMNS_WITH_TYPES = [(name, REQUEST_TYPES[name]) for name in COLUMNS]
+SCALE = timestamp_scale(REQUEST_TYPES["timestamp"])
+
+
+def build_rows(n: int, payload_bytes: int) -> list[tuple]:
+    captured: list[list[tuple]] = []
+    ingest.validate_project_slug = lambda slug, slugs: None
+    ingest.resolve_apps = lambda project_id, ids: {i: f"app-uuid-{i}" for i in ids}
+    ingest.resolve_endpoints = lambda records: {}
+    ingest._templates_column = False  # built-in route templating, no Postgres
+    ingest._insert = lambda table, rows: captured.append(rows)
+    body = make_body(n, payload_bytes)
+    records = IngestRequest.model_validate_json(body).requests
+    for start in range(0, n, ingest.MAX_BATCH_SIZE):
+        ingest.handle_requests("project", "", records[start:start + ingest.MAX_BATCH_SIZE])
+    return [row for rows in captured for row in rows]
+
+
+class _Sink:
+    """Socket stand-in that only counts what the driver would send."""
+
+    def __init__(self) -> None:
+        self.size = 0
+
+    def sendall(self, data: bytes) -> None:
+        self.size += len(data)
+
+
+def _context(use_numpy: bool) -> Context:
+    ctx = Context()
+    ctx.settings = {}
+    ctx.client_settings = {
+        "insert_block_size": defines.DEFAULT_INSERT_BLOCK_SIZE,
+        "strings_as_bytes": False,
+        "strings_encoding": defines.STRINGS_ENCODING,
+        "use_numpy": use_numpy,
+        "input_format_null_as_default": False,
+        "namedtuple_as_json": False,
+    }
+    ctx.server_info = ServerInfo("ClickHouse", 24, 8, 0, defines.CLIENT_REVISION, "UTC", "bench", defines.CLIENT_REVISION)
+    return ctx
+
+
+def serialize(fmt: str, rows: list[tuple]) -> int:
+    """Encode one insert block like the driver does; returns its size."""
+    if fmt == "rows":
+        block = RowOrientedBlock(COLUMNS_WITH_TYPES, rows)
+    elif fmt == "numpy":
+        block = ColumnOrientedBlock(COLUMNS_WITH_TYPES, to_numpy_columns(COLUMNS, rows, SCALE))
+    else:
+        block = ColumnOrientedBlock(COLUMNS_WITH_TYPES, to_columns(COLUMNS, rows, SCALE))
+    sink = _Sink()
+    BlockOutputStream(BufferedSocketWriter(sink, defines.BUFFER_SIZE), _context(fmt == "numpy")).write(block)
+    return sink.size
+
+
+def insert(client, fmt: str, rows: list[tuple]) -> int:
+    query = f"INSERT INTO bench_api_requests ({', '.join(COLUMNS)}) VALUES"
+    if fmt == "rows":
+        return client.execute(query, rows)
+    data = to_numpy_columns(COLUMNS, rows, SCALE) if fmt == "numpy" else to_columns(COLUMNS, rows, SCALE)
+    return client.execute(query, data, columnar=True)
+
+
+def _rate(fn, rows: list[tuple], min_seconds: float) -> float:
+    fn(rows)  # warm up
+    done = 0
+    t0 = time.perf_counter()
+    while True:
+        fn(rows)
+        done += len(rows)
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_seconds:
+            return done / elapsed
+
+
+def _formats() -> list[str]:
+    try:
+        import numpy  # noqa: F401
+        import pandas  # noqa: F401
+    except ImportError:
+        print("numpy/pandas not installed: skipping the numpy format")
+        return ["rows", "columnar"]
+    return ["rows", "columnar", "numpy"]
+
+
+def _clients(formats: list[str]) -> dict:
+    from clickhouse_driver import Client
+
+    from app.config import load_clickhouse
+
+    c = load_clickhouse()
+    clients = {}
+    for fmt in formats:
+        client = Client(
+            host=c.host, port=c.port, database=c.database, user=c.user, password=c.password,
+            secure=c.secure, verify=c.verify, settings={"use_numpy": fmt == "numpy"},
+        )
+        types = ", ".join(f"{name} {type_}" for name, type_ in COLUMNS_WITH_TYPES)
+        client.execute(f"CREATE TEMPORARY TABLE IF NOT EXISTS bench_api_requests ({types}) ENGINE = Memory")
+        clients[fmt] = client
+    return clients
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[200, 10000], help="rows per block")
+    parser.add_argument("--payload-bytes", type=int, default=512)
+    parser.add_argument("--seconds", type=float, default=2.0, help="minimum time per measurement")
+    parser.add_argument("--clickhouse", action="store_true", help="also insert into a temp table on the server")
+    args = parser.parse_args()
+
+    formats = _formats()
+    clients = _clients(formats) if args.clickhouse else {}
+    header = f"{'rows':>7}  {'format':<9}{'encode rows/s':>15}"
+    if clients:
+        header += f"{'insert rows/s':>15}"
+    print(header)
+    for size in args.sizes:
+        rows = build_rows(size, args.payload_bytes)
+        base = None
+        for fmt in formats:
+            rate = _rate(lambda r: serialize(fmt, r), rows, args.seconds)
+            base = base or rate
+            line = f"{size:>7}  {fmt:<9}{rate:>15,.0f}"
+            if clients:
+                line += f"{_rate(lambda r: insert(clients[fmt], fmt, r), rows, args.seconds):>15,.0f}"
+            print(f"{line}   x{rate / base:.2f}")
+
+
+if __name__ == "__main__":
+    main()
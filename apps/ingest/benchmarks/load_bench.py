@@ -0,0 +1,538 @@
+"""Ingest capacity: latency percentiles, records/sec per core and peak RSS.
+
+Starts the real app under uvicorn in a child process (one per endpoint), with
+Postgres and ClickHouse replaced by in-process stand-ins that answer the
+queries ``ingest.py`` sends after a configurable round-trip delay, and replays
+synthetic SDK batches against it from client threads. Everything else (auth
+cache, decompression, decoding, app/endpoint resolution and caches, the
+write-behind buffer, columnar conversion) runs as in production.
+
+Batches mimic SDK traffic: a few apps, a few hundred endpoints per app,
+log-normal payload sizes, trace ids shared by several records and span trees
+under one root. Reported per endpoint: client-side p50/p99 latency, records/s,
+records per server CPU second (the per-core capacity) and the server's peak
+RSS.
+
+    cd apps/ingest
+    python -m benchmarks.load_bench --duration 10
+    python -m benchmarks.load_bench --json head.json --compare base.json
+
+``--compare`` exits non-zero when records/CPU-second drops more than
+``--tolerance`` below the other run, so CI can check a change against its
+base branch on the same runner. The server inherits the environment, so
+``APILENS_INGEST_ASYNC=true`` benchmarks the async handlers (aio.py) and
+``--concurrency`` sets how many SDK connections are in flight.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import gzip
+import http.client
+import json
+import math
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+ENDPOINTS = {"requests": "/v1/requests", "logs": "/v1/logs", "traces": "/v1/traces"}
+PROJECT_ID = "00000000-0000-4000-8000-000000000001"
+PROJECT_SLUG = "bench"
+_METHODS = ["GET"] * 6 + ["POST"] * 2 + ["PUT", "DELETE"]
+_RESOURCES = ["orders", "users", "invoices", "products", "carts", "sessions", "search", "webhooks"]
+_LEVELS = ["debug", "info", "info", "info", "warning", "error"]
+
+
+def _app_uuid(slug: str) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"apilens-bench:{slug}"))
+
+
+# --- synthetic SDK batches ----------------------------------------------------
+
+class Workload:
+    """Deterministic generator of SDK-shaped records with realistic cardinalities."""
+
+    def __init__(self, apps: int, endpoints: int, payload_bytes: int, seed: int = 7) -> None:
+        self.rnd = random.Random(seed)
+        self.apps = [f"app-{i}" for i in range(apps)]
+        self.routes = [
+            (self.rnd.choice(_METHODS), f"/v1/{self.rnd.choice(_RESOURCES)}/{i}")
+            for i in range(endpoints)
+        ]
+        self.payload_bytes = payload_bytes
+        # Recent, so rows stay inside the ingest timestamp window (timestamps.py).
+        self.clock = datetime.now(timezone.utc) - timedelta(hours=1)
+
+    def _tick(self) -> str:
+        self.clock += timedelta(milliseconds=self.rnd.randrange(1, 40))
+        return self.clock.isoformat()
+
+    def _payload(self) -> str:
+        if not self.payload_bytes:
+            return ""
+        size = int(self.rnd.lognormvariate(math.log(self.payload_bytes), 0.8))
+        return json.dumps({"data": "x" * min(size, 64 * 1024)})
+
+    def _traces(self, n: int):
+        """(trace_id, span_id, parent_span_id) for n records, 1-8 per trace."""
+        out = []
+        while len(out) < n:
+            trace_id = f"{self.rnd.getrandbits(128):032x}"
+            root = f"{self.rnd.getrandbits(64):016x}"
+            out.append((trace_id, root, ""))
+            for _ in range(self.rnd.randrange(0, 8)):
+                out.append((trace_id, f"{self.rnd.getrandbits(64):016x}", root))
+        return out[:n]
+
+    def requests(self, n: int) -> dict:
+        records = []
+        for trace_id, span_id, _ in self._traces(n):
+            method, path = self.rnd.choice(self.routes)
+            records.append({
+                "app_id": self.rnd.choice(self.apps),
+                "timestamp": self._tick(),
+                "environment": self.rnd.choice(["production", "production", "staging"]),
+                "method": method,
+                "path": path,
+                "status_code": self.rnd.choices([200, 201, 204, 400, 404, 500], [70, 8, 4, 6, 8, 4])[0],
+                "response_time_ms": round(self.rnd.lognormvariate(3.5, 1.0), 3),
+                "request_size": self.rnd.randrange(4096),
+                "response_size": self.rnd.randrange(65536),
+                "ip_address": f"10.{self.rnd.randrange(256)}.{self.rnd.randrange(256)}.{self.rnd.randrange(256)}",
+                "user_agent": "python-requests/2.32.3",
+                "consumer_id": f"c-{self.rnd.randrange(2000)}",
+                "consumer_name": "Acme",
+                "consumer_group": self.rnd.choice(["free", "paid", "enterprise"]),
+                "request_payload": self._payload(),
+                "response_payload": self._payload(),
+                "request_headers": '{"content-type":"application/json"}',
+                "response_headers": '{"content-type":"application/json"}',
+                "base_url": "https://api.example.com",
+                "trace_id": trace_id,
+                "span_id": span_id,
+            })
+        return {"requests": records}
+
+    def logs(self, n: int) -> dict:
+        records = []
+        for trace_id, span_id, _ in self._traces(n):
+            method, path = self.rnd.choice(self.routes)
+            records.append({
+                "app_id": self.rnd.choice(self.apps),
+                "timestamp": self._tick(),
+                "environment": "production",
+                "level": self.rnd.choice(_LEVELS),
+                "message": f"handled {method} {path} in {self.rnd.randrange(1, 900)}ms",
+                "logger_name": "app.views",
+                "endpoint_method": method,
+                "endpoint_path": path,
+                "status_code": 200,
+                "consumer_id": f"c-{self.rnd.randrange(2000)}",
+                "trace_id": trace_id,
+                "span_id": span_id,
+                "payload": self._payload()[:2048],
+                "attributes": {"region": "eu-west-1", "attempt": str(self.rnd.randrange(3))},
+            })
+        return {"logs": records}
+
+    def traces(self, n: int) -> dict:
+        records = []
+        for trace_id, span_id, parent in self._traces(n):
+            method, path = self.rnd.choice(self.routes)
+            records.append({
+                "app_id": self.rnd.choice(self.apps),
+                "timestamp": self._tick(),
+                "environment": "production",
+                "trace_id": trace_id,
+                "span_id": span_id,
+                "parent_span_id": parent,
+                "name": f"{method} {path}" if not parent else self.rnd.choice(["db.query", "http.client", "cache.get"]),
+                "kind": "server" if not parent else self.rnd.choice(["db", "client", "internal"]),
+                "service_name": "api",
+                "duration_ms": round(self.rnd.lognormvariate(2.5, 1.2), 3),
+                "status": self.rnd.choices(["ok", "error"], [97, 3])[0],
+                "status_code": 200,
+                "attributes": {"db.system": "postgresql"} if parent else {},
+            })
+        return {"spans": records}
+
+
+def make_bodies(kind: str, count: int, batch_size: int, args) -> list[tuple[bytes, dict[str, str]]]:
+    """Encoded request bodies + headers, as the Python SDK would send them."""
+    workload = Workload(args.apps, args.endpoints, args.payload_bytes)
+    bodies = []
+    for _ in range(count):
+        body = json.dumps(getattr(workload, kind)(batch_size), separators=(",", ":")).encode()
+        headers = {"Content-Type": "application/json", "X-API-Key": "bench-key"}
+        if args.compression == "gzip":
+            body = gzip.compress(body, compresslevel=5, mtime=0)
+            headers["Content-Encoding"] = "gzip"
+        bodies.append((body, headers))
+    return bodies
+
+
+# --- server side: stand-ins and the app ---------------------------------------
+
+class FakePostgres:
+    """Answers the app/endpoint queries of ingest.py from memory."""
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.endpoints: dict[tuple[str, str, str], str] = {}
+        self.queries = 0
+        self.lock = threading.Lock()
+
+    def _roundtrip(self) -> None:
+        with self.lock:
+            self.queries += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    async def _aroundtrip(self) -> None:
+        with self.lock:
+            self.queries += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    @contextlib.contextmanager
+    def conn(self):
+        yield _FakeConnection(self)
+
+    @contextlib.asynccontextmanager
+    async def aconn(self):
+        yield _FakeAsyncConnection(self)
+
+    def execute_values(self, cur, sql, rows, template=None, page_size=None, fetch=False):
+        self._roundtrip()
+        if "INSERT INTO endpoints" in sql:
+            out = []
+            with self.lock:
+                for _id, app_id, path, method, _seen in rows:
+                    endpoint_id = self.endpoints.setdefault((app_id, method, path), _id)
+                    out.append((endpoint_id, app_id, method, path))
+            return out
+        if sql.lstrip().startswith("SELECT"):
+            cur.rows = [(self.endpoints[key], *key) for key in rows if key in self.endpoints]
+        return None
+
+
+class _FakeConnection:
+    def __init__(self, pg: FakePostgres) -> None:
+        self.pg = pg
+
+    @contextlib.contextmanager
+    def cursor(self):
+        yield _FakeCursor(self.pg)
+
+    def commit(self) -> None:
+        pass
+
+    def rollback(self) -> None:
+        pass
+
+
+class _FakeCursor:
+    def __init__(self, pg: FakePostgres) -> None:
+        self.pg = pg
+        self.rows: list[tuple] = []
+
+    def execute(self, sql: str, params=()) -> None:
+        self.pg._roundtrip()
+        if "path_templates" in sql:
+            self.rows = []
+        elif "FROM apps" in sql:
+            _project_id, uuids, slugs = params
+            self.rows = [(_app_uuid(s), s) for s in slugs if s.startswith("app-")]
+            self.rows += [(u, "") for u in uuids]
+
+    def fetchall(self) -> list[tuple]:
+        return self.rows
+
+
+class _FakeAsyncConnection:
+    """The asyncpg side of :class:`FakePostgres` (aio.py's queries)."""
+
+    def __init__(self, pg: FakePostgres) -> None:
+        self.pg = pg
+
+    async def fetch(self, sql: str, *args) -> list:
+        await self.pg._aroundtrip()
+        if "path_templates" in sql:
+            return []
+        if "INSERT INTO endpoints" in sql:
+            out = []
+            with self.pg.lock:
+                for _id, app_id, path, method in zip(*args[:4]):
+                    endpoint_id = self.pg.endpoints.setdefault((app_id, method, path), str(_id))
+                    out.append({"id": endpoint_id, "app_id": app_id, "method": method, "path": path})
+            return out
+        if "FROM apps" in sql:
+            _project_id, uuids, slugs = args
+            rows = [{"id": _app_uuid(s), "slug": s} for s in slugs if s.startswith("app-")]
+            return rows + [{"id": u, "slug": ""} for u in uuids]
+        if "FROM endpoints" in sql:
+            keys = [key for key in zip(*args) if key in self.pg.endpoints]
+            return [{"id": self.pg.endpoints[k], "app_id": k[0], "method": k[1], "path": k[2]} for k in keys]
+        return []
+
+
+class FakeClickHouse:
+    """Accepts INSERT blocks (already converted by ingest.py) after a delay."""
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.rows = 0
+        self.blocks = 0
+        self.lock = threading.Lock()
+
+    def execute(self, query: str, params=None, columnar: bool = False, **_kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        if query.startswith("SELECT type FROM system.columns"):
+            return [("DateTime64(3)",)]
+        if query.startswith("INSERT") and params is not None:
+            n = len(params[0]) if columnar and len(params) else len(params)
+            with self.lock:
+                self.rows += n
+                self.blocks += 1
+        return []
+
+
+def _max_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def serve(args) -> None:
+    """Child process: the ingest app on the stand-ins, plus /_bench control routes."""
+    import uvicorn
+
+    from app import auth, ingest, main
+
+    pg = FakePostgres(args.pg_latency_ms / 1000)
+    ch = FakeClickHouse(args.ch_latency_ms / 1000)
+    ingest.pg_conn = pg.conn
+    ingest.execute_values = pg.execute_values
+    ingest.clickhouse = lambda: ch
+    main.clickhouse = lambda: ch
+    main.init_postgres_pool = lambda: None
+    auth._introspect = lambda api_key: (PROJECT_ID, PROJECT_SLUG)
+    if main._async_cfg.enabled:
+        from app import aio
+
+        async def no_pools(_cfg) -> None:
+            pass
+
+        async def ch_execute(query: str, params=None) -> None:
+            # Unbuffered inserts only (APILENS_INGEST_BUFFER=false): row tuples.
+            if ch.latency:
+                await asyncio.sleep(ch.latency)
+            with ch.lock:
+                ch.rows += len(params)
+                ch.blocks += 1
+
+        main.init_async_pools = no_pools
+        aio.apg_conn = pg.aconn
+        aio.clickhouse_execute_async = ch_execute
+
+    def stats() -> dict:
+        return {
+            "cpu_seconds": time.process_time(),
+            "max_rss_mb": _max_rss_mb(),
+            "inserted_rows": ch.rows,
+            "insert_blocks": ch.blocks,
+            "pg_queries": pg.queries,
+        }
+
+    def drain() -> dict:
+        # Flush the write-behind buffers so their CPU lands in the measurement.
+        ingest.stop_writers()
+        ingest.start_writers()
+        return stats()
+
+    main.app.add_api_route("/_bench/stats", stats, methods=["GET"], include_in_schema=False)
+    main.app.add_api_route("/_bench/drain", drain, methods=["POST"], include_in_schema=False)
+    uvicorn.run(main.app, host="127.0.0.1", port=args.port, log_level="warning", access_log=False)
+
+
+# --- client side --------------------------------------------------------------
+
+def _call(port: int, method: str, path: str) -> dict:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    try:
+        conn.request(method, path)
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+def _wait_ready(port: int, proc: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"bench server exited with {proc.returncode}")
+        try:
+            _call(port, "GET", "/v1/health")
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("bench server did not start")
+
+
+def _load(port: int, path: str, bodies, concurrency: int, duration: float) -> dict:
+    """Send batches from ``concurrency`` keep-alive connections for ``duration`` s."""
+    latencies: list[float] = []
+    counts = {"requests": 0, "records": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(offset: int) -> None:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        mine: list[float] = []
+        records = errors = 0
+        i = offset
+        while time.monotonic() < deadline:
+            body, headers = bodies[i % len(bodies)]
+            i += 1
+            t0 = time.perf_counter()
+            conn.request("POST", path, body=body, headers=headers)
+            resp = conn.getresponse()
+            data = resp.read()
+            mine.append(time.perf_counter() - t0)
+            if resp.status == 200:
+                records += json.loads(data)["accepted"]
+            else:
+                errors += 1
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            counts["requests"] += len(mine)
+            counts["records"] += records
+            counts["errors"] += errors
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    latencies.sort()
+    counts["p50_ms"] = _percentile(latencies, 0.50) * 1000
+    counts["p99_ms"] = _percentile(latencies, 0.99) * 1000
+    return counts
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_endpoint(kind: str, args) -> dict:
+    port = _free_port()
+    cmd = [
+        sys.executable, "-m", "benchmarks.load_bench", "--serve", "--port", str(port),
+        "--pg-latency-ms", str(args.pg_latency_ms), "--ch-latency-ms", str(args.ch_latency_ms),
+    ]
+    proc = subprocess.Popen(cmd)
+    try:
+        _wait_ready(port, proc)
+        bodies = make_bodies(kind, args.bodies, args.batch_size, args)
+        path = ENDPOINTS[kind]
+        _load(port, path, bodies, args.concurrency, args.warmup)
+        before = _call(port, "POST", "/_bench/drain")
+        t0 = time.monotonic()
+        result = _load(port, path, bodies, args.concurrency, args.duration)
+        after = _call(port, "POST", "/_bench/drain")
+        wall = time.monotonic() - t0
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+    cpu = after["cpu_seconds"] - before["cpu_seconds"]
+    result.update(
+        records_per_sec=result["records"] / wall,
+        records_per_cpu_sec=result["records"] / cpu if cpu > 0 else 0.0,
+        server_cpu_seconds=cpu,
+        peak_rss_mb=after["max_rss_mb"],
+        inserted_rows=after["inserted_rows"] - before["inserted_rows"],
+    )
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Endpoints whose records/CPU-second regressed by more than ``tolerance``."""
+    failures = []
+    for kind, current in results.items():
+        base = baseline.get(kind)
+        if not base or not base.get("records_per_cpu_sec"):
+            continue
+        ratio = current["records_per_cpu_sec"] / base["records_per_cpu_sec"]
+        print(f"{kind:<9} records/cpu-s x{ratio:.2f} vs baseline")
+        if ratio < 1 - tolerance:
+            failures.append(f"{kind}: {ratio:.2f}x of baseline records/cpu-s")
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", nargs="+", choices=list(ENDPOINTS), default=list(ENDPOINTS))
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per endpoint")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8, help="client connections")
+    parser.add_argument("--batch-size", type=int, default=200, help="records per SDK batch (SDK default)")
+    parser.add_argument("--bodies", type=int, default=64, help="distinct batches cycled through")
+    parser.add_argument("--apps", type=int, default=5)
+    parser.add_argument("--endpoints", type=int, default=300, help="distinct (method, path) pairs")
+    parser.add_argument("--payload-bytes", type=int, default=512, help="median captured payload size")
+    parser.add_argument("--compression", choices=["gzip", "none"], default="gzip")
+    parser.add_argument("--pg-latency-ms", type=float, default=1.0, help="simulated Postgres round trip")
+    parser.add_argument("--ch-latency-ms", type=float, default=5.0, help="simulated ClickHouse round trip")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="baseline results (--json output) to check against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed records/cpu-s drop for --compare")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    print(f"{'endpoint':<9}{'p50 ms':>9}{'p99 ms':>9}{'rec/s':>11}{'rec/cpu-s':>12}{'peak RSS MB':>13}{'errors':>8}")
+    results = {}
+    for kind in args.only:
+        r = results[kind] = run_endpoint(kind, args)
+        print(
+            f"{kind:<9}{r['p50_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['records_per_sec']:>11,.0f}"
+            f"{r['records_per_cpu_sec']:>12,.0f}{r['peak_rss_mb']:>13.0f}{r['errors']:>8}"
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failures = []
+    if args.compare:
+        with open(args.compare) as f:
+            failures = compare(results, json.load(f), args.tolerance)
+    if any(r["errors"] for r in results.values()):
+        failures.append("some requests failed")
+    if failures:
+        print("FAIL: " + "; ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
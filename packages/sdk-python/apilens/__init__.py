@@ -1,9 +1,9 @@
 from ._version import __version__
-from .client import ApiLensClient, ApiLensConfig
-from .client import RequestRecord
+from .client import ApiLensClient, ApiLensConfig, AsyncApiLensClient
+from .client import RequestRecord, SamplingPolicy
 from .client.middleware import normalize_consumer
 from .client.spans import instrument_outbound_http, span
-from .client.trace import current_span_id, current_trace_id, current_traceparent
+from .client.trace import current_span_id, current_trace_id, current_traceparent, current_tracestate
 from .django import ApiLensDjangoMiddleware
 from .fastapi import ApiLensGatewayMiddleware, ApiLensMiddleware, set_consumer, track_consumer
 from .litestar import ApiLensPlugin
@@ -18,7 +18,9 @@ def install_apilens_exporter(*args, **kwargs):
 __all__ = [
     "ApiLensClient",
     "ApiLensConfig",
+    "AsyncApiLensClient",
     "RequestRecord",
+    "SamplingPolicy",
     "install_apilens_exporter",
     "ApiLensDjangoMiddleware",
     "ApiLensPlugin",
@@ -30,6 +32,7 @@ __all__ = [
     "current_trace_id",
     "current_span_id",
     "current_traceparent",
+    "current_tracestate",
     "span",
     "instrument_outbound_http",
     "__version__",
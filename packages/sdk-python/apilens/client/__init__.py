@@ -1,10 +1,14 @@
+from .aio import AsyncApiLensClient
 from .client import ApiLensClient, ApiLensConfig
 from .models import RequestRecord
 from .otel import install_apilens_exporter
+from .sampling import SamplingPolicy
 
 __all__ = [
     "ApiLensClient",
     "ApiLensConfig",
+    "AsyncApiLensClient",
     "RequestRecord",
+    "SamplingPolicy",
     "install_apilens_exporter",
 ]
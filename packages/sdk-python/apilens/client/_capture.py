@@ -24,7 +24,9 @@ class CaptureContext:
     base_url: str = ""
     trace_id: str = ""
     span_id: str = ""
-
+    # The request's head sampling decision (trace.begin_request_trace).
+    sampled: bool = True
+    sample_rate: float = 1.0
 
 
 def _headers_to_dict(headers: Iterable[tuple[bytes, bytes]]) -> dict[str, str]:
@@ -107,8 +109,20 @@ def capture_response(
     environment: str | None = None,
     response_payload: str = "",
     response_headers: str = "",
-) -> None:
+) -> float:
+    """Capture the finished request; returns the rate it was kept at (0.0 if sampled out)."""
     elapsed_ms = max((time.perf_counter() - started_at) * 1000.0, 0.0)
+    sample_rate = 1.0
+    policy = client.config.sampling
+    if policy is not None:
+        sample_rate = policy.keep_rate(
+            ctx.trace_id,
+            (ctx.sampled, ctx.sample_rate),
+            status_code=status_code,
+            response_time_ms=elapsed_ms,
+            consumer_id=ctx.consumer_id,
+            consumer_group=ctx.consumer_group,
+        )
     client.capture(
         method=ctx.method,
         path=ctx.path,
@@ -131,4 +145,7 @@ def capture_response(
         base_url=ctx.base_url,
         trace_id=ctx.trace_id,
         span_id=ctx.span_id,
+        sample_rate=sample_rate or 1.0,
+        sampled=sample_rate > 0.0,
     )
+    return sample_rate
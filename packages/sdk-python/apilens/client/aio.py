@@ -0,0 +1,266 @@
+"""``AsyncApiLensClient``: the client's queues drained on the running event loop.
+
+:class:`~apilens.client.client.ApiLensClient` uploads from a daemon thread
+with a blocking HTTP client. In an ASGI app that thread competes with the
+event loop for the GIL while it encodes batches, and it has nothing to do with
+the loop's own lifecycle. This client keeps the same queues, batching,
+retries, ``Retry-After`` pauses and combined ``/batch`` uploads, but the
+flusher is a task on the application's loop and uploads go through an async
+transport (``ASYNC_TRANSPORTS`` in transport.py). JSON encoding and
+compression run in the loop's default executor, so the loop itself only
+writes bytes to a socket.
+
+The ASGI middleware (and ``ApiLensGatewayMiddleware`` / ``ApiLensPlugin``)
+start it on ``lifespan.startup`` and flush and close it on
+``lifespan.shutdown``. Without a lifespan it starts on the first request.
+Standalone::
+
+    async with AsyncApiLensClient(ApiLensConfig(api_key="...")) as client:
+        client.capture(...)
+
+``capture()`` stays synchronous and thread-safe, so sync views running in a
+threadpool can keep calling it.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from collections.abc import Callable, Coroutine
+from typing import Any
+
+from .client import ApiLensClient, ApiLensConfig, EndpointUnsupported, RetryAfter
+from .transport import AsyncTransport, TransportError, create_async_transport, make_ssl_context
+
+logger = logging.getLogger("apilens")
+
+
+class AsyncApiLensClient(ApiLensClient):
+    def __init__(
+        self, config: ApiLensConfig, *, start_worker: bool = True, transport: AsyncTransport | None = None
+    ) -> None:
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread: int | None = None
+        self._task: asyncio.Task | None = None
+        self._wake: asyncio.Event | None = None
+        super().__init__(config, start_worker=start_worker, transport=transport)  # type: ignore[arg-type]
+
+    def _create_transport(self) -> AsyncTransport:  # type: ignore[override]
+        config = self.config
+        return create_async_transport(
+            config.transport,
+            make_ssl_context(config.verify_tls, config.ca_bundle_path),
+            pool_maxsize=config.pool_maxsize,
+            keepalive_expiry=config.keepalive_expiry,
+        )
+
+    def start(self) -> None:
+        """Start the flusher on the running loop; a no-op outside one (call it again from the loop)."""
+        if self._task is not None and not self._task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self._wake = asyncio.Event()
+        self._stop.clear()
+        self._task = loop.create_task(self._run(), name="apilens-flush")
+        if self._queue or self._span_queue:
+            self._wake.set()  # records captured before the loop was up
+
+    async def aclose(self, *, flush: bool = True, timeout: float = 10.0) -> None:
+        """Stop the flusher, upload what is left (within ``timeout``) and close the transport."""
+        self._stop.set()
+        task, self._task = self._task, None
+        if task is not None and not task.done() and task.get_loop() is asyncio.get_running_loop():
+            self._wake.set()
+            _, pending = await asyncio.wait({task}, timeout=timeout)
+            for stuck in pending:
+                stuck.cancel()
+        if flush:
+            self._drain_rollups(force=True)
+            try:
+                await asyncio.wait_for(self.aflush_all(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("API Lens flush timed out on shutdown; unsent records were dropped")
+        await self._transport.close()
+
+    async def __aenter__(self) -> "AsyncApiLensClient":
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.aclose(flush=True)
+
+    # The sync API still works from other threads (or once the loop is gone).
+
+    def flush_once(self) -> int:
+        return self._run_sync(self.aflush_once())
+
+    def flush_all(self) -> int:
+        return self._run_sync(self.aflush_all())
+
+    def shutdown(self, *, flush: bool = True, timeout: float = 10.0) -> None:
+        self._run_sync(self.aclose(flush=flush, timeout=timeout))
+
+    def _run_sync(self, coro: Coroutine[Any, Any, Any]) -> Any:
+        loop = self._loop
+        if loop is not None and loop.is_running():
+            if threading.get_ident() == self._loop_thread:
+                coro.close()
+                raise RuntimeError("AsyncApiLensClient is running on this loop; await aflush_all() / aclose() instead")
+            return asyncio.run_coroutine_threadsafe(coro, loop).result()
+        return asyncio.run(coro)
+
+    def _after_fork(self) -> None:
+        # The parent's loop and task don't exist here; the child's middleware
+        # (or lifespan) calls start() again on its own loop.
+        self._loop = None
+        self._loop_thread = None
+        self._task = None
+        self._wake = None
+        super()._after_fork()
+
+    def _notify(self) -> None:
+        loop, wake = self._loop, self._wake
+        if loop is None or wake is None:
+            return
+        if threading.get_ident() == self._loop_thread:
+            wake.set()
+            return
+        try:
+            loop.call_soon_threadsafe(wake.set)
+        except RuntimeError:
+            pass  # loop already closed; the records wait for the next start()
+
+    async def _run(self) -> None:
+        wake = self._wake
+        while not self._stop.is_set():
+            try:
+                await asyncio.wait_for(wake.wait(), self._paused_for() or self.config.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                await self.aflush_once()
+            except Exception:  # pragma: no cover
+                logger.exception("Unexpected error while flushing API Lens queue")
+
+    async def aflush_once(self) -> int:
+        if self._paused_for() > 0:
+            return 0
+        total = await self._aflush_rollups()
+        if self._paused_for() > 0:
+            return total
+        if self._batch_supported and self.config.combined_batches:
+            return total + await self._aflush_combined()
+        batch = self._pop_batch(self.config.batch_size)
+        if batch:
+            try:
+                if await self._asend_with_retry(self._requests_upload, batch):
+                    total += len(batch)
+                else:
+                    logger.warning("API Lens ingest failed; dropping batch of %d records", len(batch))
+            except RetryAfter as exc:
+                self._defer(exc.delay, (self._queue, batch))
+                return total
+
+        span_batch = self._pop_span_batch(self.config.batch_size)
+        if span_batch:
+            try:
+                if await self._asend_with_retry(self._spans_upload, span_batch):
+                    total += len(span_batch)
+                else:
+                    logger.warning("API Lens span ingest failed; dropping batch of %d spans", len(span_batch))
+            except RetryAfter as exc:
+                self._defer(exc.delay, (self._span_queue, span_batch))
+        return total
+
+    async def _aflush_rollups(self) -> int:
+        self._drain_rollups()
+        batch = self._pop_rollup_batch(self.config.batch_size)
+        if not batch:
+            return 0
+        try:
+            if await self._asend_with_retry(self._rollups_upload, batch):
+                return len(batch)
+            logger.warning("API Lens rollup ingest failed; dropping batch of %d rollups", len(batch))
+        except RetryAfter as exc:
+            self._defer(exc.delay, (self._rollup_queue, batch))
+        except EndpointUnsupported:
+            self._rollups_supported = False
+            logger.warning("API Lens ingest does not accept rollups; dropping %d rollups", len(batch))
+        return 0
+
+    async def _aflush_combined(self) -> int:
+        batch = self._pop_batch(self.config.batch_size)
+        span_batch = self._pop_span_batch(self.config.batch_size)
+        if not batch and not span_batch:
+            return 0
+        try:
+            sent = await self._asend_with_retry(self._combined_upload, (batch, span_batch))
+        except RetryAfter as exc:
+            self._defer(exc.delay, (self._queue, batch), (self._span_queue, span_batch))
+            return 0
+        except EndpointUnsupported:
+            self._batch_supported = False
+            self._requeue((self._queue, batch), (self._span_queue, span_batch))
+            return await self.aflush_once()
+        if not sent:
+            logger.warning(
+                "API Lens ingest failed; dropping batch of %d records and %d spans", len(batch), len(span_batch)
+            )
+            return 0
+        return len(batch) + len(span_batch)
+
+    async def aflush_all(self) -> int:
+        total = 0
+        while True:
+            n = await self.aflush_once()
+            if n == 0:
+                break
+            total += n
+        return total
+
+    async def _asend_with_retry(self, upload: Callable[[Any], tuple[str, dict]], batch) -> bool:
+        # Encoding and compression are CPU work; keep them off the loop.
+        path, url, body, headers = await asyncio.get_running_loop().run_in_executor(
+            None, self._prepare, upload, batch, uuid.uuid4().hex
+        )
+        last_error: Exception | None = None
+        for attempt in range(self.config.max_retries + 1):
+            headers["APILens-Sent-At"] = f"{time.time():.3f}"
+            try:
+                try:
+                    resp = await self._transport.post(url, body, headers, self.config.timeout)
+                except TransportError as exc:
+                    raise RuntimeError(f"Ingest network error: {exc}") from exc
+                self._check_response(path, resp)
+                return True
+            except RetryAfter:
+                raise
+            except EndpointUnsupported as exc:
+                if upload in (self._combined_upload, self._rollups_upload):
+                    raise  # handled by _aflush_combined / _aflush_rollups
+                last_error = exc
+                break
+            except Exception as exc:  # pragma: no cover
+                last_error = exc
+                if attempt >= self.config.max_retries:
+                    break
+                await asyncio.sleep(self._backoff(attempt))
+
+        if last_error is not None:
+            logger.warning("API Lens ingest request failed after retries: %s", last_error)
+        return False
+
+    def _prepare(self, upload: Callable[[Any], tuple[str, dict]], batch, idempotency_key: str):
+        path, payload = upload(batch)
+        return (path, *self._build_request(path, payload, idempotency_key))
@@ -1,22 +1,78 @@
 from __future__ import annotations
 
+import gzip
 import json
 import logging
-import ssl
+import os
+import random
 import threading
 import time
-import urllib.error
 import urllib.parse
-import urllib.request
+import uuid
+import weakref
 from collections import deque
 from dataclasses import dataclass
 from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
 from .._version import __version__
 from .models import RequestRecord, SpanRecord
+from .rollups import RollupAggregator
+from .sampling import SamplingPolicy
+from .transport import TRANSPORTS, Response, Transport, TransportError, create_transport, make_ssl_context
 
 logger = logging.getLogger("apilens")
 
+_GZIP_LEVEL = 5
+
+
+def _gzip(body: bytes) -> tuple[bytes, str]:
+    return gzip.compress(body, compresslevel=_GZIP_LEVEL, mtime=0), "gzip"
+
+
+def _zstd(body: bytes) -> tuple[bytes, str]:
+    try:
+        import zstandard
+    except ImportError:
+        return _gzip(body)
+    return zstandard.ZstdCompressor(level=3).compress(body), "zstd"
+
+
+_COMPRESSORS = {"gzip": _gzip, "zstd": _zstd, "none": None}
+
+
+class RetryAfter(RuntimeError):
+    """The server asked us to back off (429/503 with a Retry-After header)."""
+
+    def __init__(self, message: str, delay: float) -> None:
+        super().__init__(message)
+        self.delay = delay
+
+
+class EndpointUnsupported(RuntimeError):
+    """The server doesn't serve this path (404/405), e.g. /batch on an older ingest."""
+
+
+# Optional server endpoints, advertised on ingest responses ("batch" =
+# /batch, "rollups" = /rollups).
+_FEATURES_HEADER = "APILens-Features"
+
+
+def _retry_after_seconds(value: str | None) -> float | None:
+    # Retry-After is either delta-seconds or an HTTP-date.
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
 
 @dataclass(slots=True)
 class ApiLensConfig:
@@ -26,6 +82,28 @@ class ApiLensConfig:
     environment: str = "production"
     ingest_path: str = "/requests"
     spans_path: str = "/traces"
+    # Once the server advertises it, requests and spans are uploaded together
+    # in one POST to batch_path per flush instead of one POST each.
+    batch_path: str = "/batch"
+    combined_batches: bool = True
+
+    # Rollup mode (see rollups.py): every request is counted into per-minute
+    # rollups sent to rollups_path, and only errors (status >=
+    # rollup_raw_min_status), slow requests (>= rollup_slow_ms) and a
+    # rollup_sample_rate sample are sent as raw records too. Starts once the
+    # server advertises rollups; until then requests are sent raw. Requests
+    # that would need more than rollup_max_buckets open buckets are sent raw.
+    rollups: bool = False
+    rollups_path: str = "/rollups"
+    rollup_sample_rate: float = 0.001
+    rollup_slow_ms: float = 1000.0
+    rollup_raw_min_status: int = 400
+    rollup_max_buckets: int = 10_000
+
+    # Head-based sampling of middleware-captured requests and their spans
+    # (see sampling.py): per-route rates, per-consumer overrides, errors and
+    # slow requests always kept. None captures everything.
+    sampling: SamplingPolicy | None = None
 
     batch_size: int = 200
     flush_interval: float = 3.0
@@ -33,17 +111,65 @@ class ApiLensConfig:
     verify_tls: bool = True
     ca_bundle_path: str = ""
 
+    # HTTP backend: "stdlib", "httpx" or "urllib3" (see transport.py). Up to
+    # pool_maxsize connections per ingest host are kept alive between
+    # flushes, and dropped after keepalive_expiry idle seconds.
+    transport: str = "stdlib"
+    pool_maxsize: int = 2
+    keepalive_expiry: float = 30.0
+
+    # Request-body compression for uploads: "gzip", "zstd" (needs the
+    # `zstandard` package; falls back to gzip without it) or "none". Batches
+    # smaller than compression_threshold bytes are sent uncompressed.
+    compression: str = "gzip"
+    compression_threshold: int = 1024
+
     max_queue_size: int = 10_000
     max_retries: int = 3
     retry_backoff_base: float = 0.25
     retry_backoff_max: float = 5.0
+    # Upper bound on how long a server Retry-After pauses flushing; the
+    # batch is kept and re-sent afterwards instead of being retried at once.
+    max_retry_after: float = 60.0
 
     enabled: bool = True
     user_agent: str = f"apilenss/{__version__}"
 
 
+# Live clients, reset in forked children (gunicorn --preload, uWSGI, Celery
+# prefork): a child inherits the queues, a lock that may be held, pooled
+# sockets shared with the parent and no flush thread.
+_clients: weakref.WeakSet[ApiLensClient] = weakref.WeakSet()
+_forking: list[ApiLensClient] = []
+
+
+def _before_fork() -> None:
+    # Hold every queue lock so the child copies consistent, unlocked queues.
+    _forking[:] = list(_clients)
+    for client in _forking:
+        client._lock.acquire()
+
+
+def _after_fork_in_parent() -> None:
+    for client in _forking:
+        client._lock.release()
+    _forking.clear()
+
+
+def _after_fork_in_child() -> None:
+    for client in _forking:
+        client._after_fork()
+    _forking.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_before_fork, after_in_parent=_after_fork_in_parent, after_in_child=_after_fork_in_child)
+
+
 class ApiLensClient:
-    def __init__(self, config: ApiLensConfig, *, start_worker: bool = True) -> None:
+    def __init__(
+        self, config: ApiLensConfig, *, start_worker: bool = True, transport: Transport | None = None
+    ) -> None:
         if not config.api_key:
             raise ValueError("api_key is required")
         # project_slug is optional: the API key is project-level, so the server
@@ -53,19 +179,43 @@ class ApiLensClient:
             raise ValueError("batch_size must be > 0")
         if config.max_queue_size <= 0:
             raise ValueError("max_queue_size must be > 0")
+        if config.compression not in _COMPRESSORS:
+            raise ValueError(f"compression must be one of {sorted(_COMPRESSORS)}")
+        if not 0.0 <= config.rollup_sample_rate <= 1.0:
+            raise ValueError("rollup_sample_rate must be between 0 and 1")
 
         self.config = config
+        self._owns_transport = transport is None
+        self._transport = transport or self._create_transport()
+        self._pid = os.getpid()
         self._queue: deque[RequestRecord] = deque()
         self._span_queue: deque[SpanRecord] = deque()
+        self._rollups = RollupAggregator(max_buckets=config.rollup_max_buckets)
+        self._rollup_queue: deque[dict] = deque()
         self._lock = threading.Lock()
         self._stop = threading.Event()
         self._wakeup = threading.Event()
         self._thread: threading.Thread | None = None
         self._dropped = 0
+        self._resume_at = 0.0
+        self._batch_supported = False
+        self._rollups_supported = False
+        _clients.add(self)
 
         if start_worker and self.config.enabled:
             self.start()
 
+    def _create_transport(self) -> Transport:
+        config = self.config
+        if config.transport not in TRANSPORTS:
+            raise ValueError(f"transport must be one of {sorted(TRANSPORTS)}")
+        return create_transport(
+            config.transport,
+            make_ssl_context(config.verify_tls, config.ca_bundle_path),
+            pool_maxsize=config.pool_maxsize,
+            keepalive_expiry=config.keepalive_expiry,
+        )
+
     def start(self) -> None:
         if self._thread and self._thread.is_alive():
             return
@@ -75,6 +225,7 @@ class ApiLensClient:
 
     def shutdown(self, *, flush: bool = True, timeout: float = 10.0) -> None:
         if flush:
+            self._drain_rollups(force=True)
             self.flush_all()
 
         self._stop.set()
@@ -82,6 +233,7 @@ class ApiLensClient:
 
         if self._thread and self._thread.is_alive():
             self._thread.join(timeout=timeout)
+        self._transport.close()
 
     def __enter__(self) -> "ApiLensClient":
         self.start()
@@ -94,6 +246,31 @@ class ApiLensClient:
     def dropped_count(self) -> int:
         return self._dropped
 
+    def _after_fork(self) -> None:
+        """Start over in a forked child: new lock, queues, connections and worker.
+
+        Records queued at fork time stay with the parent, which still uploads
+        them; the child's copies are discarded instead of being sent twice.
+        A transport passed to the constructor is kept as is.
+        """
+        running = self._thread is not None and not self._stop.is_set()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._span_queue = deque()
+        self._rollups = RollupAggregator(max_buckets=self.config.rollup_max_buckets)
+        self._rollup_queue = deque()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._dropped = 0
+        self._resume_at = 0.0
+        if self._owns_transport:
+            # The inherited pool's sockets are shared with the parent.
+            self._transport = self._create_transport()
+        if running:
+            self.start()
+
     def capture(
         self,
         *,
@@ -119,6 +296,8 @@ class ApiLensClient:
         base_url: str = "",
         trace_id: str = "",
         span_id: str = "",
+        sample_rate: float = 1.0,
+        sampled: bool = True,
     ) -> None:
         record = RequestRecord(
             timestamp=timestamp or datetime.now(tz=timezone.utc),
@@ -143,13 +322,33 @@ class ApiLensClient:
             base_url=base_url,
             trace_id=trace_id,
             span_id=span_id,
+            sample_rate=sample_rate,
         )
-        self.capture_record(record)
+        self.capture_record(record, sampled=sampled)
 
-    def capture_record(self, record: RequestRecord) -> None:
+    def capture_record(self, record: RequestRecord, *, sampled: bool = True) -> None:
+        """Queue ``record``; with ``sampled=False`` it only counts toward rollups."""
         if not self.config.enabled:
             return
+        if self._pid != os.getpid():
+            self._after_fork()  # forked without the at-fork hooks (a C-level fork)
+        rolling_up = self.config.rollups and self._rollups_supported
+        if not sampled and not rolling_up:
+            return
+        raw = True
+        if rolling_up:
+            raw = (
+                record.status_code >= self.config.rollup_raw_min_status
+                or record.response_time_ms >= self.config.rollup_slow_ms
+                or random.random() < self.config.rollup_sample_rate
+            )
         with self._lock:
+            if rolling_up and self._rollups.add(record):
+                if not raw:
+                    return
+                record.rolled_up = True
+            elif not sampled:
+                return
             if len(self._queue) >= self.config.max_queue_size:
                 self._queue.popleft()
                 self._dropped += 1
@@ -157,7 +356,7 @@ class ApiLensClient:
             queue_size = len(self._queue)
 
         if queue_size >= self.config.batch_size:
-            self._wakeup.set()
+            self._notify()
 
     def capture_many(self, records: list[RequestRecord]) -> None:
         for record in records:
@@ -166,6 +365,8 @@ class ApiLensClient:
     def capture_span(self, record: SpanRecord) -> None:
         if not self.config.enabled:
             return
+        if self._pid != os.getpid():
+            self._after_fork()
         with self._lock:
             if len(self._span_queue) >= self.config.max_queue_size:
                 self._span_queue.popleft()
@@ -174,25 +375,113 @@ class ApiLensClient:
             queue_size = len(self._span_queue)
 
         if queue_size >= self.config.batch_size:
-            self._wakeup.set()
+            self._notify()
+
+    def _notify(self) -> None:
+        """Wake the flusher early: a queue reached batch_size."""
+        self._wakeup.set()
 
     def flush_once(self) -> int:
-        total = 0
+        if self._paused_for() > 0:
+            return 0
+        total = self._flush_rollups()
+        if self._paused_for() > 0:
+            return total
+        if self._batch_supported and self.config.combined_batches:
+            return total + self._flush_combined()
         batch = self._pop_batch(self.config.batch_size)
         if batch:
-            if self._send_batch_with_retry(batch, self._send_batch):
-                total += len(batch)
-            else:
-                logger.warning("API Lens ingest failed; dropping batch of %d records", len(batch))
+            try:
+                if self._send_batch_with_retry(batch, self._send_batch):
+                    total += len(batch)
+                else:
+                    logger.warning("API Lens ingest failed; dropping batch of %d records", len(batch))
+            except RetryAfter as exc:
+                self._defer(exc.delay, (self._queue, batch))
+                return total
 
         span_batch = self._pop_span_batch(self.config.batch_size)
         if span_batch:
-            if self._send_batch_with_retry(span_batch, self._send_span_batch):
-                total += len(span_batch)
-            else:
-                logger.warning("API Lens span ingest failed; dropping batch of %d spans", len(span_batch))
+            try:
+                if self._send_batch_with_retry(span_batch, self._send_span_batch):
+                    total += len(span_batch)
+                else:
+                    logger.warning("API Lens span ingest failed; dropping batch of %d spans", len(span_batch))
+            except RetryAfter as exc:
+                self._defer(exc.delay, (self._span_queue, span_batch))
         return total
 
+    def _flush_combined(self) -> int:
+        """One upload to ``batch_path`` carrying both queues' next batch."""
+        batch = self._pop_batch(self.config.batch_size)
+        span_batch = self._pop_span_batch(self.config.batch_size)
+        if not batch and not span_batch:
+            return 0
+        try:
+            sent = self._send_batch_with_retry((batch, span_batch), self._send_combined_batch)
+        except RetryAfter as exc:
+            self._defer(exc.delay, (self._queue, batch), (self._span_queue, span_batch))
+            return 0
+        except EndpointUnsupported:
+            # Ingest was rolled back to a version without /batch.
+            self._batch_supported = False
+            self._requeue((self._queue, batch), (self._span_queue, span_batch))
+            return self.flush_once()
+        if not sent:
+            logger.warning(
+                "API Lens ingest failed; dropping batch of %d records and %d spans", len(batch), len(span_batch)
+            )
+            return 0
+        return len(batch) + len(span_batch)
+
+    def _flush_rollups(self) -> int:
+        """Upload the next batch of finished rollups."""
+        self._drain_rollups()
+        batch = self._pop_rollup_batch(self.config.batch_size)
+        if not batch:
+            return 0
+        try:
+            if self._send_batch_with_retry(batch, self._send_rollup_batch):
+                return len(batch)
+            logger.warning("API Lens rollup ingest failed; dropping batch of %d rollups", len(batch))
+        except RetryAfter as exc:
+            self._defer(exc.delay, (self._rollup_queue, batch))
+        except EndpointUnsupported:
+            # Ingest was rolled back to a version without /rollups.
+            self._rollups_supported = False
+            logger.warning("API Lens ingest does not accept rollups; dropping %d rollups", len(batch))
+        return 0
+
+    def _drain_rollups(self, *, force: bool = False) -> None:
+        """Move finished minutes (every bucket with ``force``) to the upload queue."""
+        with self._lock:
+            if not len(self._rollups):
+                return
+            self._rollup_queue.extend(self._rollups.drain(time.time(), force=force))
+            while len(self._rollup_queue) > self.config.max_queue_size:
+                self._rollup_queue.popleft()
+                self._dropped += 1
+
+    def _paused_for(self) -> float:
+        return max(self._resume_at - time.monotonic(), 0.0)
+
+    def _requeue(self, *batches: tuple[deque, list]) -> None:
+        """Put unsent batches back at the head of their queues."""
+        with self._lock:
+            for queue, batch in batches:
+                queue.extendleft(reversed(batch))
+                while len(queue) > self.config.max_queue_size:
+                    queue.pop()
+                    self._dropped += 1
+
+    def _defer(self, delay: float, *batches: tuple[deque, list]) -> None:
+        """Put rate-limited batches back at the head and pause flushing."""
+        delay = min(delay, self.config.max_retry_after)
+        self._requeue(*batches)
+        with self._lock:
+            self._resume_at = time.monotonic() + delay
+        logger.info("API Lens ingest rate limited; pausing uploads for %.1fs", delay)
+
     def flush_all(self) -> int:
         total = 0
         while True:
@@ -204,7 +493,7 @@ class ApiLensClient:
 
     def _run_loop(self) -> None:
         while not self._stop.is_set():
-            self._wakeup.wait(self.config.flush_interval)
+            self._wakeup.wait(self._paused_for() or self.config.flush_interval)
             self._wakeup.clear()
             try:
                 self.flush_once()
@@ -220,6 +509,15 @@ class ApiLensClient:
                 batch.append(self._queue.popleft())
             return batch
 
+    def _pop_rollup_batch(self, size: int) -> list[dict]:
+        with self._lock:
+            if not self._rollup_queue:
+                return []
+            batch: list[dict] = []
+            for _ in range(min(size, len(self._rollup_queue))):
+                batch.append(self._rollup_queue.popleft())
+            return batch
+
     def _pop_span_batch(self, size: int) -> list[SpanRecord]:
         with self._lock:
             if not self._span_queue:
@@ -231,66 +529,113 @@ class ApiLensClient:
 
     def _send_batch_with_retry(self, batch, send=None) -> bool:
         send = send or self._send_batch
+        # One key for every attempt: if an earlier attempt was ingested but
+        # its response was lost, the server answers the retry from its
+        # Idempotency-Key index instead of storing the batch twice.
+        idempotency_key = uuid.uuid4().hex
         last_error: Exception | None = None
         for attempt in range(self.config.max_retries + 1):
             try:
-                send(batch)
+                send(batch, idempotency_key)
                 return True
+            except RetryAfter:
+                raise
+            except EndpointUnsupported as exc:
+                if send in (self._send_combined_batch, self._send_rollup_batch):
+                    raise  # handled by _flush_combined / _flush_rollups
+                last_error = exc
+                break
             except Exception as exc:  # pragma: no cover
                 last_error = exc
                 if attempt >= self.config.max_retries:
                     break
-                backoff = min(
-                    self.config.retry_backoff_base * (2 ** attempt),
-                    self.config.retry_backoff_max,
-                )
-                time.sleep(backoff)
+                time.sleep(self._backoff(attempt))
 
         if last_error is not None:
             logger.warning("API Lens ingest request failed after retries: %s", last_error)
         return False
 
-    def _send_batch(self, batch: list[RequestRecord]) -> None:
-        self._post_json(self.config.ingest_path, {"requests": [r.to_wire() for r in batch]})
+    def _backoff(self, attempt: int) -> float:
+        return min(self.config.retry_backoff_base * (2 ** attempt), self.config.retry_backoff_max)
+
+    def _send_batch(self, batch: list[RequestRecord], idempotency_key: str | None = None) -> None:
+        self._post_json(*self._requests_upload(batch), idempotency_key)
+
+    def _send_span_batch(self, batch: list[SpanRecord], idempotency_key: str | None = None) -> None:
+        self._post_json(*self._spans_upload(batch), idempotency_key)
+
+    def _send_rollup_batch(self, batch: list[dict], idempotency_key: str | None = None) -> None:
+        self._post_json(*self._rollups_upload(batch), idempotency_key)
+
+    def _send_combined_batch(
+        self, batches: tuple[list[RequestRecord], list[SpanRecord]], idempotency_key: str | None = None
+    ) -> None:
+        self._post_json(*self._combined_upload(batches), idempotency_key)
+
+    # (path, payload) of each upload kind.
+
+    def _requests_upload(self, batch: list[RequestRecord]) -> tuple[str, dict]:
+        return self.config.ingest_path, {"requests": [r.to_wire() for r in batch]}
+
+    def _spans_upload(self, batch: list[SpanRecord]) -> tuple[str, dict]:
+        return self.config.spans_path, {"spans": [s.to_wire() for s in batch]}
+
+    def _rollups_upload(self, batch: list[dict]) -> tuple[str, dict]:
+        return self.config.rollups_path, {"rollups": batch}
 
-    def _send_span_batch(self, batch: list[SpanRecord]) -> None:
-        self._post_json(self.config.spans_path, {"spans": [s.to_wire() for s in batch]})
+    def _combined_upload(self, batches: tuple[list[RequestRecord], list[SpanRecord]]) -> tuple[str, dict]:
+        requests, spans = batches
+        payload = {"requests": [r.to_wire() for r in requests], "spans": [s.to_wire() for s in spans]}
+        return self.config.batch_path, payload
 
-    def _post_json(self, path: str, payload: dict) -> None:
+    def _encode_body(self, payload: dict) -> tuple[bytes, dict[str, str]]:
         body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        compress = _COMPRESSORS.get(self.config.compression)
+        if compress is not None and len(body) >= self.config.compression_threshold:
+            body, encoding = compress(body)
+            headers["Content-Encoding"] = encoding
+        return body, headers
+
+    def _post_json(self, path: str, payload: dict, idempotency_key: str | None = None) -> None:
+        ingest_url, body, headers = self._build_request(path, payload, idempotency_key)
+        try:
+            resp = self._transport.post(ingest_url, body, headers, self.config.timeout)
+        except TransportError as exc:
+            raise RuntimeError(f"Ingest network error: {exc}") from exc
+        self._check_response(path, resp)
+
+    def _build_request(
+        self, path: str, payload: dict, idempotency_key: str | None = None
+    ) -> tuple[str, bytes, dict[str, str]]:
+        body, headers = self._encode_body(payload)
+        if idempotency_key:
+            headers["Idempotency-Key"] = idempotency_key
+        # Lets the server correct record timestamps for this host's clock skew.
+        headers["APILens-Sent-At"] = f"{time.time():.3f}"
 
         ingest_url = urllib.parse.urljoin(
             self.config.base_url.rstrip("/") + "/",
             path.lstrip("/"),
         )
-
-        req = urllib.request.Request(
-            ingest_url,
-            method="POST",
-            data=body,
-            headers={
-                "Content-Type": "application/json",
-                "X-API-Key": self.config.api_key,
-                "User-Agent": self.config.user_agent,
-            },
-        )
-
-        try:
-            ssl_context = None
-            if self.config.verify_tls:
-                ssl_context = ssl.create_default_context(
-                    cafile=self.config.ca_bundle_path or None
-                )
-            else:
-                ssl_context = ssl._create_unverified_context()  # noqa: SLF001
-
-            with urllib.request.urlopen(req, timeout=self.config.timeout, context=ssl_context) as resp:
-                status = getattr(resp, "status", 200)
-                if status >= 400:
-                    raise RuntimeError(f"API Lens ingest returned status={status}")
-        except urllib.error.HTTPError as exc:
-            if 400 <= exc.code < 500 and exc.code != 429:
-                raise RuntimeError(f"Non-retryable ingest error status={exc.code}") from exc
-            raise RuntimeError(f"Retryable ingest error status={exc.code}") from exc
-        except urllib.error.URLError as exc:
-            raise RuntimeError(f"Ingest network error: {exc}") from exc
+        headers["X-API-Key"] = self.config.api_key
+        headers["User-Agent"] = self.config.user_agent
+        return ingest_url, body, headers
+
+    def _check_response(self, path: str, resp: Response) -> None:
+        status = resp.status
+        if status < 400:
+            features = {f.strip() for f in (resp.headers.get(_FEATURES_HEADER) or "").split(",")}
+            self._batch_supported = "batch" in features
+            self._rollups_supported = "rollups" in features
+            return
+        if status in (429, 503):
+            delay = _retry_after_seconds(resp.headers.get("Retry-After"))
+            if delay is not None:
+                raise RetryAfter(f"Ingest asked to retry after {delay:.0f}s (status={status})", delay)
+        if status in (404, 405):
+            raise EndpointUnsupported(f"Ingest does not serve {path} (status={status})")
+        # 409: an attempt with the same Idempotency-Key is still in flight.
+        if 400 <= status < 500 and status not in (409, 429):
+            raise RuntimeError(f"Non-retryable ingest error status={status}")
+        raise RuntimeError(f"Retryable ingest error status={status}")
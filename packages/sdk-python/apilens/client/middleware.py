@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import contextvars
+import logging
 import time
 from collections.abc import Awaitable, Callable
 from typing import Any
@@ -17,9 +18,12 @@ from ._capture import (
     capture_response,
 )
 from ._sanitize import decode_utf8_safe, serialize_headers
+from .aio import AsyncApiLensClient
 from .client import ApiLensClient
 from .spans import configure_spans, env_spans_enabled, record_span
-from .trace import begin_request_trace, end_request_trace
+from .trace import begin_request_trace, current_sample_rate, current_sampled, end_request_trace
+
+logger = logging.getLogger("apilens")
 
 _consumer_ctx: contextvars.ContextVar[dict[str, str] | None] = contextvars.ContextVar(
     "apilens_consumer_ctx",
@@ -225,7 +229,12 @@ def set_consumer(
 
 
 class ApiLensASGIMiddleware:
-    """Generic ASGI middleware for HTTP request capture."""
+    """Generic ASGI middleware for HTTP request capture.
+
+    With an :class:`AsyncApiLensClient` the client's flusher runs on the
+    server's loop: started on ``lifespan.startup`` (or the first request),
+    flushed and closed on ``lifespan.shutdown``.
+    """
 
     def __init__(
         self,
@@ -247,6 +256,7 @@ class ApiLensASGIMiddleware:
     ) -> None:
         self.app = app
         self.client = client
+        self._async_client = isinstance(client, AsyncApiLensClient)
         self.project_slug = project_slug
         self.app_id = app_id
         self.environment = environment
@@ -274,18 +284,30 @@ class ApiLensASGIMiddleware:
 
     async def __call__(self, scope, receive, send) -> None:
         if scope.get("type") != "http":
+            if scope.get("type") == "lifespan" and self._async_client:
+                await self._lifespan(scope, receive, send)
+                return
             await self.app(scope, receive, send)
             return
+        if self._async_client:
+            self.client.start()  # no-op once running; covers servers without lifespan
 
         headers = _headers_to_dict(scope.get("headers", []))
         path = _normalize_path(scope.get("path", "/"))
-        trace_id, span_id, parent_span_id, trace_token = begin_request_trace(headers.get("traceparent"))
+        method = (scope.get("method") or "GET").upper()
+        trace_id, span_id, parent_span_id, trace_token = begin_request_trace(
+            headers.get("traceparent"),
+            tracestate=headers.get("tracestate"),
+            sampling=self.client.config.sampling,
+            method=method,
+            path=path,
+        )
 
         request_payload_chunks: list[bytes] = []
         request_payload_len = 0
 
         ctx = CaptureContext(
-            method=(scope.get("method") or "GET").upper(),
+            method=method,
             path=path,
             project_slug=self.project_slug or self.client.config.project_slug,
             app_id=self.app_id,
@@ -296,6 +318,8 @@ class ApiLensASGIMiddleware:
             request_headers=serialize_headers(headers) if self.capture_headers else "",
             trace_id=trace_id,
             span_id=span_id,
+            sampled=current_sampled(),
+            sample_rate=current_sample_rate(),
         )
 
         started_at = time.perf_counter()
@@ -362,7 +386,7 @@ class ApiLensASGIMiddleware:
             response_payload = decode_utf8_safe(b"".join(response_payload_chunks))
             ctx.request_payload = request_payload
             _apply_consumer(ctx, consumer)
-            capture_response(
+            sample_rate = capture_response(
                 self.client,
                 ctx,
                 status_code=status_code,
@@ -372,7 +396,7 @@ class ApiLensASGIMiddleware:
                 response_payload=response_payload,
                 response_headers=response_headers_json,
             )
-            if self.capture_spans:
+            if self.capture_spans and sample_rate:
                 record_span(
                     name=f"{ctx.method} {ctx.path}",
                     kind="server",
@@ -382,10 +406,31 @@ class ApiLensASGIMiddleware:
                     duration_ms=(time.perf_counter() - started_at) * 1000.0,
                     status="error" if status_code >= 500 else "ok",
                     status_code=status_code,
+                    sample_rate=sample_rate,
                 )
             _consumer_ctx.reset(token)
             end_request_trace(trace_token)
 
+    async def _lifespan(self, scope, receive, send) -> None:
+        client = self.client
+
+        async def wrapped_receive():
+            message = await receive()
+            if message.get("type") == "lifespan.startup":
+                client.start()
+            return message
+
+        async def wrapped_send(message: dict[str, Any]) -> None:
+            # Flush before the server is told it may exit.
+            if message.get("type") in ("lifespan.shutdown.complete", "lifespan.shutdown.failed"):
+                try:
+                    await client.aclose()
+                except Exception:
+                    logger.exception("API Lens client failed to close")
+            await send(message)
+
+        await self.app(scope, wrapped_receive, wrapped_send)
+
 
 class ApiLensWSGIMiddleware:
     """WSGI wrapper for Flask and other WSGI applications."""
@@ -438,9 +483,15 @@ class ApiLensWSGIMiddleware:
     def __call__(self, environ: dict[str, Any], start_response: Callable) -> Any:
         started_at = time.perf_counter()
         consumer_token = _consumer_ctx.set(None)
-        trace_id, span_id, parent_span_id, trace_token = begin_request_trace(environ.get("HTTP_TRACEPARENT"))
-
+        method = (environ.get("REQUEST_METHOD") or "GET").upper()
         path = _normalize_path(environ.get("PATH_INFO") or "/")
+        trace_id, span_id, parent_span_id, trace_token = begin_request_trace(
+            environ.get("HTTP_TRACEPARENT"),
+            tracestate=environ.get("HTTP_TRACESTATE"),
+            sampling=self.client.config.sampling,
+            method=method,
+            path=path,
+        )
         query = environ.get("QUERY_STRING")
         if query:
             path = f"{path}?{query}"
@@ -471,7 +522,7 @@ class ApiLensWSGIMiddleware:
         )
 
         ctx = CaptureContext(
-            method=(environ.get("REQUEST_METHOD") or "GET").upper(),
+            method=method,
             path=path,
             project_slug=self.project_slug or self.client.config.project_slug,
             app_id=self.app_id,
@@ -483,6 +534,8 @@ class ApiLensWSGIMiddleware:
             base_url=_detect_base_url_from_environ(environ),
             trace_id=trace_id,
             span_id=span_id,
+            sampled=current_sampled(),
+            sample_rate=current_sample_rate(),
         )
 
         status_code = 500
@@ -527,19 +580,9 @@ class ApiLensWSGIMiddleware:
             _apply_consumer(ctx, consumer)
             _consumer_ctx.reset(consumer_token)
             end_request_trace(trace_token)
-            if self.capture_spans:
-                record_span(
-                    name=f"{ctx.method} {ctx.path}",
-                    kind="server",
-                    trace_id=trace_id,
-                    span_id=span_id,
-                    parent_span_id=parent_span_id,
-                    duration_ms=(time.perf_counter() - started_at) * 1000.0,
-                    status="error" if status_code >= 500 else "ok",
-                    status_code=status_code,
-                )
+            duration_ms = (time.perf_counter() - started_at) * 1000.0
             response_payload = decode_utf8_safe(b"".join(response_payload_chunks))
-            capture_response(
+            sample_rate = capture_response(
                 self.client,
                 ctx,
                 status_code=status_code,
@@ -549,3 +592,15 @@ class ApiLensWSGIMiddleware:
                 response_payload=response_payload,
                 response_headers=response_headers_json,
             )
+            if self.capture_spans and sample_rate:
+                record_span(
+                    name=f"{ctx.method} {ctx.path}",
+                    kind="server",
+                    trace_id=trace_id,
+                    span_id=span_id,
+                    parent_span_id=parent_span_id,
+                    duration_ms=duration_ms,
+                    status="error" if status_code >= 500 else "ok",
+                    status_code=status_code,
+                    sample_rate=sample_rate,
+                )
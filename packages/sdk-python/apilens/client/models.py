@@ -28,6 +28,8 @@ class RequestRecord:
     base_url: str = ""
     trace_id: str = ""
     span_id: str = ""
+    rolled_up: bool = False  # also counted in a rollup (rollup mode)
+    sample_rate: float = 1.0  # stands for 1 / sample_rate requests (sampling.py)
 
     def to_wire(self) -> dict[str, object]:
         ts = self.timestamp
@@ -64,6 +66,8 @@ class RequestRecord:
             "base_url": self.base_url or "",
             "trace_id": self.trace_id or "",
             "span_id": self.span_id or "",
+            "rolled_up": self.rolled_up,
+            "sample_rate": float(self.sample_rate),
         }
 
 
@@ -93,6 +97,7 @@ class SpanRecord:
     project_slug: str = ""
     app_id: str = ""
     attributes: dict[str, str] | None = None
+    sample_rate: float = 1.0
 
     def to_wire(self) -> dict[str, object]:
         return {
@@ -110,4 +115,5 @@ class SpanRecord:
             "status": (self.status or "ok").lower(),
             "status_code": int(self.status_code or 0),
             "attributes": {str(k): str(v) for k, v in (self.attributes or {}).items()},
+            "sample_rate": float(self.sample_rate),
         }
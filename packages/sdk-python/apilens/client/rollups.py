@@ -0,0 +1,146 @@
+"""Per-minute request rollups (``ApiLensConfig(rollups=True)``).
+
+On a hot service most captured requests are fast 200s that only matter in
+aggregate. In rollup mode every request is counted into a bucket keyed by
+minute, app, environment, method, route, status code and consumer group,
+holding the request count, byte sums and a latency sketch. Finished minutes
+are uploaded to ``/v1/rollups``: one small record per bucket instead of one
+per request. The client still sends errors, slow requests and a small sample
+raw (flagged ``rolled_up`` so they aren't counted twice), for request lists
+and payloads.
+
+The sketch is a log-bucketed histogram: bin ``i`` counts latencies in
+``(GAMMA**(i-1), GAMMA**i]`` ms. Reading a quantile as its bin's midpoint is
+within 1% of the exact value, and sketches merge by adding counts, which is
+how the dashboard combines minutes, workers and hosts. Keep ``GAMMA`` in
+sync with apps/ingest (``SKETCH_GAMMA``).
+
+Routes are the path with id-like segments (integers, UUIDs, ULIDs, long hex)
+replaced by placeholders, as ingest does, so ``/orders/1`` and
+``/orders/2`` share a bucket.
+"""
+
+from __future__ import annotations
+
+import math
+import re
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from .models import RequestRecord
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(GAMMA)
+# Latencies outside this range (0, NaN, inf) are counted in the edge bins.
+MIN_LATENCY_MS = 0.001
+MAX_LATENCY_MS = 1e9
+
+_UUID = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+_ULID = re.compile(r"[0-7][0-9A-HJKMNP-TV-Za-hjkmnp-tv-z]{25}")
+_HEX = re.compile(r"[0-9a-fA-F]{16,}")
+
+
+def latency_bin(ms: float) -> int:
+    if not ms > MIN_LATENCY_MS:
+        ms = MIN_LATENCY_MS
+    return math.ceil(math.log(min(ms, MAX_LATENCY_MS)) / _LOG_GAMMA)
+
+
+def _segment(seg: str) -> str:
+    if not seg or seg[0] in "{:":
+        return seg
+    if seg.isdigit():
+        return "{id}"
+    n = len(seg)
+    if n == 36 and _UUID.fullmatch(seg):
+        return "{uuid}"
+    if n == 26 and _ULID.fullmatch(seg) and any(c.isdigit() for c in seg):
+        return "{ulid}"
+    if n >= 16 and _HEX.fullmatch(seg) and any(c.isdigit() for c in seg):
+        return "{hex}"
+    return seg
+
+
+@lru_cache(maxsize=4096)
+def route(path: str) -> str:
+    """``path`` with id-like segments replaced by placeholders."""
+    path = (path or "/").split("?", 1)[0].split("#", 1)[0]
+    if not path.startswith("/"):
+        path = f"/{path}"
+    return "/".join(_segment(seg) for seg in path.split("/"))
+
+
+def _epoch_seconds(ts: datetime) -> float:
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.timestamp()
+
+
+class _Bucket:
+    __slots__ = ("request_bytes", "response_bytes", "sketch")
+
+    def __init__(self) -> None:
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.sketch: dict[int, int] = {}
+
+
+class RollupAggregator:
+    """Buckets of one client; not thread-safe (the client holds its lock)."""
+
+    def __init__(self, *, interval: int = 60, max_buckets: int = 10_000) -> None:
+        self.interval = interval
+        self.max_buckets = max_buckets
+        self._buckets: dict[tuple, _Bucket] = {}
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def add(self, record: RequestRecord) -> bool:
+        """Count ``record``; False if that would need a bucket past ``max_buckets``."""
+        start = int(_epoch_seconds(record.timestamp)) // self.interval * self.interval
+        key = (
+            start,
+            record.project_slug or "",
+            record.app_id or "",
+            record.environment,
+            (record.method or "GET").upper(),
+            route(record.path),
+            int(record.status_code),
+            record.consumer_group or "",
+        )
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                return False
+            bucket = self._buckets[key] = _Bucket()
+        bucket.request_bytes += int(record.request_size or 0)
+        bucket.response_bytes += int(record.response_size or 0)
+        index = latency_bin(float(record.response_time_ms))
+        bucket.sketch[index] = bucket.sketch.get(index, 0) + 1
+        return True
+
+    def drain(self, now: float, *, force: bool = False) -> list[dict[str, object]]:
+        """Wire records of the buckets whose minute ended by ``now`` (all of them with ``force``)."""
+        done = [key for key in self._buckets if force or key[0] + self.interval <= now]
+        out = []
+        for key in done:
+            bucket = self._buckets.pop(key)
+            start, project_slug, app_id, environment, method, path, status_code, consumer_group = key
+            bins = sorted(bucket.sketch)
+            out.append({
+                "project_slug": project_slug,
+                "app_id": app_id,
+                "timestamp": datetime.fromtimestamp(start, timezone.utc).isoformat().replace("+00:00", "Z"),
+                "environment": environment,
+                "method": method,
+                "path": path,
+                "status_code": status_code,
+                "consumer_group": consumer_group,
+                "request_bytes": bucket.request_bytes,
+                "response_bytes": bucket.response_bytes,
+                "latency_bins": bins,
+                "latency_counts": [bucket.sketch[b] for b in bins],
+            })
+        return out
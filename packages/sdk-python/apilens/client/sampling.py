@@ -0,0 +1,121 @@
+"""Head-based request sampling (``ApiLensConfig(sampling=SamplingPolicy(...))``).
+
+Without a policy the middleware captures every request and its spans. With
+one, a request is kept with the rate of its route (``routes``), or of its
+consumer once the handler has identified it (``consumers``), else ``rate``.
+Requests with a status of at least ``keep_min_status`` or slower than
+``keep_slow_ms`` are always kept. Kept records carry the rate they were kept
+at as ``sample_rate`` (1 for always-kept ones), and the dashboard counts each
+as ``1 / sample_rate`` requests.
+
+The coin is the trace id's low 32 bits, the same value the ingest tail
+sampler uses, so every service in a trace, and ingest, draw the same number:
+a trace kept at rate ``r`` is kept at any rate above ``r`` too. The decision
+is propagated downstream in the ``traceparent`` sampled flag, with its rate
+in ``tracestate`` (``apilens=r:0.1``). A service with a policy follows an
+incoming decision that carries that entry; a ``traceparent`` without it (a
+gateway, a browser, another vendor) only supplies the trace id, since those
+often set the flag unconditionally.
+
+Route keys are a path or route (``"/health"``, ``"/orders/{id}"``, with the
+placeholders of :func:`~apilens.client.rollups.route`), optionally prefixed
+by a method (``"GET /orders/{id}"``). A trailing ``*`` matches by prefix
+(``"/internal/*"``). An exact key wins over a prefix, a longer prefix over a
+shorter one, and a key with a method over one without.
+
+Child spans and outbound calls follow the route decision: the consumer is
+usually identified after they start. A consumer override applies to the
+request record and its server span.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+
+from .rollups import route
+
+
+def sample_value(trace_id: str) -> float:
+    """A uniform [0, 1) value derived from the trace id (low 32 bits)."""
+    try:
+        return int(trace_id[-8:], 16) / 2**32
+    except ValueError:
+        return 0.0
+
+
+def _check_rate(name: str, rate: float) -> None:
+    if not 0.0 <= rate <= 1.0:
+        raise ValueError(f"{name} must be between 0 and 1")
+
+
+@dataclass(slots=True)
+class SamplingPolicy:
+    rate: float = 1.0
+    routes: dict[str, float] = field(default_factory=dict)
+    # Keyed by consumer id or consumer group; an id wins over its group.
+    consumers: dict[str, float] = field(default_factory=dict)
+    keep_min_status: int = 400
+    keep_slow_ms: float = 1000.0
+    _exact: dict[tuple[str, str], float] = field(default_factory=dict, init=False, repr=False, compare=False)
+    _prefixes: list[tuple[str, str, float]] = field(default_factory=list, init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        _check_rate("rate", self.rate)
+        for key, rate in self.routes.items():
+            _check_rate(f"routes[{key!r}]", rate)
+            method, sep, pattern = key.strip().partition(" ")
+            if not sep:
+                method, pattern = "", key.strip()
+            method, pattern = method.upper(), pattern.strip()
+            if pattern.endswith("*"):
+                self._prefixes.append((pattern[:-1], method, rate))
+            else:
+                self._exact[(method, route(pattern))] = rate
+        # Longest prefix first; with a method before without.
+        self._prefixes.sort(key=lambda p: (len(p[0]), bool(p[1])), reverse=True)
+        for key, rate in self.consumers.items():
+            _check_rate(f"consumers[{key!r}]", rate)
+
+    def route_rate(self, method: str, path: str) -> float:
+        method = (method or "GET").upper()
+        templated = route(path)
+        for key in ((method, templated), ("", templated)):
+            rate = self._exact.get(key)
+            if rate is not None:
+                return rate
+        for prefix, prefix_method, rate in self._prefixes:
+            if templated.startswith(prefix) and prefix_method in ("", method):
+                return rate
+        return self.rate
+
+    def head(self, trace_id: str, method: str, path: str) -> tuple[bool, float]:
+        """``(sampled, rate)`` for a request this service starts the decision for."""
+        rate = self.route_rate(method, path)
+        return sample_value(trace_id) < rate, rate
+
+    def keep_rate(
+        self,
+        trace_id: str,
+        head: tuple[bool, float],
+        *,
+        status_code: int,
+        response_time_ms: float,
+        consumer_id: str = "",
+        consumer_group: str = "",
+    ) -> float:
+        """Rate a finished request is kept at: 1 when always kept, 0 when dropped.
+
+        ``head`` is the request's ``(sampled, rate)`` decision, which stands
+        unless a consumer override applies.
+        """
+        if status_code >= self.keep_min_status or response_time_ms >= self.keep_slow_ms:
+            return 1.0
+        sampled, rate = head
+        consumers = self.consumers
+        if consumers:
+            override = consumers.get(consumer_id) if consumer_id else None
+            if override is None and consumer_group:
+                override = consumers.get(consumer_group)
+            if override is not None:
+                sampled, rate = sample_value(trace_id) < override, override
+        return rate if sampled else 0.0
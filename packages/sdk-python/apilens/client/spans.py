@@ -13,7 +13,8 @@ automatically (child ``http`` spans + ``traceparent`` propagation) when the
 middleware is installed with ``capture_spans=True``.
 
 Spans are silently dropped when there is no active trace (e.g. background
-jobs) or no middleware has been installed — ``span()`` is always safe to call.
+jobs), no middleware has been installed, or the request's sampling policy
+left it out (see sampling.py) — ``span()`` is always safe to call.
 """
 
 from __future__ import annotations
@@ -27,7 +28,16 @@ from datetime import datetime, timedelta, timezone
 from typing import TYPE_CHECKING, Any
 
 from .models import SpanRecord
-from .trace import _trace_ctx, current_span_id, current_trace_id, generate_span_id
+from .trace import (
+    _trace_ctx,
+    current_sample_rate,
+    current_sampled,
+    current_span_id,
+    current_trace_id,
+    current_tracestate,
+    format_traceparent,
+    generate_span_id,
+)
 
 if TYPE_CHECKING:
     from .client import ApiLensClient
@@ -114,6 +124,7 @@ def record_span(
     status_code: int = 0,
     attributes: dict[str, Any] | None = None,
     end_time: datetime | None = None,
+    sample_rate: float = 1.0,
 ) -> None:
     """Queue one finished span (no-op when spans are not configured)."""
     recorder = _recorder
@@ -136,6 +147,7 @@ def record_span(
             project_slug=recorder.client.config.project_slug,
             app_id=recorder.app_id,
             attributes=_clean_attributes(attributes),
+            sample_rate=sample_rate,
         )
     )
 
@@ -149,7 +161,7 @@ def span(name: str, *, kind: str = "internal", attributes: dict[str, Any] | None
     is re-raised.
     """
     trace_id = current_trace_id()
-    if not trace_id or _recorder is None:
+    if not trace_id or _recorder is None or not current_sampled():
         yield None
         return
 
@@ -174,6 +186,7 @@ def span(name: str, *, kind: str = "internal", attributes: dict[str, Any] | None
             duration_ms=(time.perf_counter() - started) * 1000.0,
             status=status,
             attributes=attributes,
+            sample_rate=current_sample_rate(),
         )
 
 
@@ -204,9 +217,18 @@ def _finish_http_span(
         status="error" if error or status_code >= 500 else "ok",
         status_code=status_code,
         attributes={"http.url": url, "http.method": method.upper()},
+        sample_rate=current_sample_rate(),
     )
 
 
+def _propagate(headers, trace_id: str, span_id: str, sampled: bool) -> None:
+    # An unsampled request still propagates, so downstream drops it too.
+    headers.setdefault("traceparent", format_traceparent(trace_id, span_id, sampled))
+    state = current_tracestate()
+    if state:
+        headers.setdefault("tracestate", state)
+
+
 def _strip_url(url: str) -> str:
     # Drop query string and userinfo — span names must not leak secrets.
     text = str(url)
@@ -221,6 +243,17 @@ def _strip_url(url: str) -> str:
     return text[:512]
 
 
+def _reset_locks_after_fork() -> None:
+    # A lock held by another thread at fork time stays held in the child.
+    global _recorder_lock, _http_lock
+    _recorder_lock = threading.Lock()
+    _http_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_locks_after_fork)
+
+
 def instrument_outbound_http() -> None:
     """Patch ``requests`` and ``httpx`` (when installed) so outbound calls
     made during a request become child ``http`` spans and carry a
@@ -259,10 +292,13 @@ def _patch_requests() -> None:
         url = _strip_url(request.url or "")
         if not trace_id or _recorder is None or _skips_own_ingest(url):
             return original(self, request, **kwargs)
+        if not current_sampled():
+            _propagate(request.headers, trace_id, current_span_id(), sampled=False)
+            return original(self, request, **kwargs)
 
         parent = current_span_id()
         span_id = generate_span_id()
-        request.headers.setdefault("traceparent", f"00-{trace_id}-{span_id}-01")
+        _propagate(request.headers, trace_id, span_id, sampled=True)
         method = request.method or "GET"
         started = time.perf_counter()
         try:
@@ -295,10 +331,13 @@ def _patch_httpx() -> None:
         url = _strip_url(str(request.url))
         if not trace_id or _recorder is None or _skips_own_ingest(url):
             return original_sync(self, request, **kwargs)
+        if not current_sampled():
+            _propagate(request.headers, trace_id, current_span_id(), sampled=False)
+            return original_sync(self, request, **kwargs)
 
         parent = current_span_id()
         span_id = generate_span_id()
-        request.headers.setdefault("traceparent", f"00-{trace_id}-{span_id}-01")
+        _propagate(request.headers, trace_id, span_id, sampled=True)
         method = request.method or "GET"
         started = time.perf_counter()
         try:
@@ -324,10 +363,13 @@ def _patch_httpx() -> None:
         url = _strip_url(str(request.url))
         if not trace_id or _recorder is None or _skips_own_ingest(url):
             return await original_async(self, request, **kwargs)
+        if not current_sampled():
+            _propagate(request.headers, trace_id, current_span_id(), sampled=False)
+            return await original_async(self, request, **kwargs)
 
         parent = current_span_id()
         span_id = generate_span_id()
-        request.headers.setdefault("traceparent", f"00-{trace_id}-{span_id}-01")
+        _propagate(request.headers, trace_id, span_id, sampled=True)
         method = request.method or "GET"
         started = time.perf_counter()
         try:
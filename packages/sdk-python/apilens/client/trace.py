@@ -4,6 +4,11 @@ Every captured request carries a ``trace_id`` (the whole distributed
 transaction) and a ``span_id`` (this service's handling of it). When the
 caller already propagates a valid ``traceparent`` header we continue that
 trace; otherwise we start a new one.
+
+With a :class:`~apilens.client.sampling.SamplingPolicy` the request also
+gets a sampling decision, read with :func:`current_sampled`, sent
+downstream in the ``traceparent`` flags and, with its rate, in
+``tracestate``. Without one every request is sampled, as before.
 """
 
 from __future__ import annotations
@@ -11,6 +16,10 @@ from __future__ import annotations
 import contextvars
 import re
 import secrets
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .sampling import SamplingPolicy
 
 _TRACEPARENT_RE = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
 
@@ -18,6 +27,13 @@ _trace_ctx: contextvars.ContextVar[tuple[str, str] | None] = contextvars.Context
     "apilens_trace_ctx",
     default=None,
 )
+# (sampled, rate) of the current request; None when no policy decided it.
+_sampling_ctx: contextvars.ContextVar[tuple[bool, float] | None] = contextvars.ContextVar(
+    "apilens_sampling_ctx",
+    default=None,
+)
+
+_TRACESTATE_KEY = "apilens"
 
 
 def parse_traceparent(header: str | None) -> tuple[str, str] | None:
@@ -45,7 +61,34 @@ def generate_span_id() -> str:
     return secrets.token_hex(8)
 
 
-def begin_request_trace(traceparent: str | None) -> tuple[str, str, str, contextvars.Token]:
+def parse_tracestate_rate(header: str | None) -> float | None:
+    """The sampling rate an upstream APILens service put in ``tracestate``."""
+    if not header:
+        return None
+    for member in header.split(","):
+        key, _, value = member.strip().partition("=")
+        if key != _TRACESTATE_KEY or not value.startswith("r:"):
+            continue
+        try:
+            rate = float(value[2:])
+        except ValueError:
+            return None
+        return rate if 0.0 <= rate <= 1.0 else None
+    return None
+
+
+def format_traceparent(trace_id: str, span_id: str, sampled: bool = True) -> str:
+    return f"00-{trace_id}-{span_id}-{'01' if sampled else '00'}"
+
+
+def begin_request_trace(
+    traceparent: str | None,
+    *,
+    tracestate: str | None = None,
+    sampling: "SamplingPolicy | None" = None,
+    method: str = "GET",
+    path: str = "/",
+) -> tuple[str, str, str, tuple[contextvars.Token, contextvars.Token]]:
     """Resolve the trace context for an incoming request.
 
     Continues the caller's trace when a valid ``traceparent`` is present,
@@ -53,17 +96,31 @@ def begin_request_trace(traceparent: str | None) -> tuple[str, str, str, context
     parent_span_id, token)`` — parent_span_id is the caller's span ("" for a
     new trace), which stitches cross-service traces together. The token must
     be passed to :func:`end_request_trace` when the request finishes.
+
+    With ``sampling``, the caller's decision is followed when it carries an
+    APILens rate in ``tracestate``; otherwise the policy decides from
+    ``method`` and ``path``.
     """
     parsed = parse_traceparent(traceparent)
     trace_id = parsed[0] if parsed else generate_trace_id()
     parent_span_id = parsed[1] if parsed else ""
     span_id = generate_span_id()
+    decision = None
+    if sampling is not None:
+        rate = parse_tracestate_rate(tracestate) if parsed else None
+        if rate is not None:
+            # The last byte of traceparent is the flags; bit 0 is "sampled".
+            decision = (bool(int(traceparent.strip()[-2:], 16) & 1), rate)
+        else:
+            decision = sampling.head(trace_id, method, path)
     token = _trace_ctx.set((trace_id, span_id))
-    return trace_id, span_id, parent_span_id, token
+    return trace_id, span_id, parent_span_id, (token, _sampling_ctx.set(decision))
 
 
-def end_request_trace(token: contextvars.Token) -> None:
-    _trace_ctx.reset(token)
+def end_request_trace(token: tuple[contextvars.Token, contextvars.Token]) -> None:
+    trace_token, sampling_token = token
+    _sampling_ctx.reset(sampling_token)
+    _trace_ctx.reset(trace_token)
 
 
 def current_trace_id() -> str:
@@ -82,6 +139,18 @@ def current_span_id() -> str:
     return ctx[1] if ctx else ""
 
 
+def current_sampled() -> bool:
+    """Whether the current request's spans are recorded (True without a policy)."""
+    decision = _sampling_ctx.get()
+    return decision[0] if decision else True
+
+
+def current_sample_rate() -> float:
+    """Rate the current request was sampled at (1.0 without a policy)."""
+    decision = _sampling_ctx.get()
+    return decision[1] if decision else 1.0
+
+
 def current_traceparent() -> str:
     """A ``traceparent`` header value for propagating to downstream services.
 
@@ -90,4 +159,15 @@ def current_traceparent() -> str:
     ctx = _trace_ctx.get()
     if not ctx:
         return ""
-    return f"00-{ctx[0]}-{ctx[1]}-01"
+    return format_traceparent(ctx[0], ctx[1], current_sampled())
+
+
+def current_tracestate() -> str:
+    """A ``tracestate`` header value carrying the sampling rate downstream.
+
+    Returns "" outside a request or when no sampling policy decided it.
+    """
+    decision = _sampling_ctx.get()
+    if not decision or not _trace_ctx.get():
+        return ""
+    return f"{_TRACESTATE_KEY}=r:{decision[1]:.6g}"
@@ -0,0 +1,449 @@
+"""HTTP transports for uploading batches to the ingest service.
+
+Every transport keeps connections open between flushes and builds its SSL
+context once, so a flush costs one request on a warm connection instead of a
+TCP + TLS handshake and a CA-bundle parse. Pick one with
+``ApiLensConfig.transport``:
+
+- ``"stdlib"`` (default): ``http.client`` keep-alive connections, no extra
+  dependencies.
+- ``"httpx"``: an ``httpx.Client`` (``pip install httpx``).
+- ``"urllib3"``: a ``urllib3.PoolManager`` (``pip install urllib3``).
+
+Or pass any object with ``post()`` and ``close()`` as ``ApiLensClient(...,
+transport=...)``.
+
+:class:`~apilens.client.aio.AsyncApiLensClient` uses the async twins
+(``ASYNC_TRANSPORTS``): ``"stdlib"`` is an asyncio-streams HTTP/1.1 client and
+``"httpx"`` an ``httpx.AsyncClient``. Their ``post()`` and ``close()`` are
+coroutines.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import email.parser
+import http.client
+import ssl
+import threading
+import time
+import urllib.parse
+from collections.abc import Mapping
+from dataclasses import dataclass
+from typing import Protocol
+
+
+class TransportError(OSError):
+    """The request didn't get an HTTP response (connect, TLS, timeout or reset)."""
+
+
+@dataclass(slots=True)
+class Response:
+    status: int
+    headers: Mapping[str, str]  # case-insensitive lookups
+
+
+class Transport(Protocol):
+    def post(self, url: str, body: bytes, headers: dict[str, str], timeout: float) -> Response:
+        """POST ``body``; any HTTP status is returned, network failures raise TransportError."""
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+class AsyncTransport(Protocol):
+    async def post(self, url: str, body: bytes, headers: dict[str, str], timeout: float) -> Response:
+        ...
+
+    async def close(self) -> None:
+        ...
+
+
+def make_ssl_context(verify_tls: bool = True, ca_bundle_path: str = "") -> ssl.SSLContext:
+    if not verify_tls:
+        return ssl._create_unverified_context()  # noqa: SLF001
+    return ssl.create_default_context(cafile=ca_bundle_path or None)
+
+
+# Errors that mean a kept-alive connection was closed by the server (or an
+# idle-timeout proxy) before our request went out; resending is safe.
+_STALE_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    BrokenPipeError,
+    ConnectionResetError,
+    ConnectionAbortedError,
+)
+
+
+class _Conn:
+    __slots__ = ("conn", "idle_since")
+
+    def __init__(self, conn: http.client.HTTPConnection) -> None:
+        self.conn = conn
+        self.idle_since = 0.0
+
+
+class StdlibTransport:
+    """Pooled ``http.client`` keep-alive connections per (scheme, host, port).
+
+    One request per connection at a time (no pipelining). A connection that
+    fails before a response is read is dropped; if it had been reused, the
+    request is sent once more on a fresh connection.
+    """
+
+    def __init__(
+        self,
+        ssl_context: ssl.SSLContext | None = None,
+        *,
+        pool_maxsize: int = 2,
+        keepalive_expiry: float = 30.0,
+    ) -> None:
+        self._ssl_context = ssl_context or make_ssl_context()
+        self._pool_maxsize = pool_maxsize
+        self._keepalive_expiry = keepalive_expiry
+        self._idle: dict[tuple[str, str, int], list[_Conn]] = {}
+        self._lock = threading.Lock()
+
+    def post(self, url: str, body: bytes, headers: dict[str, str], timeout: float) -> Response:
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ("http", "https"):
+            raise TransportError(f"Unsupported URL scheme: {parts.scheme!r}")
+        key = (scheme, parts.hostname or "", parts.port or (443 if scheme == "https" else 80))
+        target = parts.path or "/"
+        if parts.query:
+            target = f"{target}?{parts.query}"
+
+        conn, reused = self._checkout(key, timeout)
+        try:
+            return self._send(key, conn, target, body, headers)
+        except _STALE_ERRORS as exc:
+            conn.conn.close()
+            if not reused:
+                raise TransportError(str(exc) or type(exc).__name__) from exc
+        except (OSError, http.client.HTTPException) as exc:
+            conn.conn.close()
+            raise TransportError(str(exc) or type(exc).__name__) from exc
+
+        conn = self._connect(key, timeout)
+        try:
+            return self._send(key, conn, target, body, headers)
+        except (OSError, http.client.HTTPException) as exc:
+            conn.conn.close()
+            raise TransportError(str(exc) or type(exc).__name__) from exc
+
+    def _send(self, key, conn: _Conn, target: str, body: bytes, headers: dict[str, str]) -> Response:
+        conn.conn.request("POST", target, body=body, headers=headers)
+        resp = conn.conn.getresponse()
+        resp.read()  # drain, or the connection can't carry the next request
+        response = Response(resp.status, resp.headers)
+        if resp.will_close:
+            conn.conn.close()
+        else:
+            self._checkin(key, conn)
+        return response
+
+    def _checkout(self, key: tuple[str, str, int], timeout: float) -> tuple[_Conn, bool]:
+        now = time.monotonic()
+        stale: list[_Conn] = []
+        found: _Conn | None = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn = idle.pop()
+                if now - conn.idle_since < self._keepalive_expiry:
+                    found = conn
+                    break
+                stale.append(conn)
+        for conn in stale:
+            conn.conn.close()
+        if found is None:
+            return self._connect(key, timeout), False
+        found.conn.timeout = timeout
+        if found.conn.sock is not None:
+            found.conn.sock.settimeout(timeout)
+        return found, True
+
+    def _connect(self, key: tuple[str, str, int], timeout: float) -> _Conn:
+        scheme, host, port = key
+        if scheme == "https":
+            return _Conn(http.client.HTTPSConnection(host, port, timeout=timeout, context=self._ssl_context))
+        return _Conn(http.client.HTTPConnection(host, port, timeout=timeout))
+
+    def _checkin(self, key: tuple[str, str, int], conn: _Conn) -> None:
+        conn.idle_since = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._pool_maxsize:
+                idle.append(conn)
+                return
+        conn.conn.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.conn.close()
+
+
+class HttpxTransport:
+    def __init__(
+        self,
+        ssl_context: ssl.SSLContext | None = None,
+        *,
+        pool_maxsize: int = 2,
+        keepalive_expiry: float = 30.0,
+    ) -> None:
+        import httpx
+
+        self._httpx = httpx
+        self._client = httpx.Client(
+            verify=ssl_context or make_ssl_context(),
+            limits=httpx.Limits(max_keepalive_connections=pool_maxsize, keepalive_expiry=keepalive_expiry),
+        )
+
+    def post(self, url: str, body: bytes, headers: dict[str, str], timeout: float) -> Response:
+        try:
+            resp = self._client.post(url, content=body, headers=headers, timeout=timeout)
+        except self._httpx.TransportError as exc:
+            raise TransportError(str(exc) or type(exc).__name__) from exc
+        return Response(resp.status_code, resp.headers)
+
+    def close(self) -> None:
+        self._client.close()
+
+
+class Urllib3Transport:
+    def __init__(
+        self,
+        ssl_context: ssl.SSLContext | None = None,
+        *,
+        pool_maxsize: int = 2,
+        keepalive_expiry: float = 30.0,  # unused: urllib3 checks for dropped connections on reuse
+    ) -> None:
+        import urllib3
+
+        self._urllib3 = urllib3
+        self._pool = urllib3.PoolManager(
+            maxsize=pool_maxsize,
+            ssl_context=ssl_context or make_ssl_context(),
+            # Retries and backoff stay with ApiLensClient.
+            retries=False,
+        )
+
+    def post(self, url: str, body: bytes, headers: dict[str, str], timeout: float) -> Response:
+        try:
+            resp = self._pool.request("POST", url, body=body, headers=headers, timeout=timeout)
+        except self._urllib3.exceptions.HTTPError as exc:
+            raise TransportError(str(exc) or type(exc).__name__) from exc
+        return Response(resp.status, resp.headers)
+
+    def close(self) -> None:
+        self._pool.clear()
+
+
+TRANSPORTS = {"stdlib": StdlibTransport, "httpx": HttpxTransport, "urllib3": Urllib3Transport}
+
+
+class _StaleConnection(ConnectionError):
+    """The server closed a kept-alive connection before answering."""
+
+
+class _AsyncConn:
+    __slots__ = ("reader", "writer", "loop", "idle_since")
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.idle_since = 0.0
+
+    def close(self) -> None:
+        if not self.loop.is_closed():
+            self.writer.close()
+
+
+def _split_url(url: str) -> tuple[tuple[str, str, int], str, str]:
+    """((scheme, host, port), request target, Host header) of an http(s) URL."""
+    parts = urllib.parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    if scheme not in ("http", "https"):
+        raise TransportError(f"Unsupported URL scheme: {parts.scheme!r}")
+    default_port = 443 if scheme == "https" else 80
+    host = parts.hostname or ""
+    port = parts.port or default_port
+    target = parts.path or "/"
+    if parts.query:
+        target = f"{target}?{parts.query}"
+    host_header = host if port == default_port else f"{host}:{port}"
+    return (scheme, host, port), target, host_header
+
+
+class AsyncStdlibTransport:
+    """:class:`StdlibTransport` on asyncio streams: keep-alive HTTP/1.1, no extra dependencies."""
+
+    def __init__(
+        self,
+        ssl_context: ssl.SSLContext | None = None,
+        *,
+        pool_maxsize: int = 2,
+        keepalive_expiry: float = 30.0,
+    ) -> None:
+        self._ssl_context = ssl_context or make_ssl_context()
+        self._pool_maxsize = pool_maxsize
+        self._keepalive_expiry = keepalive_expiry
+        self._idle: dict[tuple[str, str, int], list[_AsyncConn]] = {}
+
+    async def post(self, url: str, body: bytes, headers: dict[str, str], timeout: float) -> Response:
+        key, target, host_header = _split_url(url)
+        head = [f"POST {target} HTTP/1.1", f"Host: {host_header}", f"Content-Length: {len(body)}"]
+        head.extend(f"{name}: {value}" for name, value in headers.items())
+        request = ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+
+        conn = self._checkout(key)
+        if conn is not None:
+            try:
+                return await asyncio.wait_for(self._send(key, conn, request), timeout)
+            except (_StaleConnection, ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+                conn.close()  # closed while idle; resend on a fresh connection
+            except (OSError, asyncio.TimeoutError, ValueError) as exc:
+                conn.close()
+                raise TransportError(str(exc) or type(exc).__name__) from exc
+
+        conn = None
+        try:
+            conn = await asyncio.wait_for(self._connect(key), timeout)
+            return await asyncio.wait_for(self._send(key, conn, request), timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as exc:
+            if conn is not None:
+                conn.close()
+            raise TransportError(str(exc) or type(exc).__name__) from exc
+
+    async def _send(self, key: tuple[str, str, int], conn: _AsyncConn, request: bytes) -> Response:
+        conn.writer.write(request)
+        await conn.writer.drain()
+        status_line = await conn.reader.readline()
+        if not status_line:
+            raise _StaleConnection("connection closed before a response")
+        version, status, *_ = status_line.decode("latin-1").split(" ", 2)
+        raw_headers = bytearray()
+        while True:
+            line = await conn.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            raw_headers += line
+        headers = email.parser.Parser(_class=http.client.HTTPMessage).parsestr(raw_headers.decode("latin-1"))
+
+        will_close = version == "HTTP/1.0" or (headers.get("Connection") or "").lower() == "close"
+        if (headers.get("Transfer-Encoding") or "").lower() == "chunked":
+            while True:
+                size = int((await conn.reader.readline()).split(b";", 1)[0], 16)
+                await conn.reader.readexactly(size + 2)  # chunk + CRLF
+                if size == 0:
+                    break
+        elif headers.get("Content-Length") is not None:
+            await conn.reader.readexactly(int(headers["Content-Length"]))
+        else:
+            await conn.reader.read()
+            will_close = True
+
+        if will_close:
+            conn.close()
+        else:
+            self._checkin(key, conn)
+        return Response(int(status), headers)
+
+    def _checkout(self, key: tuple[str, str, int]) -> _AsyncConn | None:
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        idle = self._idle.get(key, [])
+        while idle:
+            conn = idle.pop()
+            # Connections opened on another (finished) loop can't be reused.
+            if conn.loop is loop and now - conn.idle_since < self._keepalive_expiry and not conn.reader.at_eof():
+                return conn
+            conn.close()
+        return None
+
+    async def _connect(self, key: tuple[str, str, int]) -> _AsyncConn:
+        scheme, host, port = key
+        if scheme == "https":
+            reader, writer = await asyncio.open_connection(host, port, ssl=self._ssl_context, server_hostname=host)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return _AsyncConn(reader, writer)
+
+    def _checkin(self, key: tuple[str, str, int], conn: _AsyncConn) -> None:
+        conn.idle_since = time.monotonic()
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self._pool_maxsize:
+            idle.append(conn)
+        else:
+            conn.close()
+
+    async def close(self) -> None:
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+class AsyncHttpxTransport:
+    def __init__(
+        self,
+        ssl_context: ssl.SSLContext | None = None,
+        *,
+        pool_maxsize: int = 2,
+        keepalive_expiry: float = 30.0,
+    ) -> None:
+        import httpx
+
+        self._httpx = httpx
+        self._client = httpx.AsyncClient(
+            verify=ssl_context or make_ssl_context(),
+            limits=httpx.Limits(max_keepalive_connections=pool_maxsize, keepalive_expiry=keepalive_expiry),
+        )
+
+    async def post(self, url: str, body: bytes, headers: dict[str, str], timeout: float) -> Response:
+        try:
+            resp = await self._client.post(url, content=body, headers=headers, timeout=timeout)
+        except self._httpx.TransportError as exc:
+            raise TransportError(str(exc) or type(exc).__name__) from exc
+        return Response(resp.status_code, resp.headers)
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+ASYNC_TRANSPORTS = {"stdlib": AsyncStdlibTransport, "httpx": AsyncHttpxTransport}
+
+
+def create_transport(
+    name: str,
+    ssl_context: ssl.SSLContext | None = None,
+    *,
+    pool_maxsize: int = 2,
+    keepalive_expiry: float = 30.0,
+) -> Transport:
+    try:
+        cls = TRANSPORTS[name]
+    except KeyError:
+        raise ValueError(f"transport must be one of {sorted(TRANSPORTS)}") from None
+    return cls(ssl_context, pool_maxsize=pool_maxsize, keepalive_expiry=keepalive_expiry)
+
+
+def create_async_transport(
+    name: str,
+    ssl_context: ssl.SSLContext | None = None,
+    *,
+    pool_maxsize: int = 2,
+    keepalive_expiry: float = 30.0,
+) -> AsyncTransport:
+    try:
+        cls = ASYNC_TRANSPORTS[name]
+    except KeyError:
+        raise ValueError(f"async transport must be one of {sorted(ASYNC_TRANSPORTS)}") from None
+    return cls(ssl_context, pool_maxsize=pool_maxsize, keepalive_expiry=keepalive_expiry)
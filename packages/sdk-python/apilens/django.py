@@ -15,8 +15,10 @@ from .client.middleware import (
     track_consumer,
 )
 from .client.spans import configure_spans, env_spans_enabled, record_span
-from .client.trace import begin_request_trace, end_request_trace
+from .client.trace import begin_request_trace, current_sample_rate, current_sampled, end_request_trace
 
+# One client per process. Created in the master under gunicorn --preload, it
+# resets itself in each forked worker (ApiLensClient._after_fork).
 _client_singleton: ApiLensClient | None = None
 
 
@@ -61,6 +63,8 @@ def _get_client_from_settings() -> ApiLensClient:
         environment=getattr(settings, "APILENS_ENVIRONMENT", "production"),
         batch_size=int(getattr(settings, "APILENS_BATCH_SIZE", 200)),
         flush_interval=float(getattr(settings, "APILENS_FLUSH_INTERVAL", 3.0)),
+        # Optional apilens.SamplingPolicy; None captures every request.
+        sampling=getattr(settings, "APILENS_SAMPLING", None),
     )
     _client_singleton = ApiLensClient(cfg)
     return _client_singleton
@@ -143,7 +147,14 @@ class ApiLensDjangoMiddleware:
         status_code = 500
         response_size = 0
         consumer_token = _consumer_ctx.set(None)
-        trace_id, span_id, parent_span_id, trace_token = begin_request_trace(request.META.get("HTTP_TRACEPARENT"))
+        path = _normalize_path(getattr(request, "path", "/") or "/")
+        trace_id, span_id, parent_span_id, trace_token = begin_request_trace(
+            request.META.get("HTTP_TRACEPARENT"),
+            tracestate=request.META.get("HTTP_TRACESTATE"),
+            sampling=self.client.config.sampling,
+            method=request.method or "GET",
+            path=path,
+        )
 
         xff = (request.META.get("HTTP_X_FORWARDED_FOR") or "").strip()
         if xff:
@@ -158,7 +169,7 @@ class ApiLensDjangoMiddleware:
 
         ctx = CaptureContext(
             method=(request.method or "GET").upper(),
-            path=_normalize_path(getattr(request, "path", "/") or "/"),
+            path=path,
             project_slug=self.project_slug or self.client.config.project_slug,
             app_id=self.app_id,
             request_size=_to_int(request.META.get("CONTENT_LENGTH"), 0),
@@ -167,6 +178,8 @@ class ApiLensDjangoMiddleware:
             base_url=base_url,
             trace_id=trace_id,
             span_id=span_id,
+            sampled=current_sampled(),
+            sample_rate=current_sample_rate(),
         )
         if self.capture_headers:
             try:
@@ -204,26 +217,28 @@ class ApiLensDjangoMiddleware:
             _apply_consumer(ctx, consumer)
             _consumer_ctx.reset(consumer_token)
             end_request_trace(trace_token)
-            if self.capture_spans:
+            duration_ms = (time.perf_counter() - started_at) * 1000.0
+            sample_rate = capture_response(
+                self.client,
+                ctx,
+                status_code=status_code,
+                response_size=response_size,
+                started_at=started_at,
+                response_payload=locals().get("response_payload", ""),
+                response_headers=response_headers,
+            )
+            if self.capture_spans and sample_rate:
                 record_span(
                     name=f"{ctx.method} {ctx.path}",
                     kind="server",
                     trace_id=trace_id,
                     span_id=span_id,
                     parent_span_id=parent_span_id,
-                    duration_ms=(time.perf_counter() - started_at) * 1000.0,
+                    duration_ms=duration_ms,
                     status="error" if status_code >= 500 else "ok",
                     status_code=status_code,
+                    sample_rate=sample_rate,
                 )
-            capture_response(
-                self.client,
-                ctx,
-                status_code=status_code,
-                response_size=response_size,
-                started_at=started_at,
-                response_payload=locals().get("response_payload", ""),
-                response_headers=response_headers,
-            )
 
 
 def instrument_app(app: Any, client: ApiLensClient | None = None, *, environment: str | None = None) -> Any:
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from typing import Any, Callable
 
-from .client import ApiLensClient, ApiLensConfig
+from .client import ApiLensClient, ApiLensConfig, AsyncApiLensClient
 from .client.middleware import ApiLensASGIMiddleware
 from .frameworks.fastapi import instrument_fastapi, set_consumer, track_consumer
 
@@ -20,6 +20,10 @@ class ApiLensGatewayMiddleware(ApiLensASGIMiddleware):
             base_url="https://ingest.apilens.ai/v1",
             env="production",
         )
+
+    Without a ``client`` it builds an :class:`AsyncApiLensClient` that uploads
+    from the app's event loop and flushes on lifespan shutdown;
+    ``async_client=False`` uses the threaded :class:`ApiLensClient` instead.
     """
 
     def __init__(
@@ -42,6 +46,7 @@ class ApiLensGatewayMiddleware(ApiLensASGIMiddleware):
         service_name: str = "",
         max_payload_bytes: int = 65536,
         get_consumer: Callable[..., Any] | None = None,
+        async_client: bool = True,
     ) -> None:
         resolved_key = (api_key or client_id or "").strip()
         resolved_project_slug = project_slug.strip()
@@ -49,7 +54,8 @@ class ApiLensGatewayMiddleware(ApiLensASGIMiddleware):
             if not resolved_key:
                 raise ValueError("api_key (or client_id) is required")
             # project_slug is optional: the project-level key identifies it.
-            client = ApiLensClient(
+            client_cls = AsyncApiLensClient if async_client else ApiLensClient
+            client = client_cls(
                 ApiLensConfig(
                     api_key=resolved_key,
                     project_slug=resolved_project_slug,
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 
-from .client import ApiLensClient
+from .client import ApiLensClient, AsyncApiLensClient
 from .client.middleware import ApiLensASGIMiddleware
 
 
@@ -18,7 +18,9 @@ class ApiLensPlugin:
         )
 
     ``app_id`` selects which app in the project the traffic belongs to and is
-    required for ingestion (and for span capture).
+    required for ingestion (and for span capture). An
+    :class:`~apilens.client.aio.AsyncApiLensClient` is started and closed
+    with the app's startup and shutdown hooks.
     """
 
     client: ApiLensClient
@@ -49,6 +51,18 @@ class ApiLensPlugin:
             )
         )
         app_config.middleware = middleware
+        if isinstance(self.client, AsyncApiLensClient):
+            # Litestar runs the lifespan itself; it never reaches middleware.
+            client = self.client
+
+            async def start_apilens() -> None:
+                client.start()
+
+            async def close_apilens() -> None:
+                await client.aclose()
+
+            app_config.on_startup = [*(getattr(app_config, "on_startup", None) or []), start_apilens]
+            app_config.on_shutdown = [*(getattr(app_config, "on_shutdown", None) or []), close_apilens]
         return app_config
 
 
@@ -0,0 +1,217 @@
+"""Event-loop lag under capture load: threaded ApiLensClient vs AsyncApiLensClient.
+
+Runs an asyncio loop that captures records at a fixed rate (as an ASGI app's
+middleware would) while a probe task measures how late its timer wake-ups
+are. That lateness is the delay every request on the loop would see. The
+ingest side is a stub HTTP server in a child process that answers each upload
+after ``--latency-ms``, so the server's own CPU doesn't compete with the loop.
+
+Reported per client: p50/p99/max loop lag, records uploaded, records dropped
+and uploads made.
+
+    cd packages/sdk-python
+    python -m benchmarks.loop_lag_bench --duration 10
+    python -m benchmarks.loop_lag_bench --rate 5000 --payload-bytes 2048 --transport httpx
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gzip
+import json
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from apilens.client.aio import AsyncApiLensClient
+from apilens.client.client import ApiLensClient, ApiLensConfig
+
+CLIENTS = {"threaded": ApiLensClient, "async": AsyncApiLensClient}
+
+
+# --- stub ingest --------------------------------------------------------------
+
+def serve(port: int, latency: float) -> None:
+    stats = {"uploads": 0, "records": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self) -> None:
+            self._reply(200, json.dumps(stats).encode())
+
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            payload = json.loads(body)
+            time.sleep(latency)
+            stats["uploads"] += 1
+            stats["records"] += len(payload.get("requests", ())) + len(payload.get("spans", ()))
+            self._reply(200, b'{"accepted":1}')
+
+        def _reply(self, status: int, body: bytes) -> None:
+            self.send_response(status)
+            self.send_header("APILens-Features", "batch")
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args) -> None:
+            pass
+
+    ThreadingHTTPServer(("127.0.0.1", port), Handler).serve_forever()
+
+
+def _stats(port: int) -> dict:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=5) as resp:
+        return json.loads(resp.read())
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_ready(port: int, proc: subprocess.Popen) -> None:
+    for _ in range(100):
+        if proc.poll() is not None:
+            raise RuntimeError(f"stub ingest exited with {proc.returncode}")
+        try:
+            _stats(port)
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("stub ingest did not start")
+
+
+# --- load + probe -------------------------------------------------------------
+
+async def _capture_load(client: ApiLensClient, rate: float, payload: str, deadline: float) -> int:
+    """Capture ``rate`` records/s in 1 ms slices, like middleware on a busy loop."""
+    captured = 0
+    start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        due = int((time.perf_counter() - start) * rate)
+        while captured < due:
+            client.capture(
+                method="POST",
+                path=f"/v1/orders/{captured % 300}",
+                status_code=200,
+                response_time_ms=12.5,
+                app_id="bench",
+                request_payload=payload,
+                response_payload=payload,
+                request_headers='{"content-type":"application/json"}',
+                response_headers='{"content-type":"application/json"}',
+            )
+            captured += 1
+        await asyncio.sleep(0.001)
+    return captured
+
+
+async def _probe(interval: float, deadline: float) -> list[float]:
+    """How late each ``sleep(interval)`` wake-up is, in seconds."""
+    lags: list[float] = []
+    while time.perf_counter() < deadline:
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(max(time.perf_counter() - t0 - interval, 0.0))
+    return lags
+
+
+async def _run(kind: str, port: int, args) -> dict:
+    config = ApiLensConfig(
+        api_key="bench",
+        base_url=f"http://127.0.0.1:{port}/v1",
+        batch_size=args.batch_size,
+        flush_interval=args.flush_interval,
+        transport=args.transport,
+        compression=args.compression,
+        max_queue_size=args.max_queue_size,
+    )
+    client = CLIENTS[kind](config)
+    if isinstance(client, AsyncApiLensClient):
+        client.start()
+    payload = json.dumps({"data": "x" * args.payload_bytes})
+    deadline = time.perf_counter() + args.duration
+    captured, lags = await asyncio.gather(
+        _capture_load(client, args.rate, payload, deadline),
+        _probe(args.probe_interval, deadline),
+    )
+    # Drain outside the measured window.
+    if isinstance(client, AsyncApiLensClient):
+        await client.aclose()
+    else:
+        await asyncio.get_running_loop().run_in_executor(None, client.shutdown)
+    lags.sort()
+    return {
+        "captured": captured,
+        "dropped": client.dropped_count,
+        "p50_ms": _percentile(lags, 0.50) * 1000,
+        "p99_ms": _percentile(lags, 0.99) * 1000,
+        "max_ms": (lags[-1] if lags else 0.0) * 1000,
+    }
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def run_client(kind: str, args) -> dict:
+    port = _free_port()
+    cmd = [
+        sys.executable, "-m", "benchmarks.loop_lag_bench", "--serve", "--port", str(port),
+        "--latency-ms", str(args.latency_ms),
+    ]
+    proc = subprocess.Popen(cmd)
+    try:
+        _wait_ready(port, proc)
+        result = asyncio.run(_run(kind, port, args))
+        result.update(_stats(port))
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", nargs="+", choices=list(CLIENTS), default=list(CLIENTS))
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per client")
+    parser.add_argument("--rate", type=float, default=2000.0, help="records captured per second")
+    parser.add_argument("--payload-bytes", type=int, default=512, help="request and response payload size")
+    parser.add_argument("--batch-size", type=int, default=200, help="records per upload (SDK default)")
+    parser.add_argument("--flush-interval", type=float, default=3.0, help="seconds (SDK default)")
+    parser.add_argument("--max-queue-size", type=int, default=10_000)
+    parser.add_argument("--transport", choices=["stdlib", "httpx"], default="stdlib")
+    parser.add_argument("--compression", choices=["gzip", "zstd", "none"], default="gzip")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="stub ingest response delay")
+    parser.add_argument("--probe-interval", type=float, default=0.005, help="lag probe period in seconds")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port, args.latency_ms / 1000)
+        return
+
+    print(f"{'client':<10}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'uploaded':>10}{'dropped':>9}{'uploads':>9}")
+    for kind in args.only:
+        r = run_client(kind, args)
+        print(
+            f"{kind:<10}{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}{r['max_ms']:>9.2f}"
+            f"{r['records']:>10,}{r['dropped']:>9,}{r['uploads']:>9,}"
+        )
+
+
+if __name__ == "__main__":
+    main()
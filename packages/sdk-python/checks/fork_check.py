@@ -0,0 +1,248 @@
+"""Pre-fork check: SDK clients created before ``os.fork()`` (gunicorn --preload).
+
+Forks workers from a parent whose threaded client has a running flush thread,
+a pooled keep-alive connection, queued records and a queue lock held by
+another thread at fork time (with a span-recorder lock held the same way),
+then checks against a stub ingest server that:
+
+- every child can take the client's locks, starts with an empty queue and a
+  flush thread of its own, and uploads its own records exactly once;
+- no child re-sends the records queued in the parent, which the parent still
+  uploads exactly once;
+- an ``AsyncApiLensClient`` forked before it was started starts on the
+  child's event loop and uploads the child's records, while the records
+  queued before the fork are uploaded by the parent only.
+
+Exits non-zero when a check fails.
+
+    cd packages/sdk-python
+    python -m checks.fork_check
+    python -m checks.fork_check --workers 8 --records 50 --transport httpx
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from apilens.client import spans
+from apilens.client.aio import AsyncApiLensClient
+from apilens.client.client import ApiLensClient, ApiLensConfig
+
+
+# --- stub ingest --------------------------------------------------------------
+
+def serve(port: int) -> None:
+    paths: list[str] = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self) -> None:
+            self._reply(200, json.dumps(paths).encode())
+
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            payload = json.loads(body)
+            paths.extend(record["path"] for record in payload.get("requests", ()))
+            self._reply(200, b'{"accepted":1}')
+
+        def _reply(self, status: int, body: bytes) -> None:
+            self.send_response(status)
+            self.send_header("APILens-Features", "batch")
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args) -> None:
+            pass
+
+    ThreadingHTTPServer(("127.0.0.1", port), Handler).serve_forever()
+
+
+def _uploaded(port: int) -> list[str]:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/paths", timeout=5) as resp:
+        return json.loads(resp.read())
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_ready(port: int, proc: subprocess.Popen) -> None:
+    for _ in range(100):
+        if proc.poll() is not None:
+            raise RuntimeError(f"stub ingest exited with {proc.returncode}")
+        try:
+            _uploaded(port)
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("stub ingest did not start")
+
+
+# --- checks -------------------------------------------------------------------
+
+def _capture(client: ApiLensClient, tag: str, count: int) -> None:
+    for i in range(count):
+        client.capture(method="GET", path=f"/{tag}/{i}", status_code=200, response_time_ms=1.0, app_id="fork")
+
+
+def _hold(lock, seconds: float) -> threading.Thread:
+    """Hold ``lock`` from another thread for ``seconds``; returns once it is held."""
+    held = threading.Event()
+
+    def run() -> None:
+        with lock:
+            held.set()
+            time.sleep(seconds)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    held.wait()
+    return thread
+
+
+def _threaded_child(client: ApiLensClient, tag: str, records: int) -> int:
+    """Runs in a forked child; the exit status is a bit mask of failed checks."""
+    failed = 0
+    if not client._lock.acquire(timeout=2):
+        failed |= 1
+    else:
+        client._lock.release()
+    if not spans._recorder_lock.acquire(timeout=2):
+        failed |= 2
+    else:
+        spans._recorder_lock.release()
+    if client._queue:
+        failed |= 4
+    _capture(client, tag, records)
+    if client._thread is None or not client._thread.is_alive():
+        failed |= 8
+    client.shutdown()
+    return failed
+
+
+def check_threaded(port: int, args) -> list[tuple[str, bool]]:
+    config = ApiLensConfig(
+        api_key="fork", base_url=f"http://127.0.0.1:{port}/v1", flush_interval=0.2, transport=args.transport,
+    )
+    client = ApiLensClient(config)
+    # Upload once so the children inherit a pooled keep-alive connection.
+    _capture(client, "warmup", 1)
+    client.flush_all()
+    _capture(client, "parent", args.records)
+    # Held across the fork: the at-fork hook waits for the queue lock; the
+    # span-recorder lock is still held when the child is created.
+    holders = [_hold(client._lock, 0.3), _hold(spans._recorder_lock, 0.3)]
+
+    pids = {}
+    for worker in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 1 << 7
+            try:
+                status = _threaded_child(client, f"child{worker}", args.records)
+            finally:
+                os._exit(status)
+        pids[pid] = worker
+    statuses = {}
+    for pid, worker in pids.items():
+        _, status = os.waitpid(pid, 0)
+        statuses[worker] = os.waitstatus_to_exitcode(status)
+    for holder in holders:
+        holder.join()
+    client.shutdown()
+
+    counts = Counter(path.split("/")[1] for path in _uploaded(port))
+    return [
+        ("children take the inherited client lock", all(s & 1 == 0 for s in statuses.values())),
+        ("children take the inherited span-recorder lock", all(s & 2 == 0 for s in statuses.values())),
+        ("children start with an empty queue", all(s & 4 == 0 for s in statuses.values())),
+        ("children run their own flush thread", all(s & 8 == 0 for s in statuses.values())),
+        ("children exit cleanly", all(s & ~15 == 0 for s in statuses.values())),
+        ("each child uploads its records once", all(
+            counts[f"child{worker}"] == args.records for worker in range(args.workers)
+        )),
+        ("parent records uploaded once, by the parent", counts["parent"] == args.records),
+    ]
+
+
+async def _async_child(client: AsyncApiLensClient, records: int) -> None:
+    client.start()
+    _capture(client, "async-child", records)
+    await client.aclose()
+
+
+def check_async(port: int, args) -> list[tuple[str, bool]]:
+    config = ApiLensConfig(api_key="fork", base_url=f"http://127.0.0.1:{port}/v1", transport=args.transport)
+    client = AsyncApiLensClient(config, start_worker=False)
+    _capture(client, "async-parent", args.records)
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            asyncio.run(_async_child(client, args.records))
+            status = 0
+        finally:
+            os._exit(status)
+    _, status = os.waitpid(pid, 0)
+    client.shutdown()
+
+    counts = Counter(path.split("/")[1] for path in _uploaded(port))
+    return [
+        ("async child starts and closes on its own loop", os.waitstatus_to_exitcode(status) == 0),
+        ("async child uploads its records once", counts["async-child"] == args.records),
+        ("async parent records uploaded once, by the parent", counts["async-parent"] == args.records),
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4, help="forked children")
+    parser.add_argument("--records", type=int, default=20, help="records captured per process")
+    parser.add_argument("--transport", choices=["stdlib", "httpx"], default="stdlib")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port)
+        return
+    if not hasattr(os, "fork"):
+        sys.exit("fork_check needs os.fork()")
+
+    failures = 0
+    for check in (check_threaded, check_async):
+        port = _free_port()
+        proc = subprocess.Popen([sys.executable, "-m", "checks.fork_check", "--serve", "--port", str(port)])
+        try:
+            _wait_ready(port, proc)
+            results = check(port, args)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+        for name, ok in results:
+            print(f"{'ok' if ok else 'FAIL':<6}{name}")
+            failures += not ok
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()